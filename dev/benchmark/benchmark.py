@@ -0,0 +1,332 @@
+'''
+benchmark.py: measure the throughput of eprints2bags against a local server
+
+This starts the mock EPrints server in mockserver.py, runs eprints2bags
+against it once for each of several scenarios (bag and archive modes and
+archive types), and reports for each one the records per second, megabytes of
+documents per second, CPU time (of eprints2bags itself and of its
+checksumming processes) and the time and CPU time spent in each stage of the
+record processing pipeline.  Baselines also hold the totals for each kind of
+operation kept by eprints2bags/metrics.py.  eprints2bags is run from the source tree this
+file is in, each scenario in a separate process.
+
+Results can be saved as a JSON baseline, and later runs compared against a
+baseline to catch performance regressions before upgrading:
+
+    python3 dev/benchmark/benchmark.py --records 200 --save before
+    ... change or upgrade things ...
+    python3 dev/benchmark/benchmark.py --records 200 --compare before
+
+Baselines are kept in dev/benchmark/baselines/.  A comparison exits with
+status 1 if any scenario got slower by more than the tolerance.
+
+The server can inject faults (see mockserver.py); the time eprints2bags
+spent in each of its retry and backoff paths is then reported as well, to
+help in tuning them:
+
+    python3 dev/benchmark/benchmark.py --scenarios bag \
+            --fault documents:429=0.05,reset=0.05 --fault records:202=0.05
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import argparse
+from   collections import OrderedDict
+from   datetime import datetime
+import importlib.util
+import json
+import os
+from   os import path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from   urllib.request import urlopen
+
+_HERE = path.dirname(path.abspath(__file__))
+sys.path.insert(0, _HERE)
+sys.path.insert(0, path.join(_HERE, '..', '..'))
+
+from   mockserver import MockServer, byte_count, fault_spec, add_fault_arguments
+
+
+# Constants.
+# .............................................................................
+
+SCENARIOS = OrderedDict([
+    ('none',                     ['-b', 'none']),
+    ('bag',                      ['-b', 'bag']),
+    ('archive-uncompressed-zip', ['-t', 'uncompressed-zip']),
+    ('archive-compressed-zip',   ['-t', 'compressed-zip']),
+    ('archive-smart-zip',        ['-t', 'smart-zip']),
+    ('archive-uncompressed-tar', ['-t', 'uncompressed-tar']),
+    ('archive-compressed-tar',   ['-t', 'compressed-tar']),
+    ('archive-zstd-tar',         ['-t', 'zstd-tar']),
+    ('stream-uncompressed-zip',  ['-x', '-t', 'uncompressed-zip']),
+    ('stream-compressed-zip',    ['-x', '-t', 'compressed-zip']),
+])
+'''Scenarios benchmarked, and the eprints2bags options used for each.'''
+
+BASELINE_DIR = path.join(_HERE, 'baselines')
+'''Directory where baselines named without a path are kept.'''
+
+DEFAULT_TOLERANCE = 0.15
+'''Default fraction by which throughput may drop before it's a regression.'''
+
+
+# Main functions.
+# .............................................................................
+
+def benchmark(server, scenarios, extra_args, repeat = 1):
+    '''Run eprints2bags against the MockServer 'server' for each of the named
+    'scenarios', adding 'extra_args' to the command line.  Returns an
+    OrderedDict mapping scenario names to results.  With 'repeat' > 1, each
+    scenario is run that many times and the fastest run is kept.'''
+    results = OrderedDict()
+    for name in scenarios:
+        best = None
+        for _ in range(repeat):
+            result = run_scenario(server, SCENARIOS[name] + extra_args)
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        results[name] = best
+        print(summary_line(name, best))
+        sys.stdout.flush()
+    return results
+
+
+def run_scenario(server, args):
+    '''Run eprints2bags once with 'args' in a separate process, and return a
+    dict of measurements.'''
+    output_dir = tempfile.mkdtemp(prefix = 'eprints2bags-bench-')
+    result_file = path.join(output_dir, 'result.json')
+    command = [sys.executable, path.abspath(__file__), '--run-one', result_file,
+               '--', '-a', server.base_url + '/rest', '-u', 'bench', '-p', 'bench',
+               '-o', path.join(output_dir, 'out'), '-K', '-q', '-C', '-r', '0'] + args
+    try:
+        stats(server, reset = True)
+        subprocess.check_call(command, stdout = subprocess.DEVNULL)
+        with open(result_file) as file:
+            result = json.load(file)
+        sent = stats(server)
+        seconds = result['seconds']
+        result['records_per_sec'] = server_records(server) / seconds
+        result['mb_per_sec'] = sent['bytes'] / 1000000 / seconds
+        result['requests'] = sent['requests']
+        result['faults'] = sent['faults']
+        return result
+    finally:
+        shutil.rmtree(output_dir, ignore_errors = True)
+
+
+def run_one(result_file, args):
+    '''Run eprints2bags in this process with command-line arguments 'args',
+    and write the measurements to 'result_file'.'''
+    import plac
+    from eprints2bags.__main__ import main
+    from eprints2bags.metrics import operation_stats
+    from eprints2bags.network import retry_stats
+    from eprints2bags.pipeline import Pipeline
+
+    # Keep a hold of the pipeline, to get its statistics at the end.
+    pipelines = []
+    original_run = Pipeline.run
+    def run(self, items):
+        pipelines.append(self)
+        return original_run(self, items)
+    Pipeline.run = run
+
+    before = os.times()
+    start = time.perf_counter()
+    plac.call(main, args)
+    seconds = time.perf_counter() - start
+    after = os.times()
+    stages = OrderedDict()
+    if pipelines:
+        for name, totals in pipelines[0].stats().items():
+            stages[name] = totals._asdict()
+    result = {'seconds': seconds,
+              'cpu_seconds': (after.user - before.user) + (after.system - before.system),
+              'child_cpu_seconds': ((after.children_user - before.children_user)
+                                    + (after.children_system - before.children_system)),
+              'stages': stages,
+              'operations': OrderedDict((name, OrderedDict([('count', totals.count),
+                                                            ('seconds', totals.seconds),
+                                                            ('bytes', totals.bytes)]))
+                                        for name, totals in operation_stats().items()
+                                        if totals.count),
+              'retries': OrderedDict((name, totals._asdict())
+                                     for name, totals in retry_stats().items()
+                                     if totals.count)}
+    with open(result_file, 'w') as file:
+        json.dump(result, file)
+
+
+def compare(results, baseline, tolerance):
+    '''Print a comparison of 'results' with the results in 'baseline', and
+    return the names of the scenarios whose throughput dropped by more than
+    the fraction 'tolerance'.'''
+    regressions = []
+    print('')
+    print('{:26} {:>12} {:>12} {:>8}'.format('scenario', 'baseline r/s', 'now r/s', 'change'))
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['records_per_sec']
+        now = result['records_per_sec']
+        change = (now - before) / before
+        flag = ''
+        if change < -tolerance:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print('{:26} {:12.2f} {:12.2f} {:+7.1%}{}'.format(name, before, now, change, flag))
+    return regressions
+
+
+# Helper functions.
+# .............................................................................
+
+def stats(server, reset = False):
+    url = server.base_url + '/_stats' + ('?reset=1' if reset else '')
+    with urlopen(url) as response:
+        return json.loads(response.read().decode())
+
+
+def server_records(server):
+    return len(server.numbers)
+
+
+def summary_line(name, result):
+    stages = '  '.join('{} {:.1f}s/{:.1f}s'.format(stage, totals['seconds'],
+                                                    totals['cpu_seconds'] or 0)
+                       for stage, totals in result['stages'].items())
+    line = ('{:26} {:8.2f} rec/s {:8.2f} MB/s  cpu {:6.1f}s + {:6.1f}s hashing  [{}]'
+            .format(name, result['records_per_sec'], result['mb_per_sec'],
+                    result['cpu_seconds'], result['child_cpu_seconds'], stages))
+    if result.get('faults'):
+        line += '\n{:26} faults: {}'.format('', '  '.join(
+            '{} {}'.format(fault, count) for fault, count in sorted(result['faults'].items())))
+    if result.get('retries'):
+        line += '\n{:26} retries: {}'.format('', '  '.join(
+            '{} {}x {:.1f}s'.format(kind, totals['count'], totals['seconds'])
+            for kind, totals in result['retries'].items()))
+    return line
+
+
+def baseline_path(name):
+    if path.sep in name or name.endswith('.json'):
+        return name
+    return path.join(BASELINE_DIR, name + '.json')
+
+
+def zstd_available():
+    return importlib.util.find_spec('zstandard') is not None
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark eprints2bags.')
+    parser.add_argument('--records', type = int, default = 100,
+                        help = 'number of records served (default: 100)')
+    parser.add_argument('--docs', type = int, default = 1,
+                        help = 'number of documents per record (default: 1)')
+    parser.add_argument('--doc-sizes', default = '256K,2M',
+                        help = 'document sizes, separated by commas (default: 256K,2M)')
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = 'server latency in milliseconds (default: 0)')
+    parser.add_argument('--bandwidth', default = '0',
+                        help = 'max. bytes/sec per connection (default: no limit)')
+    parser.add_argument('--scenarios', default = ','.join(SCENARIOS),
+                        help = 'scenarios to run, separated by commas (default: all)')
+    parser.add_argument('--repeat', type = int, default = 1,
+                        help = 'run each scenario N times and keep the best (default: 1)')
+    parser.add_argument('--verify', default = 'fast',
+                        help = 'value of eprints2bags option -v (default: fast)')
+    parser.add_argument('--workers', help = 'value of eprints2bags option -w')
+    parser.add_argument('--processes', help = 'value of eprints2bags option -c')
+    parser.add_argument('--save', metavar = 'NAME', help = 'save the results as baseline NAME')
+    parser.add_argument('--compare', metavar = 'NAME', help = 'compare the results with baseline NAME')
+    parser.add_argument('--tolerance', type = float, default = DEFAULT_TOLERANCE,
+                        help = 'allowed drop in records/sec (default: {})'.format(DEFAULT_TOLERANCE))
+    add_fault_arguments(parser)
+    parser.add_argument('--run-one', help = argparse.SUPPRESS)
+    parser.add_argument('rest', nargs = argparse.REMAINDER, help = argparse.SUPPRESS)
+    options = parser.parse_args(args)
+
+    if options.run_one:
+        run_one(options.run_one, options.rest[1:] if options.rest[:1] == ['--'] else options.rest)
+        return 0
+
+    scenarios = [name.strip() for name in options.scenarios.split(',')]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(unknown))
+    try:
+        faults = fault_spec(options.fault)
+    except ValueError as ex:
+        parser.error(str(ex))
+    if not zstd_available() and 'archive-zstd-tar' in scenarios:
+        print('Skipping archive-zstd-tar: package zstandard is not installed')
+        scenarios.remove('archive-zstd-tar')
+    extra_args = ['-v', options.verify]
+    if options.workers:
+        extra_args += ['-w', options.workers]
+    if options.processes:
+        extra_args += ['-c', options.processes]
+
+    settings = OrderedDict([('records', options.records), ('docs', options.docs),
+                            ('doc_sizes', options.doc_sizes), ('latency', options.latency),
+                            ('bandwidth', options.bandwidth), ('verify', options.verify),
+                            ('workers', options.workers), ('processes', options.processes)])
+    if faults:
+        settings.update([('faults', options.fault), ('retry_after', options.retry_after),
+                         ('slow_rate', options.slow_rate), ('seed', options.seed)])
+    server = MockServer(0, options.records, [byte_count(x) for x in options.doc_sizes.split(',')],
+                        options.docs, options.latency / 1000, byte_count(options.bandwidth),
+                        faults, options.retry_after, byte_count(options.slow_rate), options.seed)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    try:
+        results = benchmark(server, scenarios, extra_args, options.repeat)
+    finally:
+        server.shutdown()
+
+    report = OrderedDict([('created', datetime.now().isoformat(timespec = 'seconds')),
+                          ('python', platform.python_version()),
+                          ('platform', platform.platform()),
+                          ('cpus', os.cpu_count()),
+                          ('settings', settings),
+                          ('results', results)])
+    status = 0
+    if options.compare:
+        with open(baseline_path(options.compare)) as file:
+            baseline = json.load(file)
+        if baseline.get('settings') != settings:
+            print('Warning: the baseline was made with different settings: {}'
+                  .format(json.dumps(baseline.get('settings'))))
+        if compare(results, baseline, options.tolerance):
+            status = 1
+    if options.save:
+        file_path = baseline_path(options.save)
+        os.makedirs(path.dirname(path.abspath(file_path)), exist_ok = True)
+        with open(file_path, 'w') as file:
+            json.dump(report, file, indent = 2)
+            file.write('\n')
+        print('Saved results in {}'.format(file_path))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,481 @@
+'''
+mockserver.py: a local imitation of an EPrints REST server for benchmarking
+
+This serves a synthetic list of records at /rest/eprint, EP3 XML records at
+/rest/eprint/N.xml (modeled on the records in tests/test-xml.xml), single
+fields at /rest/eprint/N/FIELD.txt, and the documents referenced by the
+records.  The number of records, the number and sizes of documents, the
+latency of every response and the bandwidth of every connection can be set
+on the command line.  Documents are random bytes (like PDF files, they don't
+compress), and support HTTP Range requests and ETags like a real server.
+
+The server also answers /_stats with a JSON object giving the number of
+requests, the number of bytes of documents sent and the number of faults
+injected since the server started or since the last request for
+/_stats?reset=1.
+
+Faults can be injected at random into the responses to each kind of request
+("endpoint"): the listing of records, the records, single fields, and
+documents.  Each --fault option names an endpoint and the probability of
+each kind of fault there:
+
+    429, 503   answer with that HTTP code (and Retry-After, if --retry-after
+               is given) instead of the content
+    202        answer with HTTP code 202 and no content
+    reset      reset the connection without answering
+    truncate   send the full Content-Length but only half of the content,
+               then close the connection
+    slow       send the content at --slow-rate bytes per second
+
+Usage:
+
+    python3 dev/benchmark/mockserver.py --records 1000 --doc-sizes 200K,5M
+    python3 dev/benchmark/mockserver.py --fault documents:429=0.1,reset=0.02 \
+            --fault records:503=0.05 --retry-after 1
+
+The EPrints API URL of the server is then http://127.0.0.1:8765/rest.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import argparse
+import copy
+from   http.server import HTTPServer, BaseHTTPRequestHandler
+import json
+from   lxml import etree
+from   os import path
+import random
+import re
+import socket
+from   socketserver import ThreadingMixIn
+import struct
+import sys
+import threading
+import time
+import zlib
+
+
+# Constants.
+# .............................................................................
+
+DEFAULT_PORT = 8765
+'''Default port on which the server listens.'''
+
+_TEMPLATE_FILE = path.join(path.dirname(path.abspath(__file__)),
+                           '..', '..', 'tests', 'test-xml.xml')
+'''EP3 XML file whose records are used as templates for synthetic records.'''
+
+_NS = 'http://eprints.org/ep2/data/2.0'
+'''XML namespace used in EPrints XML output.'''
+
+_POOL_SIZE = 16 * 1024 * 1024
+'''Size of the pool of random bytes from which documents are cut.'''
+
+_WRITE_SIZE = 65536
+'''Number of bytes written to the network at a time.'''
+
+_SUFFIXES = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+'''Multipliers for suffixes allowed on byte counts.'''
+
+ENDPOINTS = ['listing', 'records', 'fields', 'documents']
+'''Kinds of requests into whose responses faults can be injected.'''
+
+FAULTS = ['429', '503', '202', 'reset', 'truncate', 'slow']
+'''Kinds of faults that can be injected.'''
+
+DEFAULT_SLOW_RATE = 4096
+'''Default number of bytes per second sent in responses with fault "slow".'''
+
+
+# Exported classes.
+# .............................................................................
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    '''HTTP server imitating an EPrints server.  'records' is the number of
+    records; 'doc_sizes' a list of document sizes, used in turn; 'docs' the
+    number of documents per record; 'latency' the time in seconds to wait
+    before answering any request; and 'bandwidth' the maximum number of bytes
+    per second sent over any one connection (0 for no limit).  'faults' maps
+    names in ENDPOINTS to lists of (fault, probability) pairs, as returned by
+    fault_spec(); 'retry_after' is the value of the Retry-After header sent
+    with faults 429 and 503 (None for no header); 'slow_rate' is the number of
+    bytes per second sent with fault "slow"; and 'seed' seeds the choice of
+    faults, which starts over when the statistics are reset.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port = DEFAULT_PORT, records = 100, doc_sizes = [262144],
+                 docs = 1, latency = 0, bandwidth = 0, faults = {},
+                 retry_after = None, slow_rate = DEFAULT_SLOW_RATE, seed = 0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.numbers = [str(n) for n in range(1, records + 1)]
+        self.known = set(self.numbers)
+        self.doc_sizes = doc_sizes
+        self.docs = docs
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.faults = faults
+        self.retry_after = retry_after
+        self.slow_rate = slow_rate
+        self.seed = seed
+        self.pool = random.Random(0).getrandbits(8 * _POOL_SIZE).to_bytes(_POOL_SIZE, 'little')
+        self.templates = _templates(_TEMPLATE_FILE)
+        self.listing = _listing(self.numbers)
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.injected = {fault: 0 for fault in FAULTS}
+            self.random = random.Random(self.seed)
+
+
+    def count(self, bytes_sent = 0, request = False):
+        with self.lock:
+            self.requests += 1 if request else 0
+            self.bytes_sent += bytes_sent
+
+
+    def fault(self, endpoint):
+        '''Returns the fault to inject into the response to a request for
+        'endpoint', or None to answer normally.'''
+        if endpoint not in self.faults:
+            return None
+        with self.lock:
+            draw = self.random.random()
+            for fault, probability in self.faults[endpoint]:
+                if draw < probability:
+                    self.injected[fault] += 1
+                    return fault
+                draw -= probability
+        return None
+
+
+    def record(self, number):
+        '''Returns the EP3 XML of record 'number' as bytes.'''
+        n = int(number)
+        template = self.templates[n % len(self.templates)]
+        eprints = etree.Element('{' + _NS + '}eprints', nsmap = {None: _NS})
+        eprint = copy.deepcopy(template)
+        eprint.attrib['id'] = '{}/id/eprint/{}'.format(self.base_url, number)
+        eprint.find('{' + _NS + '}eprintid').text = number
+        documents = eprint.find('{' + _NS + '}documents')
+        prototype = documents[0]
+        for document in list(documents):
+            documents.remove(document)
+        for k in range(1, self.docs + 1):
+            document = copy.deepcopy(prototype)
+            document.attrib['id'] = '{}/id/document/{}{:03d}'.format(self.base_url, n, k)
+            url = document.find('.//{' + _NS + '}url')
+            url.text = '{}/{}/{}/document-{}.pdf'.format(self.base_url, n, k, k)
+            size = document.find('.//{' + _NS + '}filesize')
+            size.text = str(self.document_size(n, k))
+            documents.append(document)
+        eprints.append(eprint)
+        return etree.tostring(eprints, xml_declaration = True, encoding = 'utf-8')
+
+
+    def document_size(self, n, k):
+        return self.doc_sizes[(n + k) % len(self.doc_sizes)]
+
+
+    def document(self, doc_path):
+        '''Returns the size of the document at 'doc_path' and a function that
+        returns the bytes of the document in a given range, or None if there
+        is no such document.'''
+        match = re.match(r'/(\d+)/(\d+)/document-\d+\.pdf$', doc_path)
+        if not match or match.group(1) not in self.known:
+            return None
+        n, k = int(match.group(1)), int(match.group(2))
+        if not 1 <= k <= self.docs:
+            return None
+        size = self.document_size(n, k)
+        offset = zlib.crc32(doc_path.encode()) % _POOL_SIZE
+
+        def content(start, end):
+            # Bytes from 'start' up to and not including 'end', cut from the
+            # pool of random bytes, wrapping around as needed.
+            parts = []
+            position = (offset + start) % _POOL_SIZE
+            remaining = end - start
+            while remaining > 0:
+                part = self.pool[position:position + remaining]
+                parts.append(part)
+                remaining -= len(part)
+                position = 0
+            return b''.join(parts)
+
+        return size, content
+
+
+# Helper classes.
+# .............................................................................
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and bodies are written separately; without this, clients wait
+    # for delayed TCP acknowledgments.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_HEAD(self):
+        self.do_GET()
+
+
+    def do_GET(self):
+        server = self.server
+        server.count(request = True)
+        if server.latency:
+            time.sleep(server.latency)
+        url_path = self.path.split('?')[0]
+        self.fault = None
+        if url_path == '/_stats':
+            return self.send_stats()
+        self.fault = server.fault(_endpoint(url_path))
+        if self.fault in ['429', '503', '202']:
+            self.send_response(int(self.fault))
+            if self.fault != '202' and server.retry_after is not None:
+                self.send_header('Retry-After', str(server.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.fault == 'reset':
+            # Closing a socket with a zero linger time sends a TCP reset.
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            self.close_connection = True
+        elif url_path in ['/rest/eprint', '/rest/eprint/']:
+            self.send_body(200, server.listing, 'text/html')
+        elif re.match(r'/rest/eprint/\d+\.xml$', url_path):
+            number = url_path.split('/')[-1].split('.')[0]
+            if number in server.known:
+                self.send_body(200, server.record(number), 'text/xml')
+            else:
+                self.send_body(404, b'', 'text/plain')
+        elif re.match(r'/rest/eprint/\d+/\w+\.txt$', url_path):
+            self.send_field(*url_path.split('/')[-2:])
+        else:
+            self.send_document(url_path)
+
+
+    def send_stats(self):
+        server = self.server
+        with server.lock:
+            stats = {'requests': server.requests, 'bytes': server.bytes_sent,
+                     'faults': {f: n for f, n in server.injected.items() if n}}
+        if 'reset=1' in self.path:
+            server.reset_stats()
+        self.send_body(200, json.dumps(stats).encode(), 'application/json')
+
+
+    def send_field(self, number, field_file):
+        server = self.server
+        if number not in server.known:
+            return self.send_body(404, b'', 'text/plain')
+        xml = etree.fromstring(server.record(number))
+        node = xml.find('{' + _NS + '}eprint/{' + _NS + '}' + field_file[:-4])
+        text = node.text if node is not None and node.text else ''
+        self.send_body(200, text.encode(), 'text/plain')
+
+
+    def send_document(self, doc_path):
+        found = self.server.document(doc_path)
+        if not found:
+            return self.send_body(404, b'', 'text/plain')
+        size, content = found
+        etag = '"{:08x}"'.format(zlib.crc32(doc_path.encode()))
+        headers = [('Accept-Ranges', 'bytes'), ('ETag', etag)]
+        start, end = 0, size
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range', etag) == etag:
+            first, last = range_header.split('=')[1].split('-')
+            start = int(first)
+            end = min(size, int(last) + 1) if last else size
+            status = 206
+            headers.append(('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size)))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(end - start))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.write_range(content, start, end)
+
+
+    def write_range(self, content, start, end):
+        # Write the bytes of a document, no faster than the bandwidth limit,
+        # or only half of them if the response is to be truncated.
+        bandwidth = self.server.bandwidth
+        if self.fault == 'slow':
+            bandwidth = self.server.slow_rate
+        elif self.fault == 'truncate':
+            end = start + (end - start) // 2
+            self.close_connection = True
+        piece = max(1, min(_WRITE_SIZE, bandwidth // 10)) if bandwidth else _WRITE_SIZE
+        began = time.perf_counter()
+        sent = 0
+        position = start
+        while position < end:
+            data = content(position, min(end, position + piece))
+            self.wfile.write(data)
+            position += len(data)
+            sent += len(data)
+            self.server.count(len(data))
+            if bandwidth:
+                ahead = sent / bandwidth - (time.perf_counter() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            if self.fault in ['slow', 'truncate']:
+                self.write_range(lambda start, end: body[start:end], 0, len(body))
+            else:
+                self.wfile.write(body)
+
+
+# Helper functions.
+# .............................................................................
+
+def _templates(file_name):
+    # Returns the <eprint> elements of the records in 'file_name' that have
+    # documents, with any derived documents removed.
+    templates = []
+    for eprint in etree.parse(file_name).getroot():
+        documents = eprint.find('{' + _NS + '}documents')
+        if documents is None or not len(documents):
+            continue
+        for document in list(documents):
+            if document.find('.//{' + _NS + '}relation') is not None:
+                documents.remove(document)
+        if len(documents):
+            templates.append(eprint)
+    return templates
+
+
+def _listing(numbers):
+    # Returns the XHTML list of records sent by EPrints for /rest/eprint.
+    head = ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"'
+            ' "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml">\n'
+            '<head><title>EPrints REST: Eprints DataSet</title></head>\n'
+            '<body>\n<h1>EPrints REST: Eprints DataSet</h1>\n<ul>\n')
+    items = ''.join("<li><a href='{0}/'>{0}/</a></li>\n<li><a href='{0}.xml'>{0}.xml</a></li>\n"
+                    .format(n) for n in numbers)
+    return (head + items + '</ul>\n</body>\n</html>\n').encode('utf-8')
+
+
+def _endpoint(url_path):
+    # Returns the name in ENDPOINTS of the kind of request for 'url_path'.
+    if url_path in ['/rest/eprint', '/rest/eprint/']:
+        return 'listing'
+    elif re.match(r'/rest/eprint/\d+\.xml$', url_path):
+        return 'records'
+    elif url_path.startswith('/rest/eprint/'):
+        return 'fields'
+    return 'documents'
+
+
+def fault_spec(specs):
+    '''Returns the faults to inject described by the strings in 'specs', each
+    of the form ENDPOINT:FAULT=PROBABILITY,..., as a dict mapping names in
+    ENDPOINTS to lists of (fault, probability) pairs.  Raises ValueError if
+    a string is not valid.'''
+    faults = {}
+    for spec in specs:
+        endpoint, _, kinds = spec.partition(':')
+        if endpoint not in ENDPOINTS:
+            raise ValueError('unknown endpoint "{}" in "{}"'.format(endpoint, spec))
+        for kind in kinds.split(','):
+            fault, _, probability = kind.partition('=')
+            if fault not in FAULTS:
+                raise ValueError('unknown fault "{}" in "{}"'.format(fault, spec))
+            faults.setdefault(endpoint, []).append((fault, float(probability)))
+        if sum(p for _, p in faults[endpoint]) > 1:
+            raise ValueError('probabilities add up to more than 1 in "{}"'.format(spec))
+    return faults
+
+
+def byte_count(text):
+    '''Returns the number of bytes given by 'text', which may end in K, M or G.'''
+    text = text.strip().upper()
+    if text and text[-1] in _SUFFIXES:
+        return int(float(text[:-1]) * _SUFFIXES[text[-1]])
+    return int(text)
+
+
+def add_fault_arguments(parser):
+    '''Add the options controlling fault injection to the argparse 'parser'.'''
+    parser.add_argument('--fault', action = 'append', default = [],
+                        metavar = 'ENDPOINT:FAULT=P,...',
+                        help = 'inject faults into responses; may be repeated (endpoints: {};'
+                        ' faults: {})'.format(', '.join(ENDPOINTS), ', '.join(FAULTS)))
+    parser.add_argument('--retry-after', type = int,
+                        help = 'Retry-After seconds sent with faults 429 and 503 (default: none)')
+    parser.add_argument('--slow-rate', default = str(DEFAULT_SLOW_RATE),
+                        help = 'bytes/sec sent with fault "slow" (default: {})'
+                        .format(DEFAULT_SLOW_RATE))
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = 'seed for the random choice of faults (default: 0)')
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = 'Imitate an EPrints REST server.')
+    parser.add_argument('--port', type = int, default = DEFAULT_PORT,
+                        help = 'port to listen on (default: {})'.format(DEFAULT_PORT))
+    parser.add_argument('--records', type = int, default = 100,
+                        help = 'number of records (default: 100)')
+    parser.add_argument('--docs', type = int, default = 1,
+                        help = 'number of documents per record (default: 1)')
+    parser.add_argument('--doc-sizes', default = '256K',
+                        help = 'document sizes, separated by commas (default: 256K)')
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = 'milliseconds to wait before every response (default: 0)')
+    parser.add_argument('--bandwidth', default = '0',
+                        help = 'max. bytes/sec per connection, 0 for no limit (default: 0)')
+    add_fault_arguments(parser)
+    options = parser.parse_args(args)
+    try:
+        faults = fault_spec(options.fault)
+    except ValueError as ex:
+        parser.error(str(ex))
+    server = MockServer(options.port, options.records,
+                        [byte_count(x) for x in options.doc_sizes.split(',')],
+                        options.docs, options.latency / 1000,
+                        byte_count(options.bandwidth), faults, options.retry_after,
+                        byte_count(options.slow_rate), options.seed)
+    print('Serving {} records at {}/rest'.format(options.records, server.base_url))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -29,18 +29,21 @@ file "LICENSE" for more information.
 
 import bagit
 from   collections import defaultdict
+from   concurrent.futures import ThreadPoolExecutor
 import getpass
 from   humanize import intcomma
+from   itertools import chain, islice
 import keyring
 from   lxml import etree
 import os
 from   os import path
 import plac
+import random
 import requests
 import shutil
 import sys
 import tarfile
-from   time import sleep
+import threading
 from   timeit import default_timer as timer
 
 if sys.platform.startswith('win'):
@@ -49,14 +52,29 @@ if sys.platform.startswith('win'):
 
 import eprints2bags
 from   eprints2bags import print_version
+from   eprints2bags import bags
+from   eprints2bags.checksums import HashPool
 from   eprints2bags.constants import ON_WINDOWS, KEYRING_PREFIX
 from   eprints2bags.data_helpers import flatten, expand_range, parse_datetime
-from   eprints2bags.debug import set_debug, log
+from   eprints2bags.debug import set_debug, set_tracing, flush_trace, log
+from   eprints2bags.debug import new_span, span
 from   eprints2bags.messages import msg, color, MessageHandler
 from   eprints2bags.network import network_available, download_files, url_host
+from   eprints2bags.network import configure_session, use_async_network
+from   eprints2bags.network import set_rate_limits, set_chunk_size, set_segments
+from   eprints2bags.network import stream_files, retry_stats, RETRY_PATHS
+from   eprints2bags.pipeline import Pipeline, Stage
+from   eprints2bags.metrics import timed, write_summary, PrometheusWriter
+from   eprints2bags.journal import Journal, JOURNAL_FILE, MISSING, SKIPPED
+from   eprints2bags.journal import UNCHANGED, stage_done, remove_journal
+from   eprints2bags.manifest import Manifest, ManifestEntry, MANIFEST_FILE
+from   eprints2bags.layout import LAYOUTS, MAX_FLAT_RECORDS, record_path, find_record
+from   eprints2bags.layout import saved_layout, save_layout, remove_layout
 from   eprints2bags.files import readable, writable, make_dir
 from   eprints2bags.files import fs_type, KNOWN_SUBDIR_LIMITS
+from   eprints2bags.compression import zstd_available, ZSTD_MAX_LEVEL
 from   eprints2bags.files import create_archive, verify_archive, archive_extension
+from   eprints2bags.files import archive_type, directory_members
 from   eprints2bags.processes import available_cpus
 from   eprints2bags.eprints import *
 
@@ -66,13 +84,59 @@ from   eprints2bags.eprints import *
 
 _RECOGNIZED_ACTIONS = ['none', 'bag', 'bag-and-archive', 'bag+archive']
 
-_RECOGNIZED_ARCHIVE_TYPES = ['compressed-zip', 'uncompressed-zip',
-                             'compressed-tar', 'uncompressed-tar']
+_RECOGNIZED_ARCHIVE_TYPES = ['compressed-zip', 'uncompressed-zip', 'smart-zip',
+                             'compressed-tar', 'uncompressed-tar', 'zstd-tar']
 '''List of values recognized for the final archive file format.'''
 
+_NUM_STAGES = 4
+'''Number of stages in the record processing pipeline: fetch, download, bag,
+and archive.'''
+
+_DEFAULT_WORKERS = '1,2,1,1'
+'''Default number of worker threads for each stage of the pipeline.'''
+
+_DEFAULT_PER_HOST = 8
+'''Default maximum number of requests in flight to any one host when using
+the asynchronous network layer.'''
+
+_DEFAULT_RATE = '10'
+'''Default maximum number of network requests per second.'''
+
+_BYTE_SUFFIXES = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+'''Multipliers for suffixes allowed on byte counts given to -r, -z and -g.'''
+
+_DEFAULT_CHUNK_SIZE = '1M'
+'''Default size of the buffer used to read documents from the network.'''
+
+_DEFAULT_SEGMENTS = '64M,4'
+'''Default size above which documents are downloaded in several parts at
+once, and the number of parts.'''
+
+_MIN_POOL_SIZE = 10
+'''Minimum number of network connections kept open to the server.'''
+
+_FINAL_STAGE = {'none'            : 'downloaded',
+                'bag'             : 'bagged',
+                'bag+archive'     : 'bagged',
+                'bag-and-archive' : 'archived'}
+'''The last processing stage done for a record, for each value of -b.'''
+
 _BAG_CHECKSUMS = ["sha256", "sha512", "md5"]
 '''List of checksum types written with the BagIt bags.'''
 
+_VERIFY_LEVELS = ['none', 'fast', 'full', 'sampled']
+'''Values recognized for the -v option.'''
+
+_DEFAULT_VERIFY = 'sampled'
+'''Default level of verification of bags and archives.'''
+
+_SAMPLE_FRACTION = 0.1
+'''Fraction of records that get full verification with "-v sampled".'''
+
+_FILTER_SAMPLE = 20
+'''Number of records the filters must have been applied to before FilterGate
+starts deciding whether getting the fields they need first is worth it.'''
+
 _LASTMOD_PRINT_FORMAT = '%b %d %Y %H:%M:%S %Z'
 '''Format in which lastmod date is printed back to the user. The value is used
 with datetime.strftime().'''
@@ -96,7 +160,22 @@ with datetime.strftime().'''
     user       = ('EPrints server user login name "U"',                     'option', 'u'),
     password   = ('EPrints server user password "P"',                       'option', 'p'),
     arch_type  = ('use archive type "T" (default: "uncompressed-zip")',     'option', 't'),
-    delay      = ('wait time between fetches (default: 100 ms)',            'option', 'y'),
+    rate       = ('max requests/sec[,bytes/sec] (default: 10 requests/sec)', 'option', 'r'),
+    delay      = ('wait time in ms between requests (instead of -r)',      'option', 'y'),
+    workers    = ('threads for fetch,download,bag,archive (default: 1,2,1,1)', 'option', 'w'),
+    in_flight  = ('use async network I/O with at most "M" requests at once', 'option', 'm'),
+    resume     = ('resume an interrupted run in the same output directory',  'flag',   'j'),
+    incremental = ('only get records changed since they were last written', 'flag',   'd'),
+    verify     = ('verify bags & archives: none, fast, full, sampled',        'option', 'v'),
+    chunk_size = ('read documents "Z" bytes at a time (default: 1M)',       'option', 'z'),
+    segments   = ('get docs over "G" bytes in parts (default: 64M,4 parts)', 'option', 'g'),
+    stream     = ('write records straight into archive files, not directories', 'flag', 'x'),
+    level      = ('compress archives at level "L" (default: 6, zstd: 3)',   'option', 'L'),
+    canonical  = ('write record XML in canonical form (C14N), not as sent',  'flag',   'X'),
+    layout     = ('output layout: flat, sharded, auto (default: auto)',      'option', 'f'),
+    metrics_file = ('write timing metrics as JSON to "JSON" at the end',    'option', 'M'),
+    prom_file  = ('keep Prometheus metrics up to date in file "PROM"',      'option', 'P'),
+    trace      = ('if an error occurs, write recent trace to "TRACE"',      'option', 'T'),
     no_color   = ('do not color-code terminal output',                      'flag',   'C'),
     no_keyring = ('do not store credentials in a keyring service',          'flag',   'K'),
     reset_keys = ('reset user and password used',                           'flag',   'R'),
@@ -106,8 +185,12 @@ with datetime.strftime().'''
 
 def main(api_url = 'A', bag_action = 'B', processes = 'C', end_action = 'E',
          id_list = 'I', keep_going = False, lastmod = 'L', name_base = 'N',
-         output_dir = 'O', quiet = False, status = 'S', user = 'U',
-         password = 'P', arch_type = 'T', delay = 100, no_color = False,
+         output_dir = 'O', quiet = False, rate = 'R', status = 'S', user = 'U',
+         password = 'P', arch_type = 'T', delay = 'Y', workers = 'W',
+         in_flight = 'M', resume = False, incremental = False,
+         verify = 'V', chunk_size = 'Z', segments = 'G',
+         stream = False, level = 'L', canonical = False, layout = 'F',
+         metrics_file = 'JSON', prom_file = 'PROM', trace = 'TRACE', no_color = False,
          no_keyring = False, reset_keys = False, version = False, debug = 'OUT'):
     '''eprints2bags bags up EPrints content as BagIt bags.
 
@@ -151,6 +234,14 @@ value is *not* among those given.  Examples:
   eprints2bags -s ^inbox,buffer,deletion -a ...
 
 Both lastmod and status filering are done after the -i argument is processed.
+When either filter is used, eprints2bags first asks the server for only the
+eprint_status and lastmod values of each record (e.g., using a URL ending in
+/eprint/4/lastmod.txt), and gets the full record only if it passes the filters.
+This uses as many threads as the fetch stage (see -w below), and the two
+values are asked for at the same time.  (The EPrints API can't give a field
+for several records in one request.)  Since it adds a request or two for
+every record kept, eprints2bags stops doing this when the time it takes is
+more than the time saved by not getting the records that are left out.
 
 By default, if an error occurs when requesting a record from the EPrints
 server, it stops execution of eprints2bags.  Common causes of errors include
@@ -181,6 +272,17 @@ have the form NAME-NUMBER_ where NAME is the text string provided to the -n
 option and the NUMBER is the EPrints number for a given entry (meaning,
 /path/to/output/NAME-43, /path/to/output/NAME-44, /path/to/output/NAME-45, ...).
 
+Large numbers of records are written in a "sharded" layout instead, in which
+the outputs are put two levels of subdirectories further down, chosen from
+the record number so that no directory holds more than about a thousand
+records (e.g., /path/to/output/000/054/54602).  The option -f (/f on
+Windows) selects the layout: "flat", "sharded", or "auto" (the default),
+which uses the sharded layout if there are more than 10,000 records to
+write or more than the file system allows in one directory.  The layout is
+recorded in the output directory while a run is in progress, and kept after
+it if -d is used, so that resuming an interrupted run (-j) or an incremental
+run (-d) in the same directory uses the same layout.
+
 Each directory will contain an EP3XML XML file and additional document
 file(s) associated with the EPrints record in question.  Documents associated
 with each record will be fetched over the network.  The list of documents for
@@ -188,6 +290,11 @@ each record is determined from XML file, in the <documents> element.  Certain
 EPrints internal documents such as "indexcodes.txt" and preview images
 will be ignored.
 
+The XML file of each record contains exactly the bytes sent by the EPrints
+server.  If the option -X (/X on Windows) is given, the record is written
+in canonical XML form (C14N) instead, so that the files of records that have
+not changed are identical even if the server changes how it formats XML.
+
 Each record downloaded from EPrints will be placed in a BagIt style directory
 and each bag will also be put into a single-file archive by default.  The
 default archive file format is ZIP with compression turned off (see next
@@ -204,14 +311,35 @@ directory corresponding to the BagIt format.
 
 The type of archive made when "bag-and-archive" mode is used for the -b
 option can be changed using the option -t (or /t on Windows).  The possible
-values are: "compressed-zip", "uncompressed-zip", "compressed-tar", and
-"uncompressed-tar".  As mentioned above, the default is "uncompressed-zip"
+values are: "compressed-zip", "uncompressed-zip", "smart-zip",
+"compressed-tar", "uncompressed-tar", and "zstd-tar".  "smart-zip" is a ZIP
+archive in which files that are normally compressed already (PDF, JPEG, PNG,
+ZIP, MP4 and similar, judging by their file name extensions) are stored
+without compression and all other files are compressed.  "zstd-tar" is a tar
+archive compressed with Zstandard (file extension ".tar.zst"); it requires
+the optional Python package "zstandard".  As mentioned above, the default is
+"uncompressed-zip"
 (used if no -t option is given).  ZIP is the default because it is more
 widely recognized and supported than tar format, and uncompressed ZIP is used
 because file corruption is generally more damaging to a compressed archive
 than an uncompressed one.  Since the main use case for eprints2bags is to
 archive contents for long-term storage, avoiding compression seems safer.
 
+In bag-and-archive mode, the option -x (or /x on Windows) makes eprints2bags
+write each record and its documents straight into the record's archive file
+as they are downloaded, instead of first writing them to a directory, turning
+that into a bag, archiving it and deleting the directory.  The BagIt tag
+files (bagit.txt, bag-info.txt and the manifests) are computed from the
+downloaded data and added at the end of each archive.  This halves the amount
+of disk I/O and avoids the need for scratch space for the record directories.
+In this mode, documents are always downloaded in a single stream.
+
+Compressed archives are compressed using several threads at once; the number
+of threads is the number of processes used for bagging (see -c below).  The
+option -L (or /L on Windows) sets the compression level, from 1 (fastest) to
+9 (smallest files); the default is 6.  For "zstd-tar", the level can be from
+1 to 19, and the default is 3.
+
 Finally, the overall collection of EPrints records (whether the records are
 bagged and archived, or just bagged, or left as-is) can optionally be itself
 put into a bag and/or put in a ZIP archive.  This behavior can be changed with
@@ -260,13 +388,123 @@ add the -R (or /R on Windows) command-line argument to a command.  When
 eprints2bags is run with this option, it will query for the user name and
 password again even if an entry already exists in the keyring or keychain.
 
+Resuming an interrupted run
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+As it works, eprints2bags keeps a journal of the progress of each record in
+a file named ".eprints2bags-journal.db" in the output directory.  If a run is
+interrupted, running eprints2bags again with the same arguments plus the
+option -j (or /j on Windows) will skip the records that were finished (as
+well as records that were found to be missing or were skipped), and will
+continue the others from the last stage they completed: for example, a
+record that was bagged but not archived will only be archived.  Without -j,
+any existing journal is discarded and all records are processed again.  The
+journal is deleted once all the records have been processed, so it is only
+left in the output directory by a run that was interrupted or failed.
+
+Incremental harvesting
+~~~~~~~~~~~~~~~~~~~~~~
+
+With the option -d (or /d on Windows), eprints2bags keeps a manifest of
+every record it has written, in a file named ".eprints2bags-manifest.db" in
+the output directory.  The manifest holds each record's "lastmod" and
+"rev_number" values, the HTTP validators sent by the server (ETag and
+Last-Modified), and the checksums of the record's documents.  The first run
+with -d gets every record; running eprints2bags again with -d on the same
+output directory will only get records that have changed since they were
+last written.  Where possible, eprints2bags asks the server for the record
+conditionally, or for just the record's "lastmod" field, so that unchanged
+records are not transferred at all.  The new version of a changed record is
+written under a new name (e.g., 4-r3 for revision 3 of record 4), leaving
+the earlier version in place.
+
+Verification
+~~~~~~~~~~~~
+
+After creating each bag and archive file, eprints2bags checks it.  The
+option -v (or /v on Windows) selects how thoroughly: "none" skips the
+checks; "fast" checks that each bag contains the files listed in its
+manifests with the expected total size (the Payload-Oxum value), and that
+the directory of each archive file can be read and lists the expected files
+with the expected sizes, without reading the contents of any of them; "full"
+rereads every file in each bag to compare its checksums to the manifests,
+and reads every member of each archive file to compare its MD5 checksum to
+the one computed when the file was bagged; "sampled", the default, uses
+"full" for a random tenth of the records and "fast" for the others.  At the end of a run, eprints2bags reports which
+records got which level of verification.
+
+Archive files can also be checked later using the subcommand "verify", as in
+"eprints2bags verify -v full FILE...".  Use "eprints2bags verify -h" for
+more information.
+
 Other command-line arguments
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 Generating checksum values can be a time-consuming operation for large bags.
-By default, during the bagging step, eprints2bags will use a number of
-processes equal to one-half of the available CPUs on the computer.  The number
-of processes can be changed using the option -c (or /c on Windows).
+To avoid reading the documents again, eprints2bags computes their checksums
+while downloading them, and writes the manifests of each record's bag from
+those values.  The checksums that still have to be computed (for the record
+XML files, for fully verifying bags, and for the bag of the whole output
+directory made with -e) are computed by a single pool of processes that
+lasts for the whole run and is shared by all records.  Files are handed to
+the processes in groups of roughly equal total size.  By default, the pool
+has one process for every two available CPUs on the computer; the number of
+processes can be changed using the option -c (or /c on Windows).
+
+Records are processed in four stages -- fetching the record XML, downloading
+the documents, bagging, and archiving -- and the stages run concurrently, so
+that (for example) one record can be downloading while another is being
+bagged.  Each stage has its own pool of worker threads.  The option -w (or /w
+on Windows) sets the number of threads for each stage, as four integers
+separated by commas in the order fetch,download,bag,archive (e.g., -w
+1,4,2,2).  A single integer sets the same number for all stages.  The default
+is 1,2,1,1, except that the bag stage gets at least as many threads as there
+are checksumming processes (see -c), so that many records can be bagged at
+once.  Using more than one fetch thread increases the load on the EPrints
+server.
+
+For very large harvests, the option -m (or /m on Windows) makes eprints2bags
+perform all network operations using asynchronous I/O on a single thread,
+which allows many more requests to be in flight than there are network
+connections in the normal mode.  The value of -m is the maximum number of
+requests in flight at any time, optionally followed by a comma and the
+maximum number of requests in flight to any one host (default: 8).  For
+example, -m 200,16.  In this mode, the fetch and download stages can be
+given many more worker threads (e.g., -w 16,200,4,4).  This mode requires the optional Python
+package "aiohttp".
+
+Documents are read from the network in chunks of 1 MB by default, into a
+single buffer that is reused for the whole document, and the space for each
+document is reserved on disk in advance when the server reports its size.
+The option -z (or /z on Windows) changes the chunk size; its value is a number
+of bytes, optionally followed by a suffix K, M or G (e.g., -z 8M).
+
+Documents are written to files with names ending in ".part" until they have
+been downloaded completely.  If a download is interrupted (for example, by a
+network timeout), eprints2bags keeps the partial file and, when it tries
+again, asks the server for only the rest of the document.  The server is
+asked to send the whole document instead if the document changed in the
+meantime (based on the ETag or Last-Modified values sent by the server).
+
+Documents larger than 64 MB are downloaded in 4 parts at once, each over its
+own network connection, when the server supports requests for byte ranges;
+otherwise they are downloaded in a single stream.  The option -g (or /g on
+Windows) changes the size above which this is done and, optionally after a
+comma, the number of parts (e.g., -g 500M,8).  A size of 0 turns off
+downloading in parts.
+
+eprints2bags keeps track of how many times it does each of the main
+operations for a record (getting the fields needed by -l and -s, getting the
+XML, parsing it, downloading documents,
+making the bag, validating it, creating the archive file, verifying it, and
+deleting the record directory), how many of those failed, how many bytes
+they involved and how long they took, along with the time spent in each
+stage and in retrying network requests.  The option -M (or /M on Windows)
+writes all that to the given file in JSON format at the end of the run.
+The option -P (or /P on Windows) writes it to the given file in the text
+format of Prometheus (https://prometheus.io), and rewrites the file every
+15 seconds during the run, so that it can be collected by the "textfile"
+collector of the Prometheus node exporter.
 
 eprints2bags will print messages as it works.  To reduce the number of
 messages to warnings and errors, use the option -q (or /q on Windows).  Also,
@@ -278,7 +516,15 @@ If given the -@ argument (/@ on Windows), this program will output a detailed
 trace of what it is doing, and will also drop into a debugger upon the
 occurrence of any errors.  The debug trace will be written to the given
 destination, which can be a dash character (-) to indicate console output, or
-a file path.
+a file path.  If the file name ends in ".jsonl", the trace is written as JSON
+lines, one object per message, giving the time, thread, source file,
+function and line, the message, and a span id that is the same for all the
+messages about one record.
+
+The option -T (or /T on Windows) keeps the same kind of trace, but only of
+the most recent activity and only in memory, and writes it in JSON lines
+format to the given file if the run stops because of an error.  This costs
+little enough to be used routinely.  It has no effect together with -@.
 
 If given the -V option (/V on Windows), this program will print the version
 and other information, and exit without doing anything else.
@@ -289,24 +535,33 @@ Additional notes
 Beware that some file systems have limitations on the number of
 subdirectories that can be created, which directly impacts how many record
 subdirectories can be created by this program.  eprints2bags attempts to
-guess the type of file system where the output is being written and warn the
-user if the number of records exceeds known maximums (e.g., 31,998
-subdirectories for the ext2 and ext3 file systems in Linux), but its internal
-table does not include all possible file systems and it may not be able to
-warn users in all cases.  If you encounter file system limitations on the
-number of subdirectories that can be created, a simple solution is to
-manually create an intermediate level of subdirectories under the destination
-given to -o, then run eprints2bags multiple times, each time indicating a
-different subrange of records to the -i option and a different subdirectory
-to -o, such that the number of records written to each destination is below
-the file system's limit on total number of directories.
+guess the type of file system where the output is being written, and in the
+"auto" layout (see -f above), switches to the sharded layout if the number of
+records exceeds known maximums (e.g., 31,998 subdirectories for the ext2 and
+ext3 file systems in Linux).  Its internal table does not include all
+possible file systems, but the sharded layout is also used for any run of
+more than 10,000 records.  With -f flat, eprints2bags stops if the number of
+records exceeds the known maximum.
 
 It is also noteworthy that hitting a server for tens of thousands of records
 and documents in rapid succession is likely to draw suspicion from server
-administrators.  By default, this program inserts a small delay between
-record fetches (adjustable using the -y command-line option), which may be
-too short in some cases.  Setting the value to 0 is also possible, but might
-get you blocked or banned from an institution's servers.
+administrators.  By default, this program makes at most 10 network requests
+per second, counting every request for a record or a document.  (Earlier
+versions instead paused 100 ms after each record, and did not count the
+requests for its documents.)  The option -r (or /r on Windows) changes the
+maximum; its value is a number of requests per second, optionally followed
+by a comma and a maximum number of bytes per second for document downloads,
+with an optional suffix K, M or G (e.g., -r 20,50M).  The rate adapts to the
+server: when the server responds that it is overloaded (HTTP codes 429 and
+503), eprints2bags halves the request rate (once for all the requests refused
+at about the same time), waits before trying a refused request again, for
+the Retry-After time given by the server if there is one, then gradually
+increases the rate again up to the maximum.  The older option -y (or /y on
+Windows) is still accepted instead of -r; it gives a minimum delay in
+milliseconds between requests, so that -y 100 is equivalent to -r 10.
+Options -r and -y cannot be used together.  Setting the value of -r to 0
+removes the limit, but might get you blocked or banned from an institution's
+servers.
 
 Command-line options summary
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -325,6 +580,8 @@ Command-line options summary
         set_debug(True, debug)
         import faulthandler
         faulthandler.enable()
+    elif trace != 'TRACE':
+        set_tracing(path.abspath(trace))
     if version:
         print_version()
         exit()
@@ -370,101 +627,422 @@ Command-line options summary
         exit(say.fatal_text('Value of {}b option not recognized. {}', prefix, hint))
     if end_action != "none" and not given_output_dir:
         exit(say.fatal_text('Please specify an output directory when using -e "{}"', end_action))
+    if end_action != "none" and incremental:
+        exit(say.fatal_text('Option {}d cannot be used with -e "{}"', prefix, end_action))
+
+    layout = 'auto' if layout == 'F' else layout.lower()
+    if layout not in LAYOUTS + ['auto']:
+        exit(say.fatal_text('Value of {}f option not recognized. {}', prefix, hint))
 
     archive_fmt = 'uncompressed-zip' if arch_type == 'T' else arch_type.lower()
     if archive_fmt not in _RECOGNIZED_ARCHIVE_TYPES:
         exit(say.fatal_text('Value of {}t option not recognized. {}', prefix, hint))
 
+    if archive_fmt == 'zstd-tar' and not zstd_available():
+        exit(say.fatal_text('Archive type "zstd-tar" requires the Python package'
+                            ' "zstandard"'))
+
+    if stream and bag_action != 'bag-and-archive':
+        exit(say.fatal_text('Option {}x can only be used with {}b bag-and-archive',
+                            prefix, prefix))
+
+    verify = _DEFAULT_VERIFY if verify == 'V' else verify.lower()
+    if verify not in _VERIFY_LEVELS:
+        exit(say.fatal_text('Value of {}v option not recognized. {}', prefix, hint))
+
     status = None if status == 'S' else status.split(',')
     status_negation = (status and status[0].startswith('^'))
     if status_negation:                 # Remove the '^' if it's there.
         status[0] = status[0][1:]
 
-    delay = int(delay)
+    if rate != 'R' and delay != 'Y':
+        exit(say.fatal_text('Options {}r and {}y cannot be used together',
+                            prefix, prefix))
+    limits = parsed_rate(rate, delay, say)
+    num_workers = parsed_workers(_DEFAULT_WORKERS if workers == 'W' else workers, say)
+    async_limits = None if in_flight == 'M' else parsed_in_flight(in_flight, say)
+    chunk_size = parsed_chunk_size(_DEFAULT_CHUNK_SIZE if chunk_size == 'Z' else chunk_size, say)
+    segments = parsed_segments(_DEFAULT_SEGMENTS if segments == 'G' else segments, say)
     procs = int(max(1, available_cpus()/2 if processes == 'C' else int(processes)))
+    if workers == 'W':
+        # Bag workers mostly wait for the shared pool of hashing processes,
+        # so there should be enough of them to keep every process busy.
+        num_workers[2] = max(num_workers[2], procs)
+    level = None if level == 'L' else parsed_level(level, archive_fmt, say)
+    compression = (level, procs)
     user = None if user == 'U' else user
     password = None if password == 'P' else password
     prefix = '' if name_base == 'N' else name_base + '-'
+    metrics_file = None if metrics_file == 'JSON' else path.abspath(metrics_file)
+    prom_file = None if prom_file == 'PROM' else path.abspath(prom_file)
 
     # Do the real work --------------------------------------------------------
 
+    async_network = None
+    hash_pool = None
+    pipeline = None
+    prom_writer = None
+    completed = False
+
+    def stage_stats():
+        return pipeline.stats() if pipeline else {}
+
     try:
         if not user or not password:
             user, password = credentials(api_url, user, password, use_keyring, reset_keys)
+        # Every thread that talks to the server may hold one connection.
+        # Filter threads, if any, are as many as the fetch threads.
+        prefiltering = bool(status or lastmod)
+        num_fields = (1 if status else 0) + (1 if lastmod else 0)
+        num_network = sum(num_workers[:2]) + num_fields * num_workers[0]
+        configure_session(pool_size = max(_MIN_POOL_SIZE, num_network))
+        set_rate_limits(*limits)
+        set_chunk_size(chunk_size)
+        set_segments(*segments)
+        if bag_action != 'none' or end_action != 'none':
+            hash_pool = HashPool(procs)
+        if async_limits:
+            if __debug__: log('Using async network layer with limits {}', async_limits)
+            async_network = use_async_network(*async_limits)
+        if prom_file:
+            prom_writer = PrometheusWriter(prom_file, stage_stats)
         if __debug__: log('Testing given server URL')
         raw_list = eprints_raw_list(api_url, user, password)
         if raw_list == None:
             text = 'Did not get an EPrints server response from "{}"'.format(api_url)
             exit(say.fatal_text(text))
-        if not wanted:
-            say.info('Fetching records list from {}', api_url)
-            wanted = eprints_records_list(raw_list)
         fs = fs_type(output_dir)
         if __debug__: log('Destination file system is {}', fs)
-        if fs in KNOWN_SUBDIR_LIMITS and len(wanted) > KNOWN_SUBDIR_LIMITS[fs]:
-            text = '{} is too many folders for the file system at "{}".'
-            exit(say.fatal_text(text.format(intcomma(num_wanted), output_dir)))
+        subdir_limit = KNOWN_SUBDIR_LIMITS.get(fs, sys.maxsize)
+        num_wanted = len(wanted)
+        if wanted:
+            raw_list.close()
+        else:
+            # The list is parsed as it arrives, and records are processed
+            # while the rest of it is still being read.
+            say.info('Fetching records list from {}', api_url)
+            wanted = eprints_records_list(raw_list)
 
-        say.info('Beginning to process {} EPrints {}', intcomma(len(wanted)),
-                 'entries' if len(wanted) > 1 else 'entry')
+        # An output directory keeps the layout it was first written with.
+        # Directories written before layouts existed are flat.
+        previous = saved_layout(output_dir)
+        if not previous and (path.exists(path.join(output_dir, JOURNAL_FILE))
+                             or path.exists(path.join(output_dir, MANIFEST_FILE))):
+            previous = 'flat'
+        if previous and layout not in ['auto', previous]:
+            text = 'Output directory "{}" already uses the {} layout'
+            exit(say.fatal_text(text.format(output_dir, previous)))
+        layout = previous or layout
+        if layout == 'auto':
+            # Only look ahead in the list as far as needed to decide.
+            flat_limit = min(MAX_FLAT_RECORDS, subdir_limit)
+            if not num_wanted:
+                ahead = list(islice(wanted, flat_limit + 1))
+                wanted = chain(ahead, wanted)
+            layout = 'sharded' if (num_wanted or len(ahead)) > flat_limit else 'flat'
+        sharded = (layout == 'sharded')
+        if sharded:
+            subdir_limit = sys.maxsize
+        too_many = '{} is too many folders for the file system at "' + output_dir + '".'
+        if num_wanted > subdir_limit:
+            exit(say.fatal_text(too_many.format(intcomma(num_wanted))))
+        if num_wanted:
+            say.info('Beginning to process {} EPrints {}', intcomma(num_wanted),
+                     'entries' if num_wanted > 1 else 'entry')
+        else:
+            say.info('Beginning to process EPrints entries as they are listed')
         if lastmod:
             say.info('Will only keep records modified after {}', lastmod_str)
         if status:
             say.info('Will only keep records {} status {}',
                      'without' if status_negation else 'with',
                      fmt_statuses(status, status_negation))
-        say.info('Output will be written under directory "{}"', output_dir)
+        say.info('Output will be written under directory "{}" ({} layout)',
+                 output_dir, layout)
         make_dir(output_dir)
+        save_layout(output_dir, layout)
+
+        journal_file = path.join(output_dir, JOURNAL_FILE)
+        if resume and not path.exists(journal_file):
+            say.warn('No journal found in {} -- starting from the beginning', output_dir)
+        journal = Journal(journal_file, resume)
+        final_stage = _FINAL_STAGE[bag_action]
+        # The manifest of what's been written is only kept if asked for.
+        manifest = None
+        if incremental:
+            manifest = Manifest(path.join(output_dir, MANIFEST_FILE))
 
         say.msg('='*70, 'dark')
         missing = []
         skipped = []
-        for number in wanted:
+        unchanged = []
+        finished = []
+        verified = defaultdict(list)
+
+        # The numbers of the records in the order they were listed.
+        listed = []
+
+        def records():
+            # Generate the Record objects fed to the pipeline.  When resuming,
+            # records that were finished in a previous run are left out, and
+            # others start at the first stage they didn't complete.
+            previous = journal.stages() if resume else {}
+            for number in wanted:
+                listed.append(number)
+                if len(listed) > subdir_limit:
+                    exit(say.fatal_text(too_many.format(intcomma(len(listed)))))
+                stage = previous.get(number)
+                if stage == MISSING:
+                    missing.append(number)
+                elif stage == SKIPPED:
+                    skipped.append(number)
+                elif stage == UNCHANGED:
+                    unchanged.append(number)
+                elif stage_done(stage, final_stage):
+                    finished.append(number)
+                elif resume:
+                    name = journal.name(number) or prefix + str(number)
+                    record_dir = record_path(output_dir, number, name, sharded)
+                    yield resumed_record(number, stage, record_dir, prefix, say)
+                else:
+                    yield Record(number)
+
+        # Used by prefilter() to ask for the lastmod field while it asks for
+        # the status field, when both are needed.
+        field_pool = None
+        if status and lastmod:
+            field_pool = ThreadPoolExecutor(max_workers = num_workers[0])
+        gate = FilterGate()
+
+        def prefilter(record):
+            if record.stage or not gate.worthwhile():
+                return record
+            # Ask the server for only the fields needed by the status and
+            # lastmod filters, so that the full record is fetched only if it
+            # is going to be kept.  If the server can't answer, fetch() will
+            # apply the filters to the full record instead.  The EPrints API
+            # has no way to ask for a field of many records in one request.
+            number = record.number
+            reason = None
+            with timed('filter') as timing:
+                pending = None
+                if field_pool:
+                    pending = field_pool.submit(eprints_remote_field, number,
+                                                'lastmod', api_url, user, password)
+                if status:
+                    value = eprints_remote_field(number, 'eprint_status', api_url, user, password)
+                    if value != None and (value in status) == status_negation:
+                        reason = ('has status "{}"', value)
+                if lastmod and not reason:
+                    if pending:
+                        value = pending.result()
+                    else:
+                        value = eprints_remote_field(number, 'lastmod', api_url, user, password)
+                    modified = parse_datetime(value) if value else None
+                    if modified and modified < lastmod:
+                        reason = ("hasn't been modified since {}", lastmod_str)
+                elif pending:
+                    pending.cancel()
+            gate.filtered(timing.seconds, reason != None)
+            if reason:
+                return record_skipped(number, *reason)
+            record.filtered = True
+            return record
+
+        def fetch(record):
+            if record.stage:
+                return record
             # Start by getting the full record in EP3 XML format.  A failure
             # here will either cause an exit or moving to the next record.
+            # In incremental mode, we first try to find out cheaply whether
+            # the record has changed since the last time we wrote it.
+            number = record.number
             say.msg('Getting record with id {}'.format(number), 'white')
-            xml = eprints_xml(number, api_url, user, password, keep_going, say)
-            if xml == None:
+            entry = manifest.entry(number) if incremental else None
+            if entry and not (entry.etag or entry.last_modified) and entry.lastmod:
+                current = eprints_remote_field(number, 'lastmod', api_url, user, password)
+                if current == entry.lastmod:
+                    return record_unchanged(number)
+            headers = conditional_headers(entry) if entry else None
+            with timed('fetch') as timing:
+                response = eprints_xml_response(number, api_url, user, password,
+                                                keep_going, say, headers)
+                if response != None:
+                    timing.bytes = len(response.content)
+            gate.fetched(timing.seconds)
+            if response == None:
                 missing.append(number)
-                continue
-            if lastmod and eprints_lastmod(xml) < lastmod:
-                say.info("{} hasn't been modified since {} -- skipping",
-                         number, lastmod_str)
-                skipped.append(number)
-                continue
-            if status and ((not status_negation and eprints_status(xml) not in status)
-                           or (status_negation and eprints_status(xml) in status)):
-                say.info('{} has status "{}" -- skipping', number, eprints_status(xml))
-                skipped.append(number)
-                continue
-
-            # Good so far.  Create the directory and write the XML out.
-            record_dir = path.join(output_dir, prefix + str(number))
-            say.info('Creating {}', record_dir)
-            make_dir(record_dir)
-            write_record(number, xml, prefix, record_dir)
-
+                journal.record(number, MISSING)
+                return None
+            if response.status_code == 304:
+                return record_unchanged(number)
+            with timed('parse') as timing:
+                timing.bytes = len(response.content)
+                xml = etree.fromstring(response.content)
+                summary = eprints_summary(xml)
+            if entry and (summary.lastmod, summary.rev_number) \
+               == (entry.lastmod, entry.rev_number):
+                # The server doesn't support conditional requests or
+                # per-field queries, but we can still avoid writing it again.
+                return record_unchanged(number)
+            reason = None
+            if lastmod and parse_datetime(summary.lastmod) < lastmod:
+                reason = ("hasn't been modified since {}", lastmod_str)
+            elif status and (summary.status in status) == status_negation:
+                reason = ('has status "{}"', summary.status)
+            if prefiltering and not record.filtered:
+                gate.judged(reason != None)
+            if reason:
+                return record_skipped(number, *reason)
+
+            # Good so far.  Create the directory and write the XML out.  If an
+            # earlier version of the record was written, keep it and give the
+            # new version a different name.
+            record.content = canonical_record(xml) if canonical else response.content
+            record.summary = summary
+            record.etag = response.headers.get('ETag')
+            record.last_modified = response.headers.get('Last-Modified')
+            if entry:
+                record.name = versioned_name(number, summary.rev_number, prefix,
+                                             output_dir, manifest)
+            else:
+                record.name = prefix + str(number)
+            record.dir = record_path(output_dir, number, record.name, sharded)
+            if stream and sharded:
+                make_dir(path.dirname(record.dir))
+            if not stream:
+                say.info('Creating {}', record.dir)
+                make_dir(record.dir)
+                write_record(number, record.content, prefix, record.dir)
+            journal.record(number, 'fetched', record.name)
+            return record
+
+        def record_skipped(number, reason, *args):
+            say.info('{} ' + reason + ' -- skipping', number, *args)
+            skipped.append(number)
+            journal.record(number, SKIPPED)
+            return None
+
+        def record_unchanged(number):
+            say.info('{} is unchanged since it was last written -- skipping', number)
+            unchanged.append(number)
+            journal.record(number, UNCHANGED)
+            return None
+
+        def download(record):
+            if stage_done(record.stage, 'downloaded'):
+                return record
             # Download any documents referenced in the XML record.
-            docs = eprints_documents(xml)
-            download_files(docs, user, password, record_dir, keep_going, say)
-
+            docs = list(record.summary.documents)
+            if stream:
+                with timed('download') as timing:
+                    record.bag = stream_record(record, docs, prefix, archive_fmt,
+                                               user, password, keep_going, say,
+                                               compression)
+                    timing.bytes = sum(record.bag.members.values()) - len(record.content)
+                return record
+            with timed('download') as timing:
+                record.digests = download_files(docs, user, password, record.dir,
+                                                keep_going, say, _BAG_CHECKSUMS)
+                timing.bytes = sum(path.getsize(path.join(record.dir, name))
+                                   for name in record.digests)
+            journal.record(record.number, 'downloaded', record.name)
+            return record
+
+        def bag(record):
+            if stage_done(record.stage, 'bagged'):
+                return record
             # Bag it and archive it, depending on user choice.
-            bag_and_archive(record_dir, bag_action, archive_fmt, procs, xml, api_url, say)
-
-            # Be nice to the server.
-            sleep(delay/1000)
+            if stream:
+                record.bag.finish(record_bag_info(record.summary))
+            elif bag_action != 'none':
+                record.verify = record.verify or verify_level(verify)
+                record.bag = make_bag(record.dir, hash_pool, record.summary, api_url, say,
+                                      record.digests, record.verify)
+                journal.record(record.number, 'bagged', record.name)
+            return record
+
+        def archive(record):
+            if stream:
+                record.verify = record.verify or verify_level(verify)
+                close_streamed_archive(record.bag, archive_fmt, say, record.verify, procs)
+                journal.record(record.number, 'archived', record.name)
+            elif bag_action == 'bag-and-archive':
+                record.verify = record.verify or verify_level(verify)
+                make_archive(record.dir, archive_fmt, record.bag, record.summary,
+                             api_url, say, record.verify, compression)
+                journal.record(record.number, 'archived', record.name)
+            # This is the last stage, so the record is finished.
+            if bag_action != 'none':
+                verified[record.verify].append(record.number)
+            if manifest:
+                manifest.update(manifest_entry(record))
+            return record
+
+        def traced(function):
+            # Tag what's logged while working on a record with its span id.
+            def traced_function(record):
+                with span(record.span):
+                    return function(record)
+            return traced_function
+
+        stages = [Stage('fetch',    traced(fetch),    num_workers[0]),
+                  Stage('download', traced(download), num_workers[1]),
+                  Stage('bag',      traced(bag),      num_workers[2]),
+                  Stage('archive',  traced(archive),  num_workers[3])]
+        if prefiltering:
+            stages.insert(0, Stage('filter', traced(prefilter), num_workers[0]))
+        pipeline = Pipeline(stages)
+        try:
+            pipeline.run(records())
+        finally:
+            if field_pool:
+                field_pool.shutdown()
+        # Every record has been dealt with, so the journal is no longer
+        # needed.  The layout only needs to be remembered for later -d runs.
+        journal.close()
+        remove_journal(journal_file)
+        if manifest:
+            manifest.close()
+        else:
+            remove_layout(output_dir)
 
+        # Report in the order of the original list, not the order of completion.
+        missing_set, skipped_set = set(missing), set(skipped)
+        missing = [number for number in listed if number in missing_set]
+        skipped = [number for number in listed if number in skipped_set]
         say.msg('='*70, 'dark')
-        count = len(wanted) - len(missing) - len(skipped)
+        count = (len(listed) - len(missing) - len(skipped) - len(unchanged)
+                 - len(finished))
         say.info('Wrote {} EPrints record{} to {}/.', intcomma(count),
                  's' if count > 1 else '', output_dir)
         if len(skipped) > 0:
             say.info('The following records were skipped: '+ ', '.join(skipped) + '.')
         if len(missing) > 0:
             say.warn('The following records were not found: '+ ', '.join(missing) + '.')
+        if len(unchanged) > 0:
+            say.info('{} of the records were unchanged since they were last written.',
+                     intcomma(len(unchanged)))
+        if len(finished) > 0:
+            say.info('{} of the records were finished in a previous run.',
+                     intcomma(len(finished)))
+        for level in ['full', 'fast', 'none']:
+            if verified[level]:
+                numbers = set(verified[level])
+                say.info('Verification "{}" was used for: {}.', level,
+                         ', '.join(n for n in listed if n in numbers))
+        for name, totals in retry_stats().items():
+            if totals.count:
+                say.info('Time lost to {}: {:.1f} s ({} time{}).', RETRY_PATHS[name],
+                         totals.seconds, intcomma(totals.count),
+                         's' if totals.count > 1 else '')
 
         # Bag the whole result and archive it, depending on user choice.
-        bag_and_archive(output_dir, end_action, archive_fmt, procs, None, api_url, say)
+        # Sampling makes no sense for a single bag, so use the cheaper level.
+        final_verify = 'fast' if verify == 'sampled' else verify
+        bag_and_archive(output_dir, end_action, archive_fmt, hash_pool, None,
+                        api_url, say, final_verify, compression)
+        completed = True
 
     except KeyboardInterrupt as ex:
         exit(say.msg('Quitting.', 'error'))
@@ -479,6 +1057,20 @@ Command-line options summary
             import pdb; pdb.set_trace()
         else:
             exit(say.error_text('Fatal error: {}', str(ex)))
+    finally:
+        if async_network:
+            async_network.close()
+        if hash_pool:
+            hash_pool.close()
+        if not completed:
+            flush_trace()
+        try:
+            if prom_writer:
+                prom_writer.stop()
+            if metrics_file:
+                write_summary(metrics_file, stage_stats())
+        except OSError as ex:
+            say.warn('Unable to write metrics: {}', str(ex))
 
 # If this is windows, we want the command-line args to use slash intead
 # of hyphen.
@@ -486,7 +1078,165 @@ Command-line options summary
 if ON_WINDOWS:
     main.prefix_chars = '/'
 
+
+# Subcommand "verify".
+# ......................................................................
+
+@plac.annotations(
+    level      = ('verify using method "V": fast or full (default: full)',  'option', 'v'),
+    processes  = ('num. threads to use for ZIP files (default: #cores/2)',  'option', 'c'),
+    quiet      = ('do not print informational messages while working',      'flag',   'q'),
+    no_color   = ('do not color-code terminal output',                      'flag',   'C'),
+    debug      = ('write detailed trace to "OUT" ("-" means console)',      'option', '@'),
+    archives   = 'archive files written by eprints2bags',
+)
+
+def verify_main(level = 'V', processes = 'C', quiet = False, no_color = False,
+                debug = 'OUT', *archives):
+    '''Check archive files written by eprints2bags, without extracting them.
+
+Usage: eprints2bags verify [options] FILE...
+
+Each FILE must be a ZIP or tar archive (with extension .zip, .tar, .tar.gz or
+.tar.zst) containing one or more BagIt bags, as written by eprints2bags in
+"bag-and-archive" mode.  For each bag in each file, the files in the bag's
+data directory are compared to the files listed in the bag's manifest and to
+the Payload-Oxum value in its bag-info.txt file.  With "-v full" (the
+default), every file is also read and its checksum compared to the manifest,
+and for ZIP files, the CRC-32 values stored in the archive are checked as
+well.  "-v fast" only compares the lists of files and their sizes.  The
+members of ZIP files are read using several threads at once; the number can
+be changed using the option -c (or /c on Windows).
+
+The exit status is 0 if all the files are valid and 1 otherwise.
+'''
+    say = MessageHandler(not no_color, quiet)
+    prefix = '/' if ON_WINDOWS else '-'
+    hint = '(Hint: use {}h for help.)'.format(prefix)
+    if debug != 'OUT':
+        set_debug(True, debug)
+    level = 'full' if level == 'V' else level.lower()
+    if level not in ['fast', 'full']:
+        exit(say.fatal_text('Value of {}v option not recognized. {}', prefix, hint))
+    if not archives:
+        exit(say.fatal_text('No archive files given. {}', hint))
+    threads = int(max(1, available_cpus()/2 if processes == 'C' else int(processes)))
+
+    failed = []
+    for archive_file in archives:
+        type = archive_type(archive_file)
+        if not readable(archive_file):
+            problems = ['Unable to read file "{}"'.format(archive_file)]
+        elif not type:
+            problems = ['Unrecognized type of archive file "{}"'.format(archive_file)]
+        else:
+            say.info('Verifying {} ({})', archive_file, level)
+            problems = bags.audit_archive(archive_file, type, level == 'full', threads)
+        for problem in problems:
+            say.error('{}', problem)
+        if problems:
+            failed.append(archive_file)
+    if failed:
+        exit(say.error_text('{} of {} archive files failed verification.',
+                            intcomma(len(failed)), intcomma(len(archives))))
+    say.info('All {} archive files are valid.', intcomma(len(archives)))
+
+if ON_WINDOWS:
+    verify_main.prefix_chars = '/'
+
+
+def run():
+    '''Runs the subcommand named by the first command-line argument, if
+    there is one, or else the main program.'''
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        plac.call(verify_main, sys.argv[2:])
+    else:
+        plac.call(main)
+
 
+# Helper classes.
+# ......................................................................
+
+class Record():
+    '''State of one EPrints record as it moves through the processing stages.'''
+
+    def __init__(self, number):
+        self.number = number            # Record number, as a string.
+        self.content = None             # EP3 XML of the record, as bytes.
+        self.summary = None             # RecordSummary of the XML.
+        self.dir    = None              # Directory where output is written.
+        self.bag    = None              # bagit.Bag object, once bagged.
+        self.stage  = None              # Last stage completed (see journal.py).
+        self.name   = None              # Name of the output dir, sans path.
+        self.etag   = None              # Value of the ETag header from server.
+        self.last_modified = None       # Value of the Last-Modified header.
+        self.digests = {}               # Checksums of downloaded files.
+        self.verify = None              # Verification level: full, fast, none.
+        self.filtered = False           # True if prefilter() let it through.
+        self.span   = new_span(number)  # Span id of debug messages, if any.
+
+
+class FilterGate():
+    '''Decides whether getting the fields needed by the -l and -s filters
+    before getting a record is worth it.  Doing so saves getting the records
+    that the filters leave out, but adds requests for the records that are
+    kept.  Once the filters have been applied to enough records, the fields
+    are only asked for while the time that takes is less than the fraction
+    of records left out times the average time taken to get a record.'''
+
+    def __init__(self):
+        self._lock           = threading.Lock()
+        self._judged         = 0        # Records the filters were applied to.
+        self._rejected       = 0        # Records the filters left out.
+        self._filter_count   = 0
+        self._filter_seconds = 0.0
+        self._fetch_count    = 0
+        self._fetch_seconds  = 0.0
+        self._enabled        = True
+
+
+    def worthwhile(self):
+        '''Returns True if the fields should be asked for first.'''
+        with self._lock:
+            if (self._judged < _FILTER_SAMPLE or not self._filter_count
+                or not self._fetch_count):
+                return True
+            saved = (self._rejected / self._judged) \
+                * (self._fetch_seconds / self._fetch_count)
+            enabled = saved > self._filter_seconds / self._filter_count
+            if enabled != self._enabled:
+                if __debug__: log('{} asking for fields first: {:.0%} left out'
+                                  ' saves {:.3f} s per record',
+                                  'resuming' if enabled else 'stopping',
+                                  self._rejected / self._judged, saved)
+                self._enabled = enabled
+            return enabled
+
+
+    def filtered(self, seconds, rejected):
+        '''Note that getting the fields for a record took 'seconds', and
+        whether the record was left out as a result.'''
+        with self._lock:
+            self._filter_count += 1
+            self._filter_seconds += seconds
+        self.judged(rejected)
+
+
+    def fetched(self, seconds):
+        '''Note that getting a full record took 'seconds'.'''
+        with self._lock:
+            self._fetch_count += 1
+            self._fetch_seconds += seconds
+
+
+    def judged(self, rejected):
+        '''Note that the filters were applied to a record, and whether the
+        record was left out.'''
+        with self._lock:
+            self._judged += 1
+            self._rejected += 1 if rejected else 0
+
+
 # Helper functions.
 # ......................................................................
 
@@ -514,6 +1264,169 @@ def parsed_id_list(id_list, say):
     return flatten(expand_range(x) for x in id_list.split(','))
 
 
+def resumed_record(number, stage, record_dir, prefix, say):
+    '''Returns a Record object for record 'number', set up to continue after
+    'stage' (which may be None) using what's already in 'record_dir'.'''
+    record = Record(number)
+    if stage and path.isdir(record_dir):
+        bagged = path.exists(path.join(record_dir, 'bagit.txt'))
+        if stage == 'bagged' and bagged:
+            record.bag = bagit.Bag(record_dir)
+            xml_dir = path.join(record_dir, 'data')
+        elif stage != 'bagged' and not bagged and not path.exists(path.join(record_dir, 'data')):
+            xml_dir = record_dir
+        else:
+            xml_dir = None
+        xml_file = path.join(xml_dir or record_dir, prefix + str(number) + '.xml')
+        if xml_dir and path.exists(xml_file):
+            say.info('Resuming {} after stage "{}"', number, stage)
+            record.stage = stage
+            record.dir = record_dir
+            record.name = path.basename(record_dir)
+            with open(xml_file, 'rb') as file:
+                record.content = file.read()
+            record.summary = eprints_summary(etree.fromstring(record.content))
+            return record
+    if path.exists(record_dir):
+        # Whatever was left by the earlier run is incomplete or inconsistent
+        # with the journal.  Start this record over.
+        if __debug__: log('Removing partial directory {}', record_dir)
+        shutil.rmtree(record_dir)
+    return record
+
+
+def conditional_headers(entry):
+    '''Returns a dict of HTTP headers for a conditional request for the
+    record described by the ManifestEntry 'entry'.'''
+    headers = {}
+    if entry.etag:
+        headers['If-None-Match'] = entry.etag
+    if entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
+
+def versioned_name(number, rev_number, prefix, output_dir, manifest):
+    '''Returns a name for the output of a new version of record 'number' that
+    doesn't clash with earlier versions.'''
+    base = '{}{}-r{}'.format(prefix, number, rev_number or 0)
+    name = base
+    count = 1
+    while manifest.has_name(name) or find_record(output_dir, number, name):
+        count += 1
+        name = '{}-{}'.format(base, count)
+    return name
+
+
+def manifest_entry(record):
+    '''Returns a ManifestEntry describing the finished 'record'.'''
+    documents = {}
+    if record.bag:
+        for file, checksums in record.bag.entries.items():
+            if file.startswith('data/') and 'sha256' in checksums:
+                documents[path.basename(file)] = checksums['sha256']
+    return ManifestEntry(record.number, record.name,
+                         record.summary.lastmod, record.summary.rev_number,
+                         record.etag, record.last_modified, documents)
+
+
+def parsed_workers(workers, say):
+    # A single number applies to every stage; otherwise there must be one
+    # number for each stage, in the order fetch,download,bag,archive.
+    try:
+        counts = [int(x) for x in workers.split(',')]
+    except ValueError:
+        exit(say.fatal_text('Unable to understand worker counts "{}"', workers))
+    if len(counts) == 1:
+        counts = counts * _NUM_STAGES
+    if len(counts) != _NUM_STAGES or any(n < 1 for n in counts):
+        exit(say.fatal_text('Worker counts must be {} positive integers', _NUM_STAGES))
+    return counts
+
+
+def parsed_rate(rate, delay, say):
+    # The rate is either "R" or "R,B", where R is the number of requests per
+    # second and B is bytes per second, optionally with a suffix K, M or G.
+    # The older option -y gives a delay in ms, which we turn into a rate.
+    if delay != 'Y':
+        try:
+            delay = int(delay)
+        except ValueError:
+            exit(say.fatal_text('Unable to understand delay value "{}"', delay))
+        return (1000/delay if delay > 0 else None, None)
+    if rate == 'R':
+        rate = _DEFAULT_RATE
+    parts = rate.upper().split(',')
+    try:
+        requests_per_sec = float(parts[0])
+        bytes_per_sec = None
+        if len(parts) > 1:
+            bytes_per_sec = byte_count(parts[1])
+    except (ValueError, IndexError):
+        exit(say.fatal_text('Unable to understand rate value "{}"', rate))
+    if len(parts) > 2 or requests_per_sec < 0 or (bytes_per_sec or 0) < 0:
+        exit(say.fatal_text('Unable to understand rate value "{}"', rate))
+    return (requests_per_sec or None, bytes_per_sec or None)
+
+
+def parsed_chunk_size(chunk_size, say):
+    try:
+        size = int(byte_count(chunk_size))
+    except (ValueError, IndexError):
+        exit(say.fatal_text('Unable to understand chunk size "{}"', chunk_size))
+    if size < 1:
+        exit(say.fatal_text('Chunk size must be a positive number of bytes'))
+    return size
+
+
+def parsed_segments(segments, say):
+    # The value is either "G" or "G,N", where G is the size above which to
+    # download documents in parts and N is the number of parts.  A size of
+    # 0 turns off segmented downloads.
+    parts = segments.split(',')
+    try:
+        threshold = int(byte_count(parts[0]))
+        count = int(parts[1]) if len(parts) > 1 else 4
+    except (ValueError, IndexError):
+        exit(say.fatal_text('Unable to understand segments value "{}"', segments))
+    if len(parts) > 2 or threshold < 0 or count < 1:
+        exit(say.fatal_text('Unable to understand segments value "{}"', segments))
+    return (threshold or None, count)
+
+
+def parsed_level(level, archive_fmt, say):
+    try:
+        level = int(level)
+    except ValueError:
+        exit(say.fatal_text('Unable to understand compression level "{}"', level))
+    highest = ZSTD_MAX_LEVEL if archive_fmt == 'zstd-tar' else 9
+    if level < 1 or level > highest:
+        exit(say.fatal_text('Compression level must be between 1 and {}', highest))
+    return level
+
+
+def byte_count(text):
+    # A number, optionally followed by one of the suffixes K, M or G.
+    text = text.upper()
+    multiplier = _BYTE_SUFFIXES.get(text[-1], 1)
+    digits = text[:-1] if text[-1] in _BYTE_SUFFIXES else text
+    return float(digits) * multiplier
+
+
+def parsed_in_flight(in_flight, say):
+    # The value is either "M" or "M,H", where M is the maximum number of
+    # requests in flight overall and H is the maximum per host.
+    try:
+        limits = [int(x) for x in in_flight.split(',')]
+    except ValueError:
+        exit(say.fatal_text('Unable to understand request limits "{}"', in_flight))
+    if len(limits) == 1:
+        limits.append(min(limits[0], _DEFAULT_PER_HOST))
+    if len(limits) != 2 or any(n < 1 for n in limits):
+        exit(say.fatal_text('Request limits must be 1 or 2 positive integers'))
+    return limits
+
+
 def credentials(api_url, user, pswd, use_keyring, reset = False):
     '''Returns stored credentials for the given combination of host and user,
     or asks the user for new credentials if none are stored or reset is True.
@@ -553,45 +1466,138 @@ def password(prompt):
         return sys.stdin.readline().rstrip()
 
 
-def bag_and_archive(directory, action, archive_fmt, processes, xml, url, say):
-    # If xml != None, we're dealing with a record, else the top-level directory.
-    if action != 'none':
-        say.info('Making bag out of {}', directory)
-        # Don't use large # of processes b/c creating the process pool is
-        # expensive.  If procs = 32 and most of our records have only 1-2
-        # files, make_bag() will still create a pool of 32 each time.  The
-        # following tries to balance things out for the most common case.
-        # Note: this uses listdir to avoid walking down the directory tree,
-        # but if a given entry is the root of a large subdirectory, then this
-        # may fail to use multiple processes when it would be good to do so.
-        procs = 1 if len(os.listdir(directory)) < processes else processes
-        bag = bagit.make_bag(directory, checksums = _BAG_CHECKSUMS, processes = procs)
-        if xml != None:
-            # The official_url field is not always present in the record.
-            # Try to get it, and default to using the eprints record id.
-            official_url = eprints_official_url(xml)
-            record_id = eprints_record_id(xml)
-            extern_id = official_url if official_url else record_id
-            bag.info['Internal-Sender-Identifier'] = record_id
-            bag.info['External-Identifier'] = extern_id
-            bag.info['External-Description'] = 'Single EPrints record and associated document files'
-        else:
-            # Case: the overall bag for the whole directory
-            bag.info['External-Identifier'] = url
-            bag.info['External-Description'] = 'Collection of EPrints records and their associated document files'
-        bag.save()
-        if __debug__: log('Verifying bag {}', bag.path)
-        bag.validate()
+def verify_level(verify):
+    '''Returns the level of verification to apply to one record, given the
+    value of the -v option.'''
+    if verify == 'sampled':
+        return 'full' if random.random() < _SAMPLE_FRACTION else 'fast'
+    return verify
+
 
+def bag_and_archive(directory, action, archive_fmt, pool, summary, url, say,
+                    verify = 'full', compression = (None, 1)):
+    # If summary != None, it's the RecordSummary of a record, else we're
+    # dealing with the top-level directory.
+    if action != 'none':
+        bag = make_bag(directory, pool, summary, url, say, None, verify)
         if action == 'bag-and-archive':
-            archive_file = directory + archive_extension(archive_fmt)
-            say.info('Making archive file {}', archive_file)
-            comments = file_comments(bag) if xml != None else dir_comments(bag, url)
-            create_archive(archive_file, archive_fmt, directory, comments)
-            if __debug__: log('Verifying archive file {}', archive_file)
-            verify_archive(archive_file, archive_fmt)
-            if __debug__: log('Deleting directory {}', directory)
-            shutil.rmtree(directory)
+            make_archive(directory, archive_fmt, bag, summary, url, say, verify,
+                         compression)
+
+
+def make_bag(directory, pool, summary, url, say, digests = None, verify = 'full'):
+    # If summary != None, it's the RecordSummary of a record, else we're
+    # dealing with the top-level directory.
+    # 'pool' is the HashPool shared by all bags, used for computing checksums.
+    # 'digests' are the checksums of the files computed while downloading them.
+    # 'verify' is the level of verification: 'full', 'fast' or 'none'.
+    say.info('Making bag out of {}', directory)
+    if summary != None:
+        # Only files whose checksums we don't already have are read here.
+        bag_info = record_bag_info(summary)
+    else:
+        # Case: the overall bag for the whole directory.
+        bag_info = {'External-Identifier': url,
+                    'External-Description': 'Collection of EPrints records and their associated document files'}
+    with timed('make_bag') as timing:
+        bag = bags.make_bag(directory, _BAG_CHECKSUMS, digests, bag_info, pool)
+        timing.bytes = payload_bytes(bag)
+    # A fast validation checks the total size of the payload (Payload-Oxum)
+    # and that the files in the manifests and on disk are the same, without
+    # reading them; a full one also rereads them to compare their checksums.
+    if verify != 'none':
+        if __debug__: log('Verifying bag {} ({})', bag.path, verify)
+        with timed('validate') as timing:
+            bag.validate(completeness_only = True)
+            if verify == 'full':
+                bags.verify_checksums(bag, pool)
+                timing.bytes = payload_bytes(bag)
+    return bag
+
+
+def payload_bytes(bag):
+    # Returns the total size of the payload files of 'bag', from the
+    # Payload-Oxum value in its bag-info.txt file.
+    oxum = bag.info.get('Payload-Oxum', '0.0')
+    return int(oxum.split('.')[0]) if oxum.split('.')[0].isdigit() else 0
+
+
+def record_bag_info(summary):
+    # Returns the values to put in bag-info.txt for the record summarized by
+    # 'summary'.  The official_url field is not always present in the record.
+    # Try to get it, and default to using the eprints record id.
+    record_id = summary.record_id
+    extern_id = summary.official_url or record_id
+    return {'Internal-Sender-Identifier': record_id,
+            'External-Identifier': extern_id,
+            'External-Description': 'Single EPrints record and associated document files'}
+
+
+def stream_record(record, docs, prefix, archive_fmt, user, password, missing_ok,
+                  say, compression = (None, 1)):
+    # Write the record and its documents 'docs' straight into an archive file,
+    # without a record directory.  Returns the ArchivedBag object.
+    # 'compression' is the compression level and the number of threads to use.
+    archive_file = record.dir + archive_extension(archive_fmt)
+    say.info('Writing archive file {}', archive_file)
+    bag = bags.ArchivedBag(archive_file, archive_fmt, record.name, _BAG_CHECKSUMS,
+                           *compression)
+    try:
+        data = record.content
+        bag.add_file(prefix + str(record.number) + '.xml', [data], len(data))
+        stream_files(docs, user, password, bag.add_file, missing_ok, say)
+    except BaseException:
+        bag.abort()
+        raise
+    return bag
+
+
+def close_streamed_archive(bag, archive_fmt, say, verify, threads = 1):
+    # Finish writing the archive file of the ArchivedBag 'bag' and verify it.
+    # The bag itself has no directory to validate; the checksums in its
+    # manifests were computed from the same data written to the archive.
+    with timed('create_archive') as timing:
+        bag.close(file_comments(bag))
+        timing.bytes = path.getsize(bag.archive_file)
+    if verify != 'none':
+        if __debug__: log('Verifying archive file {} ({})', bag.archive_file, verify)
+        with timed('verify_archive') as timing:
+            verify_archive(bag.archive_file, archive_fmt, verify == 'full', bag.members,
+                           archive_digests(bag, bag.name), threads)
+            timing.bytes = path.getsize(bag.archive_file) if verify == 'full' else 0
+
+
+def make_archive(directory, archive_fmt, bag, summary, url, say, verify = 'full',
+                 compression = (None, 1)):
+    # If summary != None, it's the RecordSummary of a record, else we're
+    # dealing with the top-level directory.
+    # 'compression' is the compression level and the number of threads to use.
+    archive_file = directory + archive_extension(archive_fmt)
+    say.info('Making archive file {}', archive_file)
+    comments = file_comments(bag) if summary != None else dir_comments(bag, url)
+    expected = directory_members(directory) if verify == 'fast' else None
+    with timed('create_archive') as timing:
+        create_archive(archive_file, archive_fmt, directory, comments, *compression)
+        timing.bytes = path.getsize(archive_file)
+    if verify != 'none':
+        if __debug__: log('Verifying archive file {} ({})', archive_file, verify)
+        digests = archive_digests(bag, path.basename(directory))
+        with timed('verify_archive') as timing:
+            verify_archive(archive_file, archive_fmt, verify == 'full', expected,
+                           digests, compression[1])
+            timing.bytes = path.getsize(archive_file) if verify == 'full' else 0
+    if __debug__: log('Deleting directory {}', directory)
+    with timed('rmtree'):
+        shutil.rmtree(directory)
+
+
+def archive_digests(bag, name):
+    # Returns a dict mapping the names that the payload files of 'bag' have
+    # in an archive, where the bag is in directory 'name', to their MD5
+    # checksums, as recorded when the bag was made.
+    return {name + '/' + entry.replace(os.sep, '/'): checksums['md5']
+            for entry, checksums in bag.entries.items()
+            if entry.startswith('data') and 'md5' in checksums}
 
 
 def file_comments(bag):
@@ -659,7 +1665,7 @@ def fmt_statuses(status_list, negated):
 # The following allows users to invoke this using "python3 -m eprints2bags".
 
 if __name__ == '__main__':
-    plac.call(main)
+    run()
 
 
 # For Emacs users
@@ -0,0 +1,434 @@
+'''
+bags.py: write BagIt bags using checksums computed ahead of time
+
+The bagit package computes the checksums of the payload files by reading them
+when the bag is created.  For the records written by eprints2bags, the
+checksums of the documents are computed while the documents are downloaded
+(see download() in network.py), so reading the files again is a waste of
+time.  The function make_bag() in this module writes the same files that
+bagit.make_bag() would, but only reads the files whose checksums it was not
+given.  The class ArchivedBag goes one step further and writes a bag
+directly into a ZIP or tar archive file, without writing the files to disk
+first.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import bagit
+from   datetime import date
+import hashlib
+import io
+import os
+from   os import path
+import re
+import tarfile
+import tempfile
+from   time import localtime, time
+from   zipfile import ZipFile, ZipInfo, ZIP_STORED
+
+import eprints2bags
+from   eprints2bags.checksums import Digester, file_digests
+from   eprints2bags.compression import ParallelZipFile, compressed_file
+from   eprints2bags.debug import log
+from   eprints2bags.exceptions import *
+from   eprints2bags.files import read_archive
+
+
+# Constants.
+# .............................................................................
+
+BAGIT_VERSION = '0.97'
+'''Version of the BagIt specification followed by the bags we write.'''
+
+_BAGIT_TXT = 'BagIt-Version: {}\nTag-File-Character-Encoding: UTF-8\n'.format(BAGIT_VERSION)
+'''Contents of the bagit.txt file, the same as written by bagit.make_bag().'''
+
+_ZIP64_LIMIT = 2**31 - 1
+'''Entries of unknown size or larger than this need ZIP64 extensions.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class ArchivedBag():
+    '''A bag written directly into the archive file 'archive_file', of the
+    type 'type' (one of the archive types accepted by create_archive()).  The
+    files in the archive are put in a directory named 'name', as if the bag
+    had been created in a directory of that name and then archived.  The
+    archive is written to a temporary file until close() is called.
+    Compressed archives are compressed at 'level' (None means the default
+    level of the compression method) using 'threads' threads.
+
+    Add the payload files using add_file(), then call finish() to write the
+    tag files.  After that, the attributes 'version', 'info' and 'entries'
+    have the same meaning as those of a bagit.Bag object, 'members' maps
+    the names of the files in the archive to their sizes.  Finally, call
+    close().
+    '''
+
+    def __init__(self, archive_file, type, name, algorithms,
+                 level = None, threads = 1):
+        self.archive_file = archive_file
+        self.name         = name
+        self.version      = BAGIT_VERSION
+        self.info         = {}
+        self.digests      = {}
+        self.members      = {}
+        self._algorithms  = algorithms
+        self._part_file   = archive_file + '.part'
+        self._total_bytes = 0
+        if __debug__: log('writing bag {} to {}', name, self._part_file)
+        self._stream = None
+        self._tar  = None
+        self._zip  = None
+        if type.endswith('zip'):
+            if type.startswith('uncompress'):
+                self._zip = ZipFile(self._part_file, 'w', ZIP_STORED, allowZip64 = True)
+            else:
+                smart = type.startswith('smart')
+                self._zip = ParallelZipFile(self._part_file, level, threads, smart)
+        elif type.startswith('uncompress'):
+            self._tar = tarfile.open(self._part_file, 'w')
+        else:
+            self._stream = compressed_file(self._part_file, type, level, threads)
+            self._tar = tarfile.open(fileobj = self._stream, mode = 'w|')
+
+
+    def add_file(self, file_name, chunks, size = None):
+        '''Add a payload file named 'file_name' whose contents are the bytes
+        produced by the iterator 'chunks'.  'size' is the total number of
+        bytes, if known.'''
+        digester = Digester(self._algorithms)
+        size = self._write(path.join('data', file_name), chunks, size, digester)
+        self.digests[file_name] = digester.hexdigests()
+        self._total_bytes += size
+
+
+    @property
+    def entries(self):
+        return {'data/' + name.replace(os.sep, '/'): checksums
+                for name, checksums in self.digests.items()}
+
+
+    def finish(self, bag_info = None):
+        '''Write the tag files, using the values in 'bag_info' in addition
+        to the standard ones for bag-info.txt.'''
+        entries = sorted(self.entries.items())
+        oxum = '{}.{}'.format(self._total_bytes, len(entries))
+        self.info = bag_info_values(bag_info, oxum)
+        tag_files = {'bagit.txt': _BAGIT_TXT.encode('utf-8'),
+                     'bag-info.txt': bag_info_text(self.info).encode('utf-8')}
+        for alg in self._algorithms:
+            text = manifest_text((name, checksums[alg]) for name, checksums in entries)
+            tag_files['manifest-{}.txt'.format(alg)] = text.encode('utf-8')
+        for alg in self._algorithms:
+            text = manifest_text((name, hashlib.new(alg, data).hexdigest())
+                                 for name, data in sorted(tag_files.items())
+                                 if not name.startswith('tagmanifest'))
+            tag_files['tagmanifest-{}.txt'.format(alg)] = text.encode('utf-8')
+        for name, data in sorted(tag_files.items()):
+            self._write(name, [data], len(data), None)
+
+
+    def close(self, comment = None):
+        '''Finish writing the archive file and give it its final name.  If
+        'comment' is not None, it's stored as the comment of a ZIP file.'''
+        if self._zip:
+            if comment:
+                self._zip.comment = comment.encode()
+            self._zip.close()
+        else:
+            self._tar.close()
+            if self._stream:
+                self._stream.close()
+        os.replace(self._part_file, self.archive_file)
+
+
+    def abort(self):
+        '''Stop writing the archive file and delete it.'''
+        try:
+            if self._zip:
+                self._zip.close()
+            else:
+                self._tar.close()
+                if self._stream:
+                    self._stream.close()
+        except Exception as ex:
+            if __debug__: log('error closing {}: {}', self._part_file, str(ex))
+        if path.exists(self._part_file):
+            os.remove(self._part_file)
+
+
+    def _write(self, file_name, chunks, size, digester):
+        # Write one member of the archive and return the number of bytes.
+        member = self.name + '/' + file_name.replace(os.sep, '/')
+        if self._zip:
+            info = ZipInfo(member, date_time = localtime()[:6])
+            info.compress_type = self._zip.compression
+            info.external_attr = 0o644 << 16
+            large = size is None or size > _ZIP64_LIMIT
+            written = 0
+            with self._zip.open(info, 'w', force_zip64 = large) as out:
+                for chunk in chunks:
+                    if digester:
+                        digester.update(chunk)
+                    out.write(chunk)
+                    written += len(chunk)
+        else:
+            # A tar header includes the size of the file, so if we don't know
+            # it, we have to put the data somewhere else first.
+            info = tarfile.TarInfo(member)
+            info.mtime = time()
+            info.mode = 0o644
+            if size is None:
+                with tempfile.TemporaryFile() as temp:
+                    for chunk in chunks:
+                        if digester:
+                            digester.update(chunk)
+                        temp.write(chunk)
+                    info.size = temp.tell()
+                    temp.seek(0)
+                    self._tar.addfile(info, temp)
+            else:
+                info.size = size
+                reader = _ChunkReader(chunks, digester)
+                self._tar.addfile(info, reader)
+                # tarfile stops at info.size, so check nothing was left over.
+                if reader.read(1):
+                    raise IOError('Expected {} bytes for {} but got more'.format(
+                        size, file_name))
+            written = info.size
+        if size is not None and written != size:
+            raise IOError('Expected {} bytes for {} but got {}'.format(
+                size, file_name, written))
+        self.members[member] = written
+        return written
+
+
+# Exported functions.
+# .............................................................................
+
+def make_bag(directory, algorithms, digests = None, bag_info = None, pool = None):
+    '''Turn 'directory' into a bag, like bagit.make_bag(), and return a
+    bagit.Bag object for it.  'algorithms' is a list of checksum algorithm
+    names.  'digests' is a dict mapping file paths, relative to 'directory',
+    to dicts of checksums of the kind returned by file_digests(); files that
+    are not in 'digests' are read to compute their checksums, using the
+    HashPool 'pool' if it is not None.  'bag_info' is a dict of additional
+    values to write to bag-info.txt.  Unlike bagit.make_bag(), this does not
+    change the current directory, so it can be used in several threads at
+    once.
+    '''
+    digests = digests or {}
+    if __debug__: log('moving contents of {} into data directory', directory)
+    temp_dir = tempfile.mkdtemp(dir = directory)
+    for name in os.listdir(directory):
+        if path.join(directory, name) != temp_dir:
+            os.rename(path.join(directory, name), path.join(temp_dir, name))
+    data_dir = path.join(directory, 'data')
+    os.rename(temp_dir, data_dir)
+    os.chmod(data_dir, os.stat(directory).st_mode)
+
+    files = []
+    for root, dirs, names in os.walk(data_dir):
+        dirs.sort()
+        files += [path.join(root, name) for name in sorted(names)]
+    known = {}
+    for file in files:
+        checksums = digests.get(path.relpath(file, data_dir))
+        if checksums and all(alg in checksums for alg in algorithms):
+            known[file] = checksums
+    unknown = [file for file in files if file not in known]
+    if pool:
+        known.update(pool.digests(unknown, algorithms))
+    else:
+        known.update({file: file_digests(file, algorithms) for file in unknown})
+
+    manifests = {alg: [] for alg in algorithms}
+    total_bytes = 0
+    for file in files:
+        entry = 'data/' + path.relpath(file, data_dir).replace(os.sep, '/')
+        for alg in algorithms:
+            manifests[alg].append((entry, known[file][alg]))
+        total_bytes += os.stat(file).st_size
+    total_files = len(files)
+    for alg in algorithms:
+        _write_file(path.join(directory, 'manifest-{}.txt'.format(alg)),
+                    manifest_text(manifests[alg]))
+
+    info = bag_info_values(bag_info, '{}.{}'.format(total_bytes, total_files))
+    _write_file(path.join(directory, 'bagit.txt'), _BAGIT_TXT)
+    _write_file(path.join(directory, 'bag-info.txt'), bag_info_text(info))
+
+    # The tag manifests list the tag files written above, which are small.
+    tag_files = ['bag-info.txt', 'bagit.txt']
+    tag_files += ['manifest-{}.txt'.format(alg) for alg in algorithms]
+    for alg in algorithms:
+        entries = [(name, file_digests(path.join(directory, name), [alg])[alg])
+                   for name in sorted(tag_files)]
+        _write_file(path.join(directory, 'tagmanifest-{}.txt'.format(alg)),
+                    manifest_text(entries))
+    return bagit.Bag(directory)
+
+
+def audit_archive(archive_file, type, full = True, threads = 1):
+    '''Check the bags in an archive file made by eprints2bags, without
+    extracting it.  The files in the data directory of each bag are compared
+    to those listed in the bag's manifest and to the Payload-Oxum value in
+    bag-info.txt; if 'full' is True, every file is also read, using
+    'threads' threads for ZIP files, and compared to its checksum in the
+    manifest.  Returns a list of descriptions of the problems found, which is
+    empty if there are none.'''
+    def is_tag_file(name):
+        return re.search(r'(^|/)(bag-info|manifest-\w+)\.txt$', name) != None
+
+    algorithm = 'md5' if full else None
+    try:
+        sizes, digests, tags = read_archive(archive_file, type, algorithm,
+                                            is_tag_file, threads)
+    except CorruptedContent as ex:
+        return [str(ex)]
+    bag_dirs = sorted({name[:-len('bag-info.txt')] for name in tags
+                       if name.endswith('bag-info.txt')})
+    if not bag_dirs:
+        return ['No BagIt bag found in "{}"'.format(archive_file)]
+    problems = []
+    for bag_dir in bag_dirs:
+        manifests = sorted(name for name in tags if name.startswith(bag_dir)
+                           and name[len(bag_dir):].startswith('manifest-'))
+        if not manifests:
+            problems.append('No manifest found in bag "{}"'.format(bag_dir))
+            continue
+        # Prefer MD5, which is the fastest of the algorithms used in bags.
+        manifest = bag_dir + 'manifest-md5.txt'
+        if manifest not in manifests:
+            manifest = manifests[0]
+        alg = manifest[len(bag_dir) + len('manifest-'):-len('.txt')]
+        if full and alg != algorithm:
+            digests = read_archive(archive_file, type, alg, threads = threads)[1]
+            algorithm = alg
+        listed = _parsed_manifest(tags[manifest].decode('utf-8'), bag_dir)
+        payload = {name: size for name, size in sizes.items()
+                   if name.startswith(bag_dir + 'data/')}
+        for name in sorted(set(listed) - set(payload)):
+            problems.append('File "{}" is missing'.format(name))
+        for name in sorted(set(payload) - set(listed)):
+            problems.append('File "{}" is not in the manifest'.format(name))
+        if full:
+            for name in sorted(set(listed) & set(payload)):
+                if digests.get(name) != listed[name]:
+                    problems.append('File "{}" does not match its checksum'.format(name))
+        info = tags[bag_dir + 'bag-info.txt'].decode('utf-8')
+        oxum = re.search(r'(?m)^Payload-Oxum:\s*(\d+)\.(\d+)\s*$', info)
+        actual = (sum(payload.values()), len(payload))
+        if oxum and (int(oxum.group(1)), int(oxum.group(2))) != actual:
+            problems.append('Payload-Oxum of bag "{}" does not match its contents'.format(bag_dir))
+    return problems
+
+
+def verify_checksums(bag, pool):
+    '''Read every file listed in the manifests and tag manifests of the
+    bagit.Bag object 'bag', using the HashPool 'pool', and raise
+    bagit.BagValidationError if any of its checksums is wrong.  This does
+    the same checks as the last part of bag.validate(), but spreads the work
+    over the processes of a pool that is shared by all bags.'''
+    algorithms = sorted({alg for checksums in bag.entries.values() for alg in checksums})
+    files = {path.join(bag.path, entry): entry for entry in bag.entries}
+    found = pool.digests(sorted(files), algorithms)
+    errors = []
+    for file, entry in sorted(files.items()):
+        for alg, expected in bag.entries[entry].items():
+            if found[file][alg] != expected.lower():
+                errors.append(bagit.ChecksumMismatch(entry, alg, expected, found[file][alg]))
+    if errors:
+        raise bagit.BagValidationError('Bag validation failed', errors)
+
+
+def bag_info_values(bag_info, oxum):
+    '''Returns a dict of the values for bag-info.txt: the standard ones, plus
+    those in 'bag_info', plus the Payload-Oxum value 'oxum'.'''
+    info = {'Bagging-Date': date.today().strftime('%Y-%m-%d'),
+            'Bag-Software-Agent': 'eprints2bags v{} <{}>'.format(
+                eprints2bags.__version__, eprints2bags.__url__)}
+    info.update(bag_info or {})
+    info['Payload-Oxum'] = oxum
+    return info
+
+
+def bag_info_text(info):
+    '''Returns the contents of a bag-info.txt file holding the dict 'info'.'''
+    return ''.join('{}: {}\n'.format(key, str(info[key]).replace('\n', ' '))
+                   for key in sorted(info))
+
+
+def manifest_text(entries):
+    '''Returns the contents of a manifest file listing 'entries', a sequence
+    of (file name, checksum) tuples.'''
+    # The format and the encoding of file names are those used by bagit,
+    # which only encodes line breaks.  In particular, '%' is left as it is,
+    # because bagit would not decode '%25'.
+    text = ''
+    for name, checksum in entries:
+        name = name.replace('\r', '%0D').replace('\n', '%0A')
+        text += '{}  {}\n'.format(checksum, name)
+    return text
+
+
+# Helper functions.
+# .............................................................................
+
+def _parsed_manifest(text, bag_dir):
+    # Returns a dict mapping the names of the files listed in the manifest
+    # 'text' of the bag in directory 'bag_dir' (a prefix ending in '/') of an
+    # archive to their checksums.  This reverses manifest_text().
+    entries = {}
+    for line in text.splitlines():
+        if line.strip():
+            checksum, name = line.split(None, 1)
+            name = name.replace('%0D', '\r').replace('%0A', '\n')
+            entries[bag_dir + name.lstrip('*')] = checksum.lower()
+    return entries
+
+
+def _write_file(file, text):
+    with open(file, 'w', encoding = 'utf-8') as f:
+        f.write(text)
+
+
+class _ChunkReader(io.RawIOBase):
+    # File-like object reading from an iterator of chunks of bytes, as
+    # needed by tarfile.addfile().  The data read is also given to 'digester'.
+
+    def __init__(self, chunks, digester):
+        self._chunks = iter(chunks)
+        self._digester = digester
+        self._pending = memoryview(b'')
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._pending):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            # The chunk may be a view of a buffer that will be reused.
+            self._pending = memoryview(bytes(chunk))
+            self._offset = 0
+            if self._digester:
+                self._digester.update(self._pending)
+        count = min(len(buffer), len(self._pending) - self._offset)
+        buffer[:count] = self._pending[self._offset:self._offset + count]
+        self._offset += count
+        return count
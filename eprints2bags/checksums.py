@@ -0,0 +1,147 @@
+'''
+checksums.py: compute several message digests in a single pass over data
+
+This module also provides HashPool, a pool of processes that lasts for a
+whole run and computes the checksums of files for any number of threads at
+once.  Files are handed to the processes in groups of roughly equal total
+size, so that the work is spread over the processes whether a bag has one
+large file or many small ones.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   concurrent.futures import Future
+import hashlib
+import heapq
+import multiprocessing
+import os
+import signal
+
+import eprints2bags
+from   eprints2bags.debug import log
+
+
+# Constants.
+# .............................................................................
+
+_READ_SIZE = 1048576
+'''Size of the blocks read from files by file_digests().'''
+
+_MIN_TASK_BYTES = 4*1048576
+'''Smallest total size of the files handed to a process in one task, unless
+there is less than this in all.  Smaller tasks cost more in communication
+between processes than they gain.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Digester():
+    '''Computes the digests named in 'algorithms' (a list of names accepted by
+    hashlib.new(), such as "sha256" or "md5") of the data given to update().
+    '''
+
+    def __init__(self, algorithms):
+        self._hashers = [(name, hashlib.new(name)) for name in algorithms]
+
+
+    def update(self, data):
+        '''Add the bytes in 'data' to the data being digested.'''
+        for _, hasher in self._hashers:
+            hasher.update(data)
+
+
+    def hexdigests(self):
+        '''Returns a dict mapping algorithm names to hexadecimal digests.'''
+        return {name: hasher.hexdigest() for name, hasher in self._hashers}
+
+
+class HashPool():
+    '''Pool of 'processes' processes computing checksums of files.  The pool
+    is meant to be created once and used for a whole run; its methods can be
+    called from several threads at once.  Call close() when done.'''
+
+    def __init__(self, processes):
+        if __debug__: log('starting pool of {} hashing processes', processes)
+        self.processes = processes
+        # Processes are started with "spawn" because forking a process that
+        # has other threads running can leave locks held in the child.
+        context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(processes, initializer = _ignore_interrupts)
+
+
+    def digests(self, files, algorithms):
+        '''Returns a dict mapping each path in the list 'files' to a dict of
+        checksums of the kind returned by file_digests().'''
+        if not files:
+            return {}
+        results = {}
+        futures = [self._submit(group, algorithms) for group in self._groups(files)]
+        for future in futures:
+            results.update(future.result())
+        return results
+
+
+    def close(self):
+        if __debug__: log('stopping hashing processes')
+        self._pool.terminate()
+        self._pool.join()
+
+
+    def _groups(self, files):
+        # Split 'files' into groups of roughly equal total size, at most one
+        # per process, placing the largest files first.
+        sizes = sorted(((os.stat(f).st_size, f) for f in files), reverse = True)
+        total = sum(size for size, _ in sizes)
+        count = max(1, min(self.processes, len(sizes), total // _MIN_TASK_BYTES))
+        heap = [(0, n, []) for n in range(count)]
+        for size, file in sizes:
+            group_size, n, group = heapq.heappop(heap)
+            group.append(file)
+            heapq.heappush(heap, (group_size + size, n, group))
+        return [group for _, _, group in heap]
+
+
+    def _submit(self, files, algorithms):
+        future = Future()
+        self._pool.apply_async(_group_digests, (files, algorithms),
+                               callback = future.set_result,
+                               error_callback = future.set_exception)
+        return future
+
+
+# Exported functions.
+# .............................................................................
+
+def file_digests(file, algorithms):
+    '''Returns a dict mapping each algorithm name in 'algorithms' to the
+    hexadecimal digest of the contents of 'file'.  The file is read once.'''
+    if __debug__: log('computing {} of {}', ', '.join(algorithms), file)
+    digester = Digester(algorithms)
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_SIZE), b''):
+            digester.update(block)
+    return digester.hexdigests()
+
+
+# Helper functions.
+# .............................................................................
+
+def _group_digests(files, algorithms):
+    # Runs in the processes of a HashPool.
+    return {file: file_digests(file, algorithms) for file in files}
+
+
+def _ignore_interrupts():
+    # Interrupts are handled by the main process, which stops the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
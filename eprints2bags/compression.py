@@ -0,0 +1,455 @@
+'''
+compression.py: deflate compression spread over several threads
+
+Deflate (the compression method used in ZIP and gzip files) normally runs on
+a single core.  This module uses the approach of pigz: the data is cut into
+blocks, and each block is compressed separately on a pool of threads, using
+the end of the previous block as a preset dictionary so that little is lost
+in compression ratio.  Every block but the last is ended with a "sync flush",
+which ends it on a byte boundary; the compressed blocks can then simply be
+concatenated to make one valid deflate stream.  zlib releases Python's global
+interpreter lock while it works, so the threads really do run in parallel.
+
+ParallelGzipFile writes gzip files (for compressed tar archives), and
+ParallelZipFile writes ZIP files whose members are compressed this way.
+ParallelZipFile can also store files that are already compressed (such as
+PDF and JPEG files) without compressing them again.  ZstdFile writes files
+compressed with Zstandard, if the optional package "zstandard" is installed;
+zstd does its own multithreading.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import deque
+from   concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import struct
+from   time import time
+import zlib
+from   zipfile import ZipInfo, ZIP_DEFLATED
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import eprints2bags
+from   eprints2bags.exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+DEFAULT_LEVEL = 6
+'''Default compression level (1 = fastest, 9 = smallest), as in zlib.'''
+
+ZSTD_DEFAULT_LEVEL = 3
+'''Default Zstandard compression level (1 = fastest, 19 = smallest).'''
+
+ZSTD_MAX_LEVEL = 19
+'''Highest Zstandard compression level accepted.'''
+
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.7z', '.avi', '.bz2', '.docx', '.epub', '.flac', '.gif', '.gz', '.jp2',
+    '.jpeg', '.jpg', '.m4a', '.m4v', '.mkv', '.mov', '.mp3', '.mp4', '.odp',
+    '.ods', '.odt', '.ogg', '.pdf', '.png', '.pptx', '.rar', '.tgz', '.webm',
+    '.webp', '.xlsx', '.xz', '.zip', '.zst',
+}
+'''Extensions of files whose contents are normally compressed already, and
+which are not worth compressing again.'''
+
+_BLOCK_SIZE = 1048576
+'''Size of the blocks of data compressed independently.'''
+
+_DICT_SIZE = 32768
+'''Size of the deflate window; the end of each block that is used as the
+dictionary for the next one.'''
+
+_MAX_32 = 0xFFFFFFFF
+'''Largest value of the 32-bit size and offset fields in ZIP headers.'''
+
+_MAX_16 = 0xFFFF
+'''Largest value of the 16-bit entry count fields in ZIP headers.'''
+
+_ZSTD_WINDOW_LOG = 27
+'''Base-2 logarithm of the Zstandard window size (128 MB), used with
+long-distance matching to find repeats far apart in large archives.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class ParallelGzipFile():
+    '''Write-only file object that writes gzip-compressed data to the file
+    named 'file_name', using 'threads' threads at compression 'level'.'''
+
+    def __init__(self, file_name, level = None, threads = 1):
+        level = level or DEFAULT_LEVEL
+        self._file = open(file_name, 'wb')
+        self._executor = ThreadPoolExecutor(max_workers = threads)
+        # Header: magic number, deflate, no flags, time, no extra flags, unix.
+        self._file.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, int(time()), 0, 3))
+        self._deflater = _Deflater(level, self._executor, threads, self._file.write)
+
+
+    def write(self, data):
+        self._deflater.write(data)
+        return len(data)
+
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self._deflater.finish()
+            self._file.write(struct.pack('<II', self._deflater.crc,
+                                         self._deflater.size & _MAX_32))
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParallelZipFile():
+    '''Write-only ZIP file whose members are deflated by 'threads' threads at
+    compression 'level'.  If 'smart' is True, members whose names end in one
+    of INCOMPRESSIBLE_EXTENSIONS are stored without compression.  This
+    supports the parts of the interface of zipfile.ZipFile used in this
+    program: the methods open() (for writing only), write(), infolist() and
+    close(), and the attributes 'comment' and 'compression'.  The result can be read with
+    zipfile.ZipFile.'''
+
+    def __init__(self, file_name, level = None, threads = 1, smart = False):
+        self.comment = b''
+        self.compression = ZIP_DEFLATED
+        self._level = level or DEFAULT_LEVEL
+        self._threads = threads
+        self._smart = smart
+        self._file = open(file_name, 'wb')
+        self._executor = ThreadPoolExecutor(max_workers = threads)
+        self._entries = []
+        self._infos = []
+
+
+    def open(self, zinfo, mode = 'w', force_zip64 = False):
+        '''Returns a file object for writing the member described by the
+        zipfile.ZipInfo object 'zinfo'.  Use 'force_zip64' if the member may
+        be larger than 2 GB.'''
+        if mode != 'w':
+            raise InternalError('ParallelZipFile can only write members')
+        store = self._smart and incompressible(zinfo.filename)
+        return _ZipMemberWriter(self, zinfo, force_zip64, store)
+
+
+    def write(self, file_name, arcname):
+        '''Add the file 'file_name' to the archive, under the name 'arcname'.'''
+        zinfo = ZipInfo.from_file(file_name, arcname)
+        large = zinfo.file_size > _MAX_32 // 2
+        with open(file_name, 'rb') as src, self.open(zinfo, 'w', large) as dest:
+            shutil.copyfileobj(src, dest, _BLOCK_SIZE)
+
+
+    def infolist(self):
+        '''Returns a list of zipfile.ZipInfo objects for the members written
+        so far, with their CRC and sizes filled in.'''
+        return list(self._infos)
+
+
+    def close(self):
+        '''Write the central directory and close the file.'''
+        if self._file.closed:
+            return
+        try:
+            self._write_directory()
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _write_directory(self):
+        start = self._file.tell()
+        for entry in self._entries:
+            (name, flags, method, dos_time, dos_date, crc, csize, usize, offset, attr) = entry
+            extra = b''
+            needed = 20
+            if max(csize, usize, offset) >= _MAX_32:
+                extra = struct.pack('<HHQQQ', 1, 24, usize, csize, offset)
+                csize = usize = offset = _MAX_32
+                needed = 45
+            self._file.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50,
+                                         (3 << 8) | needed, needed, flags, method,
+                                         dos_time, dos_date, crc, csize, usize,
+                                         len(name), len(extra), 0, 0, 0, attr, offset))
+            self._file.write(name)
+            self._file.write(extra)
+        end = self._file.tell()
+        count = len(self._entries)
+        size = end - start
+        if count >= _MAX_16 or size >= _MAX_32 or start >= _MAX_32:
+            self._file.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45,
+                                         0, 0, count, count, size, start))
+            self._file.write(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+            count, size, start = _MAX_16, _MAX_32, _MAX_32
+        comment = self.comment[:_MAX_16]
+        self._file.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count,
+                                     size, start, len(comment)))
+        self._file.write(comment)
+
+
+class ZstdFile():
+    '''Write-only file object that writes Zstandard-compressed data to the
+    file named 'file_name', using 'threads' threads at compression 'level'.
+    Long-distance matching is used, with a window of 128 MB.  Requires the
+    optional Python package "zstandard".'''
+
+    def __init__(self, file_name, level = None, threads = 1):
+        if zstandard is None:
+            raise InternalError('Zstandard compression requires the'
+                                ' Python package "zstandard"')
+        params = zstandard.ZstdCompressionParameters.from_level(
+            level or ZSTD_DEFAULT_LEVEL, threads = threads if threads > 1 else 0,
+            enable_ldm = True, window_log = _ZSTD_WINDOW_LOG, write_checksum = True)
+        compressor = zstandard.ZstdCompressor(compression_params = params)
+        self._file = open(file_name, 'wb')
+        self._writer = compressor.stream_writer(self._file)
+
+
+    def write(self, data):
+        self._writer.write(data)
+        return len(data)
+
+
+    def close(self):
+        if self._file.closed:
+            return
+        # This also closes self._file.
+        self._writer.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Exported functions.
+# .............................................................................
+
+def zstd_available():
+    '''Returns True if the optional package needed for ZstdFile is installed.'''
+    return zstandard is not None
+
+
+def zstd_reader(file_name):
+    '''Returns a readable stream of the decompressed contents of the
+    Zstandard-compressed file 'file_name'.  Closing the stream closes the
+    file.'''
+    if zstandard is None:
+        raise InternalError('Zstandard decompression requires the'
+                            ' Python package "zstandard"')
+    decompressor = zstandard.ZstdDecompressor(max_window_size = 2**_ZSTD_WINDOW_LOG)
+    return decompressor.stream_reader(open(file_name, 'rb'), closefd = True)
+
+
+def compressed_file(file_name, type, level = None, threads = 1):
+    '''Returns a write-only file object that compresses the data written to
+    it into 'file_name', for a compressed tar archive of type 'type'.'''
+    if type.startswith('zstd'):
+        return ZstdFile(file_name, level, threads)
+    return ParallelGzipFile(file_name, level, threads)
+
+
+def incompressible(file_name):
+    '''Returns True if the extension of 'file_name' indicates a file whose
+    contents are compressed already.'''
+    return os.path.splitext(file_name)[1].lower() in INCOMPRESSIBLE_EXTENSIONS
+
+
+# Helper classes.
+# .............................................................................
+
+class _Deflater():
+    # Compresses the data given to write() as a single raw deflate stream,
+    # one block at a time on the thread pool 'executor', and passes the
+    # compressed data to the function 'output' in the right order.  At most
+    # 2 * 'threads' blocks are kept waiting, to bound the memory used.
+
+    def __init__(self, level, executor, threads, output):
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self._level = level
+        self._executor = executor
+        self._max_pending = 2 * threads
+        self._output = output
+        self._buffer = bytearray()
+        self._previous = b''
+        self._pending = deque()
+
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= _BLOCK_SIZE:
+            block = bytes(self._buffer[:_BLOCK_SIZE])
+            del self._buffer[:_BLOCK_SIZE]
+            self._submit(block, False)
+
+
+    def finish(self):
+        # The last block may be empty; that's fine, it only marks the end.
+        self._submit(bytes(self._buffer), True)
+        self._buffer = bytearray()
+
+
+    def _submit(self, block, last):
+        future = self._executor.submit(_deflate, block, self._previous, self._level, last)
+        self._previous = block[-_DICT_SIZE:]
+        self._pending.append(future)
+        while self._pending and (last or len(self._pending) > self._max_pending):
+            compressed = self._pending.popleft().result()
+            self.compressed_size += len(compressed)
+            self._output(compressed)
+
+
+class _Storer():
+    # Counterpart of _Deflater for ZIP members stored without compression.
+
+    def __init__(self, output):
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self._output = output
+
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.compressed_size += len(data)
+        self._output(data)
+
+
+    def finish(self):
+        pass
+
+
+class _ZipMemberWriter():
+    # File object for writing one member of a ParallelZipFile.  The local
+    # header is written first, with zeros for the sizes and CRC, and filled
+    # in when the member is closed.  If 'store' is True, the data is stored
+    # without compression.
+
+    def __init__(self, zip_file, zinfo, zip64, store = False):
+        self._zip = zip_file
+        self._zinfo = zinfo
+        self._file = zip_file._file
+        self._zip64 = zip64
+        self._offset = self._file.tell()
+        self._name = zinfo.filename.encode('utf-8')
+        self._flags = 0 if len(self._name) == len(zinfo.filename) else 0x800
+        year, month, day, hour, minute, second = zinfo.date_time
+        self._dos_time = (hour << 11) | (minute << 5) | (second // 2)
+        self._dos_date = ((year - 1980) << 9) | (month << 5) | day
+        self._attr = zinfo.external_attr or (0o644 << 16)
+        self._method = 0 if store else 8
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        sizes = _MAX_32 if zip64 else 0
+        self._file.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20,
+                                     self._flags, self._method, self._dos_time, self._dos_date,
+                                     0, sizes, sizes, len(self._name), len(extra)))
+        self._file.write(self._name)
+        self._file.write(extra)
+        if store:
+            self._deflater = _Storer(self._file.write)
+        else:
+            self._deflater = _Deflater(zip_file._level, zip_file._executor,
+                                       zip_file._threads, self._file.write)
+        self._closed = False
+
+
+    def write(self, data):
+        self._deflater.write(data)
+        return len(data)
+
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._deflater.finish()
+        deflater = self._deflater
+        if not self._zip64 and max(deflater.size, deflater.compressed_size) >= _MAX_32:
+            raise InternalError('File too large for a ZIP member without ZIP64')
+        end = self._file.tell()
+        self._file.seek(self._offset + 14)
+        if self._zip64:
+            self._file.write(struct.pack('<I', deflater.crc))
+            self._file.seek(self._offset + 30 + len(self._name) + 4)
+            self._file.write(struct.pack('<QQ', deflater.size, deflater.compressed_size))
+        else:
+            self._file.write(struct.pack('<III', deflater.crc, deflater.compressed_size,
+                                         deflater.size))
+        self._file.seek(end)
+        # Like zipfile, fill in the values in the ZipInfo given to open().
+        self._zinfo.CRC = deflater.crc
+        self._zinfo.file_size = deflater.size
+        self._zinfo.compress_size = deflater.compressed_size
+        self._zinfo.compress_type = self._method
+        self._zinfo.header_offset = self._offset
+        self._zip._infos.append(self._zinfo)
+        self._zip._entries.append((self._name, self._flags, self._method, self._dos_time,
+                                   self._dos_date, deflater.crc,
+                                   deflater.compressed_size, deflater.size,
+                                   self._offset, self._attr))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+
+
+# Helper functions.
+# .............................................................................
+
+def _deflate(data, zdict, level, last):
+    # Compress one block as part of a raw deflate stream.
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last
+                                                        else zlib.Z_SYNC_FLUSH)
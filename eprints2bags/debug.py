@@ -1,5 +1,19 @@
 '''
-debug.py: lightweight debug logging facility
+debug.py: lightweight debug logging and tracing facility
+
+Calls to log() are recorded by a "tracer".  set_debug() installs one that
+writes every message at once, as text or (if the destination file name ends
+in ".jsonl") as JSON lines; set_tracing() installs one that keeps only the
+most recent messages in memory, and writes them as JSON lines when
+flush_trace() is called, typically after an error.  The latter is cheap
+enough to leave on in production runs.
+
+To keep the cost of log() low, the file and function names of each place
+log() is called from are looked up only the first time, and messages are
+only formatted when they are written out.  Messages can be grouped in spans
+(for example, one for each record processed): new_span() creates a span id,
+and messages logged inside a "with span(...)" block in the same thread are
+tagged with it.
 
 Authors
 -------
@@ -18,22 +32,48 @@ file "LICENSE" for more information.
 # minimize the performance impact of this module by eliding everything when
 # Python is running with the optimization flag -O.
 
-
-# Logger configuration.
+from   collections import deque
+from   contextlib import contextmanager
+import itertools
+import json
+import os
+from   os import path
+import sys
+import threading
+import time
+
+
+# Constants.
 # .............................................................................
 
-if __debug__:
-    import inspect
-    import logging
-    from   os import path
-    import sys
+DEFAULT_TRACE_SIZE = 20000
+'''Default number of messages kept in memory by set_tracing().'''
+
+_IMMUTABLE = (str, int, float, bool, bytes, type(None))
+'''Types of arguments to log() that can safely be formatted later.'''
+
+
+# Internal module variables.
+# .............................................................................
+
+_tracer = None
+'''Object recording the messages given to log(), or None if neither
+set_debug() nor set_tracing() has turned on logging.'''
+
+_sites = {}
+'''Cache mapping the code objects of the callers of log() to the file and
+function names reported for them.'''
+
+_context = threading.local()
+'''Per-thread state: the current span id, if any.'''
+
+_span_counter = itertools.count(1)
+'''Source of the serial numbers in span ids.'''
+
+_run_id = os.urandom(4).hex()
+'''Prefix of span ids, so that spans of different runs can't be confused.'''
 
-    # This next global variable makes a huge speed difference. It lets us avoid
-    # calling logging.getLogger('packagename').isEnabledFor(logging.DEBUG)
-    # at runtime in log() to test whether debugging is turned on.
-    setattr(sys.modules[__package__], '_debugging', False)
 
-
 # Exported functions.
 # .............................................................................
 
@@ -44,32 +84,35 @@ def set_debug(enabled, dest = '-'):
     console (standard output).  The default destination is the console.  For
     simplicity, only one destination is allowed at given a time; calling this
     function multiple times with different destinations simply switches the
-    destination to the latest one.
+    destination to the latest one.  If 'dest' is a file whose name ends in
+    ".jsonl", messages are written as JSON lines instead of text.
     '''
+    global _tracer
     if __debug__:
-        from logging import DEBUG, WARNING, FileHandler, StreamHandler
-        setattr(sys.modules[__package__], '_debugging', enabled)
-
-        # Set the appropriate output destination if we haven't already.
+        _close_tracer()
         if enabled:
-            logger    = logging.getLogger(__package__)
-            formatter = logging.Formatter('%(name)s %(message)s')
-            # We only allow one active destination.
-            for h in logger.handlers:
-                logger.removeHandler(h)
             # We treat empty dest values as meaning "the default output".
-            if dest in ['-', '', None]:
-                handler = StreamHandler()
-            else:
-                handler = FileHandler(dest)
-            handler.setFormatter(formatter)
-            handler.setLevel(DEBUG)
-            logger.addHandler(handler)
-            logger.setLevel(DEBUG)
-            setattr(sys.modules[__package__], '_logger', logger)
-        elif getattr(sys.modules[__package__], '_logger'):
-            logger = logging.getLogger(__package__)
-            logger.setLevel(WARNING)
+            json_lines = bool(dest) and dest.endswith('.jsonl')
+            _tracer = _StreamTracer(None if dest in ['-', '', None] else dest, json_lines)
+
+
+def set_tracing(dest, size = DEFAULT_TRACE_SIZE):
+    '''Turns on tracing: the last 'size' messages given to log() are kept in
+    memory, and written to the file 'dest' as JSON lines by flush_trace().
+    Has no effect if debug logging has been turned on by set_debug().'''
+    global _tracer
+    if __debug__:
+        if not isinstance(_tracer, _StreamTracer):
+            _close_tracer()
+            _tracer = _RingTracer(dest, size)
+
+
+def flush_trace():
+    '''Write out the messages kept in memory by set_tracing(), if it was
+    called, and forget them.'''
+    if __debug__:
+        if isinstance(_tracer, _RingTracer):
+            _tracer.flush()
 
 
 def log(s, *other_args):
@@ -77,12 +120,137 @@ def log(s, *other_args):
     remaining arguments are the arguments to the format string.
     '''
     if __debug__:
-        # This test for the level may seem redundant, but it's not: it prevents
-        # the string format from always being performed if logging is not
-        # turned on and the user isn't running Python with -O.
-        if getattr(sys.modules[__package__], '_debugging'):
-            func = inspect.currentframe().f_back.f_code.co_name
-            file_path = inspect.currentframe().f_back.f_code.co_filename
-            filename = path.basename(file_path)
-            logging.getLogger(__package__).debug('{} {}(): '.format(filename, func)
-                                                 + s.format(*other_args))
+        # This test may seem redundant, but it's not: it keeps the cost of
+        # log() down to a function call when logging is not turned on and
+        # the user isn't running Python with -O.
+        if _tracer:
+            frame = sys._getframe(1)
+            site = _sites.get(frame.f_code)
+            if site is None:
+                site = _site(frame.f_code)
+            _tracer.add(site, frame.f_lineno, s, other_args)
+
+
+def new_span(name):
+    '''Returns a new span id for the work named 'name' (e.g., a record
+    number), or None if logging is not turned on.'''
+    if __debug__:
+        if _tracer:
+            span_id = '{}-{}'.format(_run_id, next(_span_counter))
+            with span(span_id):
+                log('span for {}', name)
+            return span_id
+    return None
+
+
+@contextmanager
+def span(span_id):
+    '''Context manager that tags the messages logged in its body, in the
+    current thread, with 'span_id'.'''
+    previous = getattr(_context, 'span', None)
+    _context.span = span_id
+    try:
+        yield
+    finally:
+        _context.span = previous
+
+
+# Helper classes.
+# .............................................................................
+
+class _StreamTracer():
+    # Writes each message to 'dest' (None for the console) right away.
+
+    def __init__(self, dest, json_lines):
+        self._file = open(dest, 'a') if dest else sys.stderr
+        self._json = json_lines
+        self._lock = threading.Lock()
+
+
+    def add(self, site, line, template, args):
+        entry = _entry(site, line, template, args)
+        text = _json_text(entry) if self._json else _text(entry)
+        with self._lock:
+            self._file.write(text + '\n')
+            self._file.flush()
+
+
+    def close(self):
+        if self._file is not sys.stderr:
+            self._file.close()
+
+
+class _RingTracer():
+    # Keeps the last 'size' messages in memory until flush() is called.
+
+    def __init__(self, dest, size):
+        self._dest = dest
+        self._entries = deque(maxlen = size)
+        self._lock = threading.Lock()
+
+
+    def add(self, site, line, template, args):
+        # deque.append() is atomic, so no lock is needed here.  Arguments
+        # that might change before they're formatted are formatted now.
+        for arg in args:
+            if not isinstance(arg, _IMMUTABLE):
+                args = tuple(a if isinstance(a, _IMMUTABLE) else str(a) for a in args)
+                break
+        self._entries.append(_entry(site, line, template, args))
+
+
+    def flush(self):
+        with self._lock:
+            entries = []
+            while self._entries:
+                entries.append(self._entries.popleft())
+            if entries:
+                with open(self._dest, 'a') as file:
+                    for entry in entries:
+                        file.write(_json_text(entry) + '\n')
+
+
+    def close(self):
+        pass
+
+
+# Helper functions.
+# .............................................................................
+
+def _site(code):
+    # Returns the names reported for the code object 'code' and caches them.
+    site = (path.basename(code.co_filename), code.co_name)
+    _sites[code] = site
+    return site
+
+
+def _entry(site, line, template, args):
+    return (time.time(), threading.current_thread().name,
+            getattr(_context, 'span', None), site, line, template, args)
+
+
+def _message(template, args):
+    try:
+        return template.format(*args)
+    except Exception:
+        # A bad format string shouldn't make us lose the message.
+        return '{} {!r}'.format(template, args)
+
+
+def _text(entry):
+    when, thread, span_id, (file, function), line, template, args = entry
+    return '{} {} {}(): {}'.format(__package__, file, function, _message(template, args))
+
+
+def _json_text(entry):
+    when, thread, span_id, (file, function), line, template, args = entry
+    return json.dumps({'time': round(when, 6), 'thread': thread, 'span': span_id,
+                       'file': file, 'function': function, 'line': line,
+                       'message': _message(template, args)})
+
+
+def _close_tracer():
+    global _tracer
+    if _tracer:
+        _tracer.close()
+    _tracer = None
@@ -14,18 +14,19 @@ open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-import codecs
-from   collections import defaultdict
+from   collections import defaultdict, namedtuple
 from   lxml import etree
 import os
 from   os import path
+import queue
 import shutil
+import threading
 
 import eprints2bags
 from   eprints2bags.data_helpers import parse_datetime
 from   eprints2bags.debug import log
 from   eprints2bags.exceptions import *
-from   eprints2bags.network import net
+from   eprints2bags.network import net, basic_auth, shared_session
 
 
 # Constants.
@@ -34,40 +35,89 @@ from   eprints2bags.network import net
 _EPRINTS_XMLNS = 'http://eprints.org/ep2/data/2.0'
 '''XML namespace used in EPrints XML output.'''
 
+_XHTML_NS = 'http://www.w3.org/1999/xhtml'
+'''XML namespace of the XHTML list of records returned by the server.'''
+
+_LIST_CHUNK_SIZE = 65536
+'''Number of bytes of the list of records read from the network at a time.'''
+
+_LIST_END = object()
+'''Marker put on the queue of record numbers after the last one.'''
+
+_VOLATILE_RELATION = 'http://eprints.org/relation/isVolatileVersionOf'
+'''Type of the relation of a document derived from another one.'''
+
+_XPATH_NS = {'ep': _EPRINTS_XMLNS}
+
+_DOC_URLS = etree.XPath('.//ep:url', namespaces = _XPATH_NS)
+'''Compiled XPath expression for the file URLs of a document.'''
+
+_DOC_DERIVED = etree.XPath('boolean(.//ep:relation//ep:type[. = $type])',
+                           namespaces = _XPATH_NS)
+'''Compiled XPath expression testing whether a document is derived.'''
+
+
+# Exported classes.
+# .............................................................................
+
+RecordSummary = namedtuple('RecordSummary', ['record_id', 'official_url',
+                                             'lastmod', 'rev_number',
+                                             'status', 'documents'])
+RecordSummary.__doc__ = '''The values used by eprints2bags from one EP3 XML
+record, as returned by eprints_summary().  The fields are strings, empty if
+the record does not have them, except 'documents', which is a tuple of the
+URLs of the record's documents, leaving out derived ones.'''
+
 
 # Main functions.
 # .............................................................................
 
-def eprints_api(url, op, user, password):
-    '''Return a full EPrints API URL, complete with user & password, and ending
-    with an operation string given by 'op'.'''
-    start = url.find('//')
-    if start < 0:
+def eprints_api(url, op):
+    '''Return a full EPrints API URL ending with an operation string given by
+    'op'.  Credentials are not put in the URL; they are sent using HTTP Basic
+    authentication (see eprints2bags.network.basic_auth).'''
+    if url.find('//') < 0:
         raise BadURL('Unable to parse "{}" as a normal URL'.format(url))
-    if user and password:
-        return url[:start + 2] + user + ':' + password + '@' + url[start + 2:] + op
-    elif user and not password:
-        return url[:start + 2] + user + '@' + url[start + 2:] + op
-    else:
-        return url[:start + 2] + url[start + 2:] + op
+    return url + op
 
 
 def eprints_raw_list(base_url, user, password):
-    url = eprints_api(base_url, '/eprint', user, password)
-    (response, error) = net('get', url)
-    if not error and response and response.text:
-        if response.text.startswith('<?xml'):
-            return response.content
-    return None
+    '''Start getting the list of records from the server.  Returns an
+    iterator over the bytes of the list, which are read from the network as
+    the iterator is used, or None if the server did not return a list.  If
+    the iterator is not used up, call its close() method.'''
+    url = eprints_api(base_url, '/eprint')
+    # The list is streamed, which needs a requests session even when the
+    # asynchronous network layer is in use.
+    (response, error) = net('get', url, session = shared_session(),
+                            auth = basic_auth(user, password), stream = True)
+    if error or not response:
+        if response:
+            response.close()
+        return None
+    chunks = _response_bytes(response)
+    first = next(chunks, b'')
+    if not first.lstrip().startswith(b'<?xml'):
+        chunks.close()
+        return None
+    return _prepended(first, chunks)
 
 
 def eprints_records_list(raw_list):
+    '''Generate the numbers (as strings) of the records in the list of
+    records 'raw_list', an iterator over bytes such as the one returned by
+    eprints_raw_list().  Numbers are generated as soon as they are parsed,
+    so that records can be processed while the list is still arriving, and
+    the parts of the list already parsed are discarded.  The list is read
+    and parsed on a separate thread as fast as the server sends it, rather
+    than as fast as records are processed, so that the connection is not
+    left idle (and at risk of timing out) for the length of the run; the
+    numbers wait in a queue until they are used.'''
     if not raw_list:
         # This shouldn't happen.
         raise InternalError('Internal error processing server response')
-    xml = etree.fromstring(raw_list)
     # The content from this call is in XHTML format.  It looks like this, and
-    # the following loop extracts the numbers from the <li> elements:
+    # the following loop extracts the numbers from the <a> elements:
     #
     #   <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
     #       "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
@@ -87,16 +137,39 @@ def eprints_records_list(raw_list):
     #   <li><a href='5.xml'>5.xml</a></li>
     #   ...
     #
-    numbers = []
-    for node in xml.findall('.//{http://www.w3.org/1999/xhtml}a'):
-        if 'href' in node.attrib and node.attrib['href'].endswith('xml'):
-            numbers.append(node.attrib['href'].split('.')[0])
-    return numbers
+    numbers = queue.Queue()
+    stop = threading.Event()
+    reader = threading.Thread(target = _read_list, args = (raw_list, numbers, stop),
+                              name = 'list-reader', daemon = True)
+    reader.start()
+    try:
+        while True:
+            item = numbers.get()
+            if item is _LIST_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # If we're stopped early, tell the reader to stop too.
+        stop.set()
 
 
 def eprints_xml(number, base_url, user, password, missing_ok, say):
-    url = eprints_api(base_url, '/eprint/{}.xml'.format(number), user, password)
-    (response, error) = net('get', url)
+    response = eprints_xml_response(number, base_url, user, password, missing_ok, say)
+    return etree.fromstring(response.content) if response != None else None
+
+
+def eprints_xml_response(number, base_url, user, password, missing_ok, say,
+                         headers = None):
+    '''Get the EP3 XML for record 'number' and return the response object,
+    or None if the record is missing and 'missing_ok' is True.  'headers' can
+    be a dict of additional HTTP headers to send, such as If-None-Match; if
+    the server replies that the record has not been modified, the status_code
+    of the response returned is 304 and the response has no content.'''
+    url = eprints_api(base_url, '/eprint/{}.xml'.format(number))
+    (response, error) = net('get', url, auth = basic_auth(user, password),
+                            headers = headers)
     if error:
         if isinstance(error, NoContent):
             if missing_ok:
@@ -115,62 +188,169 @@ def eprints_xml(number, base_url, user, password, missing_ok, say):
                 raise error
         else:
             raise error
-    return etree.fromstring(response.content)
+    return response
+
+
+def eprints_remote_field(number, field, base_url, user, password):
+    '''Ask the server for the value of a single 'field' of record 'number',
+    using the EPrints REST API for individual fields (e.g., a URL ending in
+    /eprint/4/lastmod.txt).  This is much cheaper than getting the whole
+    record.  Returns the value as a string, or None if it can't be obtained.'''
+    url = eprints_api(base_url, '/eprint/{}/{}.txt'.format(number, field))
+    (response, error) = net('get', url, auth = basic_auth(user, password))
+    if error or response == None:
+        if __debug__: log('could not get {} for {}: {}', field, number, error)
+        return None
+    return response.text.strip()
+
+
+def eprints_summary(xml):
+    '''Returns a RecordSummary of the EP3 XML record 'xml', extracted in one
+    pass over the top-level fields of the record.'''
+    eprint = xml.find('{' + _EPRINTS_XMLNS + '}eprint')
+    if eprint is None:
+        return RecordSummary('', '', '', '', '', ())
+    fields = {}
+    documents = []
+    ns_len = len(_EPRINTS_XMLNS) + 2
+    for node in eprint:
+        if not isinstance(node.tag, str):
+            continue                    # Comments and processing instructions.
+        name = node.tag[ns_len:]
+        if name == 'documents':
+            for document in node:
+                url = _document_url(document)
+                if url:
+                    documents.append(url)
+        elif name not in fields:
+            fields[name] = node.text or ''
+    return RecordSummary(eprint.attrib.get('id', ''),
+                         fields.get('official_url', ''),
+                         fields.get('lastmod', ''),
+                         fields.get('rev_number', ''),
+                         fields.get('eprint_status', ''),
+                         tuple(documents))
+
+
+def eprints_field(xml, field):
+    '''Returns the text of the top-level 'field' of the record in 'xml', or
+    an empty string if the record has no such field.'''
+    node = xml.find('{' + _EPRINTS_XMLNS + '}eprint/{' + _EPRINTS_XMLNS + '}' + field)
+    # Do not remove the explicit test for None below.
+    return node.text if node != None and node.text else ''
 
 
 def eprints_lastmod(xml):
-    lastmod_elem = xml.find('.//{' + _EPRINTS_XMLNS + '}lastmod')
-    return parse_datetime(lastmod_elem.text)
+    return parse_datetime(eprints_summary(xml).lastmod)
 
 
 def eprints_status(xml):
-    status = xml.find('.//{' + _EPRINTS_XMLNS + '}eprint_status')
-    return status.text if status != None else ''
+    return eprints_summary(xml).status
 
 
 def eprints_documents(xml):
-    files = []
-    # Ignore documents that are derived versions of original docs. These are
-    # thumbnails and the indexcodes.txt file.
-    for document in xml.findall('.//{' + _EPRINTS_XMLNS + '}document'):
-        url = document.find('.//{' + _EPRINTS_XMLNS + '}url')
-        if url == None:
-            if hasattr(document, 'attrib'):
-                if __debug__: log('Ignoring doc with no file: {}', document.attrib['id'])
-            else:
-                if __debug__: log('Ignoring document {}', document)
-            continue
-        if eprints_derived_file(document):
-            if __debug__: log('Ignoring derived file {}', url.text)
-        else:
-            files.append(url.text)
-    return files
+    return list(eprints_summary(xml).documents)
 
 
 def eprints_derived_file(document):
-    for rel in document.findall('.//{' + _EPRINTS_XMLNS + '}relation'):
-        for type in rel.findall('.//{' + _EPRINTS_XMLNS + '}type'):
-            if type.text == 'http://eprints.org/relation/isVolatileVersionOf':
-                return True
-    return False
+    return _DOC_DERIVED(document, type = _VOLATILE_RELATION)
 
 
 def eprints_record_id(xml):
-    node = xml.find('.//{' + _EPRINTS_XMLNS + '}eprint')
-    return node.attrib['id'] if 'id' in node.attrib else ''
+    return eprints_summary(xml).record_id
 
 
 def eprints_official_url(xml):
-    node = xml.find('.//{' + _EPRINTS_XMLNS + '}official_url')
-    # Do not remove the explicit test for None below.
-    return node.text if node != None else ''
+    return eprints_summary(xml).official_url
 
 
-def write_record(number, xml, dir_prefix, dir_path):
+def write_record(number, content, dir_prefix, dir_path):
+    '''Write the bytes 'content' of record 'number' to its XML file in
+    'dir_path'.'''
     xml_file_name = dir_prefix + str(number) + '.xml'
-    encoded = etree.tostring(xml, encoding = 'UTF-8', method = 'xml')
     file_path = path.join(dir_path, xml_file_name)
     if __debug__: log('Writing file {}', file_path)
-    with codecs.open(file_path, 'w', 'utf-8') as file:
-        file.write("<?xml version='1.0' encoding='utf-8'?>\n")
-        file.write(encoded.decode().rstrip() + '\n')
+    with open(file_path, 'wb') as file:
+        file.write(content)
+
+
+def canonical_record(xml):
+    '''Returns the canonical form (C14N) of the record 'xml' as bytes, which
+    is the same for records that differ only in how they are serialized.'''
+    return etree.tostring(xml, method = 'c14n')
+
+
+# Helper functions.
+# .............................................................................
+
+def _document_url(document):
+    # Returns the URL of the file of 'document', or None if the document has
+    # no file or is a derived version of an original document.  (These are
+    # thumbnails and the indexcodes.txt file.)
+    if not isinstance(document.tag, str):
+        return None
+    urls = _DOC_URLS(document)
+    if not urls:
+        if __debug__: log('Ignoring doc with no file: {}', document.attrib.get('id'))
+        return None
+    if eprints_derived_file(document):
+        if __debug__: log('Ignoring derived file {}', urls[0].text)
+        return None
+    return urls[0].text
+
+
+def _response_bytes(response):
+    # Generate the body of a streamed response in chunks, and close the
+    # response when done or when the generator is closed.
+    try:
+        for chunk in response.iter_content(_LIST_CHUNK_SIZE):
+            yield chunk
+    finally:
+        response.close()
+
+
+def _prepended(first, chunks):
+    # Generate 'first' followed by the items of the generator 'chunks'.
+    yield first
+    yield from chunks
+
+
+def _read_list(raw_list, numbers, stop):
+    # Parse the list of records 'raw_list' and put the numbers found on the
+    # queue 'numbers', followed by _LIST_END, or by the exception raised if
+    # something goes wrong.  Gives up early if the Event 'stop' is set.
+    parser = etree.XMLPullParser(events = ('end',), tag = '{' + _XHTML_NS + '}a')
+    try:
+        for chunk in raw_list:
+            if stop.is_set():
+                if __debug__: log('stopped reading the list of records')
+                break
+            parser.feed(chunk)
+            for number in _listed_numbers(parser):
+                numbers.put(number)
+        else:
+            parser.close()
+            for number in _listed_numbers(parser):
+                numbers.put(number)
+            if __debug__: log('finished reading the list of records')
+        numbers.put(_LIST_END)
+    except BaseException as ex:
+        if __debug__: log('error reading the list of records: {}', str(ex))
+        numbers.put(ex)
+    finally:
+        if hasattr(raw_list, 'close'):
+            raw_list.close()
+
+
+def _listed_numbers(parser):
+    # Generate the record numbers found in the <a> elements parsed so far by
+    # 'parser', and discard the elements.
+    for _, node in parser.read_events():
+        href = node.attrib.get('href', '')
+        if href.endswith('xml'):
+            yield href.split('.')[0]
+        # Drop what's been handled, keeping only the parents of this node.
+        node.clear()
+        parent = node.getparent()
+        while parent is not None and parent.getprevious() is not None:
+            del parent.getparent()[0]
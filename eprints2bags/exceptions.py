@@ -26,6 +26,10 @@ class BadURL(Exception):
     '''Incorrect or malformed URL.'''
     pass
 
+class RequestError(Exception):
+    '''The server rejected a request as malformed.'''
+    pass
+
 class NoContent(Exception):
     '''No content found at the given location.'''
     pass
@@ -14,18 +14,21 @@ open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from   concurrent.futures import ThreadPoolExecutor
+from   contextlib import contextmanager
 import gzip
+import hashlib
 import os
 from   os import path
 from   psutil import disk_partitions
-import shutil
 import sys
 import tarfile
 import tempfile
 import zipfile
-from   zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from   zipfile import ZipFile, ZIP_STORED
 
 import eprints2bags
+from   eprints2bags.compression import ParallelZipFile, compressed_file, zstd_reader
 from   eprints2bags.debug import log
 from   eprints2bags.exceptions import *
 
@@ -49,6 +52,9 @@ KNOWN_SUBDIR_LIMITS = {
 }
 '''Maximum number of subdirectories for different types of file systems.'''
 
+_READ_SIZE = 1048576
+'''Size of the blocks read from archive members when verifying them.'''
+
 
 # Main functions.
 # .............................................................................
@@ -103,61 +109,208 @@ def make_dir(dir_path):
         return
     else:
         if __debug__: log('Creating directory {}', dir_path)
-        # If this gets an exception, let it bubble up to caller.
-        os.makedirs(dir_path)
+        # If this gets an exception, let it bubble up to caller.  Another
+        # thread may create the same directory at the same time.
+        os.makedirs(dir_path, exist_ok = True)
 
 
 def archive_extension(type):
     if type.endswith('zip'):
         return '.zip'
     elif type.endswith('tar'):
-        return '.tar' if type.startswith('uncompressed') else '.tar.gz'
+        if type.startswith('uncompressed'):
+            return '.tar'
+        return '.tar.zst' if type.startswith('zstd') else '.tar.gz'
     else:
         raise InternalError('Unrecognized archive format: {}'.format(type))
 
 
-def create_archive(archive_file, type, source_dir, comment = None):
+def archive_type(file_name):
+    '''Returns the archive type that would produce a file named like
+    'file_name', or None if the name doesn't end in a known extension.  Both
+    kinds of ZIP archives are read the same way, so ".zip" gives
+    "compressed-zip".'''
+    name = file_name.lower()
+    for extension, type in [('.zip', 'compressed-zip'), ('.tar', 'uncompressed-tar'),
+                            ('.tar.gz', 'compressed-tar'), ('.tar.zst', 'zstd-tar')]:
+        if name.endswith(extension):
+            return type
+    return None
+
+
+def create_archive(archive_file, type, source_dir, comment = None,
+                   level = None, threads = 1):
+    '''Write the contents of 'source_dir' to 'archive_file'.  Compressed
+    archives are compressed at 'level' (None means the default level of the
+    compression method) using 'threads' threads.'''
     root_dir = path.dirname(path.normpath(source_dir))
     base_dir = path.basename(source_dir)
     if type.endswith('zip'):
-        format = ZIP_STORED if type.startswith('uncompress') else ZIP_DEFLATED
-        current_dir = os.getcwd()
-        try:
-            if root_dir != '':
-                os.chdir(root_dir)
-            with zipfile.ZipFile(archive_file, 'w', format) as zf:
-                for root, dirs, files in os.walk(base_dir):
-                    for file in files:
-                        zf.write(os.path.join(root, file))
-                if comment:
-                    zf.comment = comment.encode()
-        finally:
-            os.chdir(current_dir)
-    else:
         if type.startswith('uncompress'):
-            shutil.make_archive(source_dir, 'tar', root_dir, base_dir)
+            zip_file = zipfile.ZipFile(archive_file, 'w', ZIP_STORED)
         else:
-            shutil.make_archive(source_dir, 'gztar', root_dir, base_dir)
+            smart = type.startswith('smart')
+            zip_file = ParallelZipFile(archive_file, level, threads, smart)
+        # Names in the archive are relative to root_dir.  This avoids changing
+        # the current directory, which would affect other threads.
+        with zip_file as zf:
+            for root, dirs, files in os.walk(source_dir):
+                for file in files:
+                    file_path = path.join(root, file)
+                    zf.write(file_path, path.relpath(file_path, root_dir or None))
+            if comment:
+                zf.comment = comment.encode()
+    elif type.startswith('uncompress'):
+        with tarfile.open(archive_file, 'w') as tf:
+            tf.add(source_dir, arcname = base_dir)
+    else:
+        with compressed_file(archive_file, type, level, threads) as out:
+            with tarfile.open(fileobj = out, mode = 'w|') as tf:
+                tf.add(source_dir, arcname = base_dir)
+
+
+def verify_archive(archive_file, type, full = True, expected = None,
+                   digests = None, threads = 1):
+    '''Check the integrity of an archive and raise an exception if needed.
+
+    If 'full' is False, only the archive's directory of members is read,
+    and the names and sizes of the members are compared to 'expected', a
+    dict mapping member names to file sizes.  This only shows that the
+    directory can be read and lists what was written; none of the data of
+    the members is checked.
+
+    If 'full' is True, every member of the archive is read, using 'threads'
+    threads for ZIP files, and (for ZIP files) its CRC checked.  The MD5
+    checksums of the members are compared to 'digests', a dict mapping
+    member names to checksums known from when they were bagged.
+    '''
+    if __debug__: log('verifying {} ({})', archive_file, 'full' if full else 'fast')
+    if full:
+        sizes, found, _ = read_archive(archive_file, type, 'md5', threads = threads)
+        wrong = [name for name, digest in (digests or {}).items()
+                 if found.get(name) != digest]
+    else:
+        sizes = archive_members(archive_file, type)
+        wrong = []
+    if expected != None:
+        wrong += [name for name in set(expected) | set(sizes)
+                  if sizes.get(name) != expected.get(name)]
+    if wrong:
+        if __debug__: log('mismatched members in {}: {}', archive_file, wrong)
+        raise CorruptedContent('Failed to verify file "{}"'.format(archive_file))
+
+
+def read_archive(archive_file, type, algorithm = None, keep = None, threads = 1):
+    '''Read every regular file in an archive.  Returns a tuple of 3 dicts,
+    all keyed by member name: the sizes of the members; their checksums
+    using the hashlib algorithm 'algorithm', if it is not None; and the
+    contents of the members for which the function 'keep' returns True.
+    If 'algorithm' is None, only the members to keep are actually read.
+    The members of ZIP files are read by 'threads' threads at once, and
+    their CRC-32 values are checked.  Raises CorruptedContent if the archive
+    cannot be read.'''
+    keep = keep or (lambda name: False)
+    sizes, digests, contents = {}, {}, {}
+
+    def read_member(name, size, opener):
+        # 'opener' is a function returning a stream of the member's contents.
+        hasher = hashlib.new(algorithm) if algorithm else None
+        kept = [] if keep(name) else None
+        if not hasher and kept is None:
+            sizes[name] = size
+            return
+        buffer = bytearray(max(1, min(size, _READ_SIZE)))
+        view = memoryview(buffer)
+        size = 0
+        with opener() as stream:
+            count = stream.readinto(buffer)
+            while count:
+                if hasher:
+                    hasher.update(view[:count])
+                if kept is not None:
+                    kept.append(bytes(view[:count]))
+                size += count
+                count = stream.readinto(buffer)
+        sizes[name] = size
+        if hasher:
+            digests[name] = hasher.hexdigest()
+        if kept is not None:
+            contents[name] = b''.join(kept)
 
+    def read_zip_members(infos):
+        # Each thread needs its own handle on the file.
+        with ZipFile(archive_file) as zf:
+            for info in infos:
+                read_member(info.filename, info.file_size, lambda: zf.open(info))
 
-def verify_archive(archive_file, type):
-    '''Check the integrity of an archive and raise an exception if needed.'''
+    try:
+        if type.endswith('zip'):
+            with ZipFile(archive_file) as zf:
+                infos = [info for info in zf.infolist() if not info.is_dir()]
+            groups = [infos[i::threads] for i in range(threads)]
+            with ThreadPoolExecutor(max_workers = threads) as executor:
+                for future in [executor.submit(read_zip_members, g) for g in groups if g]:
+                    future.result()
+        else:
+            with _reading_tar(archive_file, type) as tf:
+                # Iterating works for tar files read as streams, too.
+                for member in tf:
+                    if member.isfile():
+                        read_member(member.name, member.size,
+                                    lambda: tf.extractfile(member))
+    except Exception as ex:
+        if __debug__: log('unable to read {}: {}', archive_file, str(ex))
+        raise CorruptedContent('Failed to verify file "{}"'.format(archive_file))
+    return (sizes, digests, contents)
+
+
+def archive_members(archive_file, type):
+    '''Returns a dict mapping the names of the regular files in an archive
+    to their sizes, read from the archive's directory of members.'''
     if type.endswith('zip'):
-        error = ZipFile(archive_file).testzip()
-        if error:
-            raise CorruptedContent('Failed to verify file "{}"'.format(archive_file))
+        return {name: info.file_size for name, info in _zip_infos(archive_file).items()}
+    try:
+        with _reading_tar(archive_file, type) as tf:
+            return {info.name: info.size for info in tf if info.isfile()}
+    except Exception as ex:
+        if __debug__: log('unable to read {}: {}', archive_file, str(ex))
+        raise CorruptedContent('Failed to verify file "{}"'.format(archive_file))
+
+
+def directory_members(source_dir):
+    '''Returns a dict mapping the names that the files in 'source_dir' get
+    in an archive made by create_archive() to their sizes.'''
+    root_dir = path.dirname(path.normpath(source_dir))
+    members = {}
+    for root, dirs, files in os.walk(source_dir):
+        for file in files:
+            file_path = path.join(root, file)
+            name = path.relpath(file_path, root_dir or None).replace(os.sep, '/')
+            members[name] = os.stat(file_path).st_size
+    return members
+
+
+# Helper functions.
+# .............................................................................
+
+@contextmanager
+def _reading_tar(archive_file, type):
+    # Zstandard-compressed tar files can only be read as a stream.
+    if type.startswith('zstd'):
+        with zstd_reader(archive_file) as stream:
+            with tarfile.open(fileobj = stream, mode = 'r|') as tf:
+                yield tf
     else:
-        # Algorithm originally from https://stackoverflow.com/a/32312857/743730
-        tfile = None
-        try:
-            tfile = tarfile.open(archive_file)
-            for member in tfile.getmembers():
-                content = tfile.extractfile(member.name)
-                if content:
-                    for chunk in iter(lambda: content.read(1024), b''):
-                        pass
-        except Exception as ex:
-            raise CorruptedContent('Failed to verify file "{}"'.format(archive_file))
-        finally:
-            if tfile:
-                tfile.close()
+        with tarfile.open(archive_file) as tf:
+            yield tf
+
+
+def _zip_infos(archive_file):
+    # Returns a dict mapping the names of the files in a ZIP archive to their
+    # ZipInfo objects, read from the archive's central directory.
+    try:
+        with ZipFile(archive_file) as zf:
+            return {info.filename: info for info in zf.infolist() if not info.is_dir()}
+    except Exception as ex:
+        if __debug__: log('unable to read {}: {}', archive_file, str(ex))
+        raise CorruptedContent('Failed to verify file "{}"'.format(archive_file))
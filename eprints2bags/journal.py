@@ -0,0 +1,136 @@
+'''
+journal.py: persistent record of the progress of a run
+
+The journal is a small SQLite database kept in the output directory.  As each
+record passes through the stages of processing, the journal is updated, so
+that if a run is interrupted, a later run can pick up where it left off
+instead of starting over.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import os
+from   os import path
+import sqlite3
+import threading
+from   time import time
+
+import eprints2bags
+from   eprints2bags.debug import log
+
+
+# Constants.
+# .............................................................................
+
+JOURNAL_FILE = '.eprints2bags-journal.db'
+'''Name of the journal file written in the output directory.'''
+
+STAGES = ['fetched', 'downloaded', 'bagged', 'archived']
+'''Stages of processing a record, in order.  A record's stage in the journal
+is the last one completed: "fetched" means the XML has been written,
+"downloaded" that the documents have been downloaded, and so on.'''
+
+MISSING = 'missing'
+'''Journal value for records that could not be obtained from the server.'''
+
+SKIPPED = 'skipped'
+'''Journal value for records left out due to the -l or -s filters.'''
+
+UNCHANGED = 'unchanged'
+'''Journal value for records left out because they haven't changed since
+they were last written (when using incremental mode).'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Journal():
+    '''Persistent record of the stage reached by each record in a run.  The
+    database is written to the file 'file_path'.  If 'resume' is False, any
+    existing journal at that location is discarded.  Methods can be called
+    from multiple threads.
+    '''
+
+    def __init__(self, file_path, resume = False):
+        self.file_path = file_path
+        if not resume:
+            remove_journal(file_path)
+        if __debug__: log('opening journal {}', file_path)
+        # Autocommit mode: every update is written out immediately, so that
+        # the journal is accurate even if the process is killed.
+        self._db = sqlite3.connect(file_path, isolation_level = None,
+                                   check_same_thread = False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS records'
+                         ' (number TEXT PRIMARY KEY, stage TEXT, name TEXT,'
+                         ' updated REAL)')
+        self._lock = threading.Lock()
+
+
+    def stage(self, number):
+        '''Returns the stage reached by record 'number' in this or a previous
+        run, or None if the journal has no entry for it.'''
+        with self._lock:
+            row = self._db.execute('SELECT stage FROM records WHERE number = ?',
+                                   (str(number),)).fetchone()
+        return row[0] if row else None
+
+
+    def stages(self):
+        '''Returns a dict mapping record numbers to stages, for all records.'''
+        with self._lock:
+            rows = self._db.execute('SELECT number, stage FROM records').fetchall()
+        return dict(rows)
+
+
+    def name(self, number):
+        '''Returns the name of the output directory used for record 'number',
+        or None if the journal has no name for it.'''
+        with self._lock:
+            row = self._db.execute('SELECT name FROM records WHERE number = ?',
+                                   (str(number),)).fetchone()
+        return row[0] if row else None
+
+
+    def record(self, number, stage, name = None):
+        '''Note that record 'number' has reached 'stage'.  'name' is the name
+        of the output directory for the record, if there is one.'''
+        if __debug__: log('journal: {} is {}', number, stage)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+                             (str(number), stage, name, time()))
+
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Exported functions.
+# .............................................................................
+
+def remove_journal(file_path):
+    '''Delete the journal at 'file_path' and SQLite's auxiliary files.'''
+    for suffix in ['', '-wal', '-shm']:
+        if path.exists(file_path + suffix):
+            if __debug__: log('deleting {}', file_path + suffix)
+            os.remove(file_path + suffix)
+
+
+def stage_done(current, stage):
+    '''Returns True if a record whose last completed stage is 'current' has
+    already done 'stage'.'''
+    if current not in STAGES:
+        return False
+    return STAGES.index(current) >= STAGES.index(stage)
@@ -0,0 +1,104 @@
+'''
+layout.py: placement of the outputs of records in the output directory
+
+In the "flat" layout, the directory or archive file of each record is put
+directly in the output directory.  In the "sharded" layout, it is put two
+levels of subdirectories further down, chosen from the record number so that
+no directory holds more than about a thousand records: record 54602 goes in
+000/054/, record 1234567 in 001/234/, and so on.  The layout used is saved
+in a small file in the output directory, so that later runs in the same
+directory (to resume or to harvest incrementally) use the same layout.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import os
+from   os import path
+
+import eprints2bags
+from   eprints2bags.debug import log
+
+
+# Constants.
+# .............................................................................
+
+LAYOUT_FILE = '.eprints2bags-layout'
+'''Name of the file recording the layout used in the output directory.'''
+
+LAYOUTS = ['flat', 'sharded']
+'''Possible layouts of the output directory.'''
+
+MAX_FLAT_RECORDS = 10000
+'''Largest number of records for which the "auto" layout choice is "flat".'''
+
+_SHARD_SIZE = 1000
+'''Number of consecutive record numbers put in the same subdirectory.'''
+
+_EXTENSIONS = ['', '.zip', '.tar', '.tar.gz', '.tar.zst']
+'''Extensions of the outputs of a record: a directory or an archive file.'''
+
+
+# Exported functions.
+# .............................................................................
+
+def shard(number):
+    '''Returns the path, relative to the output directory, of the
+    subdirectory for record 'number' in the sharded layout.'''
+    value = int(number) if str(number).isdigit() else 0
+    return path.join('{:03d}'.format(value // (_SHARD_SIZE * _SHARD_SIZE)),
+                     '{:03d}'.format(value // _SHARD_SIZE % _SHARD_SIZE))
+
+
+def record_path(output_dir, number, name, sharded):
+    '''Returns the path of the output of record 'number', named 'name', in
+    'output_dir', sans any archive file extension.'''
+    if sharded:
+        return path.join(output_dir, shard(number), name)
+    return path.join(output_dir, name)
+
+
+def find_record(output_dir, number, name):
+    '''Returns the path of the existing directory or archive file for record
+    'number', named 'name', in 'output_dir', looking in the places it would be
+    in either layout.  Returns None if there is no such file.'''
+    for sharded in [True, False]:
+        base = record_path(output_dir, number, name, sharded)
+        for extension in _EXTENSIONS:
+            if path.exists(base + extension):
+                return base + extension
+    return None
+
+
+def saved_layout(output_dir):
+    '''Returns the layout recorded in 'output_dir', or None if none is.'''
+    file_path = path.join(output_dir, LAYOUT_FILE)
+    if not path.exists(file_path):
+        return None
+    with open(file_path, 'r') as file:
+        layout = file.read().strip()
+    return layout if layout in LAYOUTS else None
+
+
+def save_layout(output_dir, layout):
+    '''Record in 'output_dir' that it uses 'layout'.'''
+    if __debug__: log('Using {} layout in {}', layout, output_dir)
+    with open(path.join(output_dir, LAYOUT_FILE), 'w') as file:
+        file.write(layout + '\n')
+
+
+def remove_layout(output_dir):
+    '''Delete the file recording the layout used in 'output_dir'.'''
+    file_path = path.join(output_dir, LAYOUT_FILE)
+    if path.exists(file_path):
+        if __debug__: log('deleting {}', file_path)
+        os.remove(file_path)
@@ -0,0 +1,111 @@
+'''
+manifest.py: index of the records written by previous runs
+
+The manifest is a small SQLite database kept in the output directory.  Every
+time a record is written, the manifest gets an entry with the name of the
+output (directory or archive file), the record's lastmod and rev_number
+values, the HTTP validators (ETag and Last-Modified) sent by the server with
+the record, and the checksums of the record's documents.  Incremental runs
+use this information to avoid fetching records that haven't changed.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import namedtuple
+import json
+import sqlite3
+import threading
+from   time import time
+
+import eprints2bags
+from   eprints2bags.debug import log
+
+
+# Constants.
+# .............................................................................
+
+MANIFEST_FILE = '.eprints2bags-manifest.db'
+'''Name of the manifest file written in the output directory.'''
+
+
+# Exported classes.
+# .............................................................................
+
+ManifestEntry = namedtuple('ManifestEntry', ['number', 'name', 'lastmod',
+                                             'rev_number', 'etag',
+                                             'last_modified', 'documents'])
+ManifestEntry.__doc__ = '''Information about one version of a record written
+in a previous run.  'documents' is a dict mapping document file names to
+their SHA-256 checksums.'''
+
+
+class Manifest():
+    '''Index of the records written to an output directory, across runs.  Each
+    version of a record written is kept as a separate entry.  Methods can be
+    called from multiple threads.
+    '''
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        if __debug__: log('opening manifest {}', file_path)
+        self._db = sqlite3.connect(file_path, isolation_level = None,
+                                   check_same_thread = False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS records'
+                         ' (number TEXT, name TEXT, lastmod TEXT, rev_number TEXT,'
+                         ' etag TEXT, last_modified TEXT, documents TEXT,'
+                         ' updated REAL, PRIMARY KEY (number, name))')
+        self._lock = threading.Lock()
+
+
+    def entry(self, number):
+        '''Returns the ManifestEntry for the most recently written version of
+        record 'number', or None if the record has never been written.'''
+        entries = self.entries(number)
+        return entries[-1] if entries else None
+
+
+    def entries(self, number):
+        '''Returns a list of ManifestEntry objects for all the versions of
+        record 'number' written, oldest first.'''
+        with self._lock:
+            rows = self._db.execute('SELECT number, name, lastmod, rev_number,'
+                                    ' etag, last_modified, documents FROM records'
+                                    ' WHERE number = ? ORDER BY updated',
+                                    (str(number),)).fetchall()
+        return [ManifestEntry(*row[:-1], json.loads(row[-1] or '{}')) for row in rows]
+
+
+    def has_name(self, name):
+        '''Returns True if some record was written using output name 'name'.'''
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM records WHERE name = ?',
+                                   (name,)).fetchone()
+        return row is not None
+
+
+    def update(self, entry):
+        '''Add or replace the information for the record version described by
+        the ManifestEntry 'entry'.'''
+        if __debug__: log('manifest: {} written as {}', entry.number, entry.name)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (str(entry.number), entry.name, entry.lastmod,
+                              entry.rev_number, entry.etag, entry.last_modified,
+                              json.dumps(entry.documents or {}), time()))
+
+
+    def close(self):
+        with self._lock:
+            self._db.close()
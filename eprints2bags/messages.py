@@ -16,6 +16,7 @@ file "LICENSE" for more information.
 
 import queue
 import sys
+import threading
 
 try:
     from termcolor import colored
@@ -114,6 +115,9 @@ class MessageHandler():
 # Message utility funcions.
 # .............................................................................
 
+_print_lock = threading.Lock()
+'''Lock used to keep messages printed by different threads from mixing.'''
+
 def msg(text, flags = None, colorize = True):
     '''Like the standard print(), but flushes the output immediately and
     colorizes the output by default. Flushing immediately is useful when
@@ -121,10 +125,11 @@ def msg(text, flags = None, colorize = True):
     output in that situation and this makes it very difficult to see what is
     happening in real time.
     '''
-    if colorize and 'termcolor' in sys.modules:
-        print(color(text, flags), flush = True)
-    else:
-        print(text, flush = True)
+    with _print_lock:
+        if colorize and 'termcolor' in sys.modules:
+            print(color(text, flags), flush = True)
+        else:
+            print(text, flush = True)
 
 
 def color(text, flags = None, colorize = True):
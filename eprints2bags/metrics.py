@@ -0,0 +1,304 @@
+'''
+metrics.py: counters and latency histograms for the operations of a run
+
+The main operations done for each record (getting the fields needed by the
+filters, getting and parsing its XML, downloading its documents, making and validating its bag, creating and
+verifying its archive file, and deleting its directory) are timed using
+timed().  For each kind of operation, this module keeps the number of times
+it was done, the number that failed, the total number of bytes involved, and
+a histogram of how long it took.  Together with the statistics of the stages
+of the pipeline and the time spent retrying network requests, these can be
+written out as a JSON summary at the end of a run, or as a file in the
+Prometheus text exposition format that is rewritten periodically during the
+run (for the "textfile" collector of the Prometheus node exporter).
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   bisect import bisect_left
+from   collections import namedtuple, OrderedDict
+from   contextlib import contextmanager
+from   datetime import datetime
+import json
+import os
+import threading
+import time
+
+import eprints2bags
+from   eprints2bags.debug import log
+from   eprints2bags.network import retry_stats
+
+
+# Constants.
+# .............................................................................
+
+OPERATIONS = OrderedDict([
+    ('filter',         'getting the fields of records needed by the filters'),
+    ('fetch',          'getting the XML of records from the server'),
+    ('parse',          'parsing the XML of records'),
+    ('download',       'downloading documents'),
+    ('make_bag',       'making bags'),
+    ('validate',       'validating bags'),
+    ('create_archive', 'writing archive files'),
+    ('verify_archive', 'verifying archive files'),
+    ('rmtree',         'deleting record directories after archiving them'),
+])
+'''Operations timed by timed(), with descriptions.'''
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600]
+'''Upper bounds (in seconds) of the buckets of the latency histograms.  The
+last bucket, for anything longer, is implicit.'''
+
+PROMETHEUS_INTERVAL = 15
+'''Number of seconds between updates of the Prometheus textfile.'''
+
+_PREFIX = 'eprints2bags_'
+'''Prefix of the names of the Prometheus metrics.'''
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+'''Format of the times in the JSON summary.'''
+
+
+# Internal module variables.
+# .............................................................................
+
+_lock = threading.Lock()
+'''Lock used to update the totals below.'''
+
+_totals = {}
+'''Dict mapping names in OPERATIONS to lists [count, errors, seconds,
+max_seconds, bytes, buckets].'''
+
+_started = time.time()
+'''Time at which the totals started being collected.'''
+
+
+# Exported classes.
+# .............................................................................
+
+OperationStats = namedtuple('OperationStats', ['count', 'errors', 'seconds',
+                                               'max_seconds', 'bytes', 'buckets'])
+OperationStats.__doc__ = '''Totals for one of the operations in OPERATIONS:
+the number of times it was done, the number of times it raised an exception,
+the total and longest time it took, the number of bytes involved, and the
+number of times that fell in each bucket of LATENCY_BUCKETS (a list with one
+more element than LATENCY_BUCKETS, for times longer than the last bound).'''
+
+
+class Timing():
+    '''Object given by timed() to the code being timed, which can set the
+    number of bytes involved in the operation in its 'bytes' attribute.  The
+    time the operation took is in its 'seconds' attribute when it ends.'''
+
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = None
+
+
+class PrometheusWriter():
+    '''Rewrites 'file' with the metrics in the Prometheus text format every
+    'interval' seconds, in a background thread, until stop() is called.
+    'stages' is a function returning the current Pipeline.stats(), or an
+    empty dict if there is no pipeline (yet).'''
+
+    def __init__(self, file, stages, interval = PROMETHEUS_INTERVAL):
+        self._file     = file
+        self._stages   = stages
+        self._interval = interval
+        self._stopped  = threading.Event()
+        self._thread   = threading.Thread(target = self._run, name = 'metrics',
+                                          daemon = True)
+        self._thread.start()
+
+
+    def stop(self):
+        '''Stop the periodic updates and write the file one last time.'''
+        self._stopped.set()
+        self._thread.join()
+        write_prometheus(self._file, self._stages())
+
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                write_prometheus(self._file, self._stages())
+            except Exception as ex:
+                # Failing to write metrics is no reason to stop the run.
+                if __debug__: log('unable to write {}: {}', self._file, str(ex))
+
+
+# Exported functions.
+# .............................................................................
+
+@contextmanager
+def timed(operation):
+    '''Context manager that times the code in its body as one instance of
+    'operation', a name in OPERATIONS.  It yields a Timing object.  If the
+    body raises an exception, the operation is counted as having failed.'''
+    timing = Timing()
+    failed = False
+    start = time.perf_counter()
+    try:
+        yield timing
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        timing.seconds = time.perf_counter() - start
+        _add(operation, timing.seconds, timing.bytes, failed)
+
+
+def operation_stats():
+    '''Returns an OrderedDict mapping the names in OPERATIONS to
+    OperationStats for the process so far.'''
+    with _lock:
+        return OrderedDict((name, _stats(_totals.get(name))) for name in OPERATIONS)
+
+
+def reset_metrics():
+    '''Set all the totals kept by this module back to zero.'''
+    global _started
+    with _lock:
+        _totals.clear()
+        _started = time.time()
+
+
+def summary(stages = {}):
+    '''Returns an OrderedDict with the metrics of the run so far, suitable
+    for writing as JSON.  'stages' is the value of Pipeline.stats().'''
+    now = time.time()
+    operations = OrderedDict()
+    for name, totals in operation_stats().items():
+        operations[name] = OrderedDict([
+            ('count',           totals.count),
+            ('errors',          totals.errors),
+            ('seconds',         totals.seconds),
+            ('mean_seconds',    totals.seconds / totals.count if totals.count else None),
+            ('max_seconds',     totals.max_seconds),
+            ('bytes',           totals.bytes),
+            ('bytes_per_sec',   totals.bytes / totals.seconds if totals.seconds else None),
+            ('latency_buckets', OrderedDict(zip(_bucket_labels(), totals.buckets))),
+        ])
+    return OrderedDict([
+        ('started',    datetime.fromtimestamp(_started).strftime(_TIME_FORMAT)),
+        ('finished',   datetime.fromtimestamp(now).strftime(_TIME_FORMAT)),
+        ('seconds',    now - _started),
+        ('operations', operations),
+        ('stages',     OrderedDict((name, totals._asdict())
+                                   for name, totals in stages.items())),
+        ('retries',    OrderedDict((name, totals._asdict())
+                                   for name, totals in retry_stats().items())),
+    ])
+
+
+def write_summary(file, stages = {}):
+    '''Write the summary() of the metrics as JSON to 'file'.'''
+    if __debug__: log('writing metrics summary to {}', file)
+    with open(file, 'w') as out:
+        json.dump(summary(stages), out, indent = 2)
+        out.write('\n')
+
+
+def prometheus_text(stages = {}):
+    '''Returns the metrics of the run so far in the Prometheus text format.
+    'stages' is the value of Pipeline.stats().'''
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP {}{} {}'.format(_PREFIX, name, help_text))
+        lines.append('# TYPE {}{} {}'.format(_PREFIX, name, kind))
+        for suffix, labels, value in samples:
+            lines.append('{}{}{}{} {}'.format(_PREFIX, name, suffix,
+                                              _label_text(labels), _number(value)))
+
+    operations = operation_stats()
+    samples = []
+    for name, totals in operations.items():
+        cumulative = 0
+        for label, count in zip(_bucket_labels(), totals.buckets):
+            cumulative += count
+            samples.append(('_bucket', [('operation', name), ('le', label)], cumulative))
+        samples.append(('_sum', [('operation', name)], totals.seconds))
+        samples.append(('_count', [('operation', name)], totals.count))
+    metric('operation_seconds', 'histogram', 'Time taken by each operation.', samples)
+    metric('operation_errors_total', 'counter', 'Number of operations that failed.',
+           [('', [('operation', name)], totals.errors) for name, totals in operations.items()])
+    metric('operation_bytes_total', 'counter', 'Number of bytes involved in operations.',
+           [('', [('operation', name)], totals.bytes) for name, totals in operations.items()])
+    metric('stage_items_total', 'counter', 'Number of records processed by each pipeline stage.',
+           [('', [('stage', name)], totals.items) for name, totals in stages.items()])
+    metric('stage_seconds_total', 'counter', 'Time spent by the workers of each pipeline stage.',
+           [('', [('stage', name)], totals.seconds) for name, totals in stages.items()])
+    metric('stage_cpu_seconds_total', 'counter', 'CPU time used by the workers of each pipeline stage.',
+           [('', [('stage', name)], totals.cpu_seconds) for name, totals in stages.items()
+            if totals.cpu_seconds is not None])
+    retries = retry_stats()
+    metric('retries_total', 'counter', 'Number of times each retry path was taken.',
+           [('', [('path', name)], totals.count) for name, totals in retries.items()])
+    metric('retry_seconds_total', 'counter', 'Time spent in each retry path.',
+           [('', [('path', name)], totals.seconds) for name, totals in retries.items()])
+    metric('start_time_seconds', 'gauge', 'Time at which the run started.',
+           [('', [], _started)])
+    metric('last_update_time_seconds', 'gauge', 'Time at which this file was written.',
+           [('', [], time.time())])
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(file, stages = {}):
+    '''Write the prometheus_text() of the metrics to 'file'.  The file is
+    replaced at once, so that readers never see a partly written file.'''
+    if __debug__: log('writing Prometheus metrics to {}', file)
+    temp_file = '{}.{}.tmp'.format(file, os.getpid())
+    with open(temp_file, 'w') as out:
+        out.write(prometheus_text(stages))
+    os.replace(temp_file, file)
+
+
+# Helper functions.
+# .............................................................................
+
+def _add(operation, seconds, nbytes, failed):
+    bucket = bisect_left(LATENCY_BUCKETS, seconds)
+    with _lock:
+        totals = _totals.get(operation)
+        if totals is None:
+            totals = _totals[operation] = [0, 0, 0.0, 0.0, 0, [0] * (len(LATENCY_BUCKETS) + 1)]
+        totals[0] += 1
+        totals[1] += 1 if failed else 0
+        totals[2] += seconds
+        totals[3] = max(totals[3], seconds)
+        totals[4] += nbytes or 0
+        totals[5][bucket] += 1
+
+
+def _stats(totals):
+    if totals is None:
+        return OperationStats(0, 0, 0.0, 0.0, 0, [0] * (len(LATENCY_BUCKETS) + 1))
+    return OperationStats(*(totals[:5] + [list(totals[5])]))
+
+
+def _bucket_labels():
+    return [_number(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in labels) + '}'
+
+
+def _number(value):
+    # Whole numbers are written without a trailing ".0".
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
@@ -14,24 +14,35 @@ open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+import asyncio
+from   collections import namedtuple, OrderedDict
 import http.client
+import os
 from   http.client import responses as http_responses
 from   os import path, stat
 import requests
 from   requests.packages.urllib3.exceptions import InsecureRequestWarning
-from   time import sleep
+from   time import sleep, perf_counter
 import shutil
 import socket
 import ssl
+import threading
 import urllib
 from   urllib.parse import urlsplit
 import urllib3
 import validators
 import warnings
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 import eprints2bags
+from   eprints2bags.checksums import Digester, file_digests
 from   eprints2bags.debug import log
 from   eprints2bags.exceptions import *
+from   eprints2bags.ratelimit import RateLimiter, retry_after_seconds
 
 
 # Constants.
@@ -48,6 +59,85 @@ _MAX_RETRIES = 5
 '''Maximum number of times we back off and try again.  This also affects the
 maximum wait time that will be reached after repeated retries.'''
 
+_DEFAULT_POOL_SIZE = 10
+'''Default maximum number of connections kept open to any one host.'''
+
+_DEFAULT_SEGMENT_THRESHOLD = 64 * 1048576
+'''Default size above which documents are downloaded in several parts.'''
+
+_DEFAULT_NUM_SEGMENTS = 4
+'''Default number of parts, and connections, used for large documents.'''
+
+_PART_SUFFIX = '.part'
+'''Suffix of the names of files being downloaded.'''
+
+_VALIDATOR_SUFFIX = '.validator'
+'''Suffix added to _PART_SUFFIX for the file that holds the HTTP validator
+(ETag or Last-Modified) of an interrupted download.'''
+
+_DEFAULT_CHUNK_SIZE = 1048576
+'''Default size of the buffer used by download() to read from the network.'''
+
+RETRY_PATHS = OrderedDict([
+    ('failed',     'failed requests that were retried'),
+    ('backoff',    'pauses after repeated request failures'),
+    ('reset',      'pauses after connections were reset'),
+    ('throttled',  'pauses after HTTP codes 429 and 503'),
+    ('rate-limit', 'waits imposed by the rate limiter'),
+    ('accepted',   'pauses after HTTP code 202'),
+    ('redownload', 'failed document downloads that were retried'),
+])
+'''Ways in which time can be lost to server or network trouble, as counted by
+retry_stats(), with descriptions.'''
+
+
+# Internal module variables.
+# .............................................................................
+
+_session = None
+'''Process-wide requests.Session object used when callers don't supply one.'''
+
+_session_lock = threading.Lock()
+'''Lock used to make creation of the shared session thread-safe.'''
+
+_chunk_size = _DEFAULT_CHUNK_SIZE
+'''Size of the buffer used by download() and async_download().'''
+
+_segment_threshold = _DEFAULT_SEGMENT_THRESHOLD
+'''Size (in bytes) above which download() gets documents in several parts
+at once, or None to never do that.'''
+
+_num_segments = _DEFAULT_NUM_SEGMENTS
+'''Number of parts in which download() gets large documents.'''
+
+_seek_lock = threading.Lock()
+'''Lock used by _pwrite() on systems that lack os.pwrite().'''
+
+_rate_limiter = None
+'''RateLimiter object applied to every request, if set_rate_limits() has been
+called.'''
+
+_async_network = None
+'''AsyncNetwork object used by net() and download(), if use_async_network()
+has been called.'''
+
+_retry_counts = {name: 0 for name in RETRY_PATHS}
+'''Number of times each of the paths in RETRY_PATHS has been taken.'''
+
+_retry_seconds = {name: 0.0 for name in RETRY_PATHS}
+'''Time spent in each of the paths in RETRY_PATHS.'''
+
+_retry_lock = threading.Lock()
+'''Lock used to update _retry_counts and _retry_seconds.'''
+
+
+# Exported classes.
+# .............................................................................
+
+RetryTotals = namedtuple('RetryTotals', ['count', 'seconds'])
+RetryTotals.__doc__ = '''The number of times one of the paths in RETRY_PATHS
+was taken, and the total time spent in it, as returned by retry_stats().'''
+
 
 # Main functions.
 # .............................................................................
@@ -72,6 +162,80 @@ def network_available(address = "8.8.8.8", port = 53, timeout = 5):
         return False
 
 
+def configure_session(pool_size = _DEFAULT_POOL_SIZE):
+    '''Create the process-wide session used by net() and download() when no
+    session is given to them explicitly.  'pool_size' is the maximum number
+    of connections kept alive to any one host; it should be at least as large
+    as the number of threads making requests concurrently.  Calling this
+    function again replaces the session.
+    '''
+    global _session
+    session = _new_session(pool_size)
+    with _session_lock:
+        old_session = _session
+        _session = session
+    if old_session:
+        old_session.close()
+    return session
+
+
+def shared_session():
+    '''Return the process-wide session, creating it if necessary.  The
+    session keeps connections to servers open between requests, so that
+    successive requests avoid the cost of new TCP and TLS handshakes.
+    '''
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _new_session(_DEFAULT_POOL_SIZE)
+    return _session
+
+
+def set_rate_limits(requests_per_sec, bytes_per_sec = None):
+    '''Limit all requests made by this module to 'requests_per_sec' requests
+    per second and (if 'bytes_per_sec' is not None) the data read by
+    download() to 'bytes_per_sec' bytes per second.  The request rate adapts
+    to the server: it is reduced when the server responds with HTTP code 429
+    or 503, and increased again, up to 'requests_per_sec', after successful
+    requests.  A value of None for 'requests_per_sec' removes all limits.
+    '''
+    global _rate_limiter
+    if requests_per_sec:
+        if __debug__: log('limiting rates to {} requests/s and {} bytes/s',
+                          requests_per_sec, bytes_per_sec)
+        _rate_limiter = RateLimiter(requests_per_sec, bytes_per_sec)
+    else:
+        _rate_limiter = None
+    return _rate_limiter
+
+
+def set_chunk_size(size):
+    '''Make download() read documents from the network 'size' bytes at a
+    time.  Larger values mean fewer iterations of Python code per byte.'''
+    global _chunk_size
+    if __debug__: log('setting download chunk size to {}', size)
+    _chunk_size = int(size)
+
+
+def set_segments(threshold, count = _DEFAULT_NUM_SEGMENTS):
+    '''Make download() get documents larger than 'threshold' bytes in 'count'
+    parts at once, using separate connections, when the server allows it.  A
+    'threshold' of None turns this off.'''
+    global _segment_threshold, _num_segments
+    if __debug__: log('segmenting downloads over {} bytes into {} parts',
+                      threshold, count)
+    _segment_threshold = threshold
+    _num_segments = count
+
+
+def basic_auth(user, password):
+    '''Return a value suitable for the 'auth' argument of requests calls,
+    for HTTP Basic authentication using the given 'user' and 'password'.  If
+    'user' is empty, returns None (meaning, no authentication).'''
+    return requests.auth.HTTPBasicAuth(user, password or '') if user else None
+
+
 def url_host(url):
     parts = urlsplit(url)
     if parts.netloc:
@@ -85,9 +249,26 @@ def host_from_netloc(nl):
     return nl[:nl.find(':')] if ':' in nl else nl
 
 
+def retry_stats():
+    '''Returns an OrderedDict mapping the names in RETRY_PATHS to RetryTotals
+    for the process so far.'''
+    with _retry_lock:
+        return OrderedDict((name, RetryTotals(_retry_counts[name], _retry_seconds[name]))
+                           for name in RETRY_PATHS)
+
+
+def reset_retry_stats():
+    '''Set the counts and times returned by retry_stats() back to zero.'''
+    with _retry_lock:
+        for name in RETRY_PATHS:
+            _retry_counts[name] = 0
+            _retry_seconds[name] = 0.0
+
+
 def timed_request(get_or_post, url, session = None, timeout = 20, **kwargs):
     '''Perform a network "get" or "post", handling timeouts and retries.
-    If "session" is not None, it is used as a requests.Session object.
+    If "session" is not None, it is used as a requests.Session object;
+    otherwise, the shared session returned by shared_session() is used.
     "Timeout" is a timeout (in seconds) on the network requests get or post.
     Other keyword arguments are passed to the network call.
     '''
@@ -103,17 +284,22 @@ def timed_request(get_or_post, url, session = None, timeout = 20, **kwargs):
                 # https://github.com/kennethreitz/requests/issues/2214
                 warnings.simplefilter("ignore", InsecureRequestWarning)
                 if __debug__: log('doing http {} on {}', get_or_post, url)
-                if session:
-                    method = getattr(session, get_or_post)
-                else:
-                    method = requests.get if get_or_post == 'get' else requests.post
+                method = getattr(session or shared_session(), get_or_post)
+                if _rate_limiter:
+                    start = perf_counter()
+                    if _rate_limiter.acquire():
+                        _count_retry('rate-limit', perf_counter() - start)
+                start = perf_counter()
                 response = method(url, timeout = timeout, verify = False, **kwargs)
                 if __debug__: log('response received')
+                _note_response(response.status_code, response.headers,
+                               perf_counter() - start)
                 return response
         except Exception as ex:
             # Problem might be transient.  Don't quit right away.
             failures += 1
             if __debug__: log('exception (failure #{}): {}', failures, str(ex))
+            _count_retry('failed', perf_counter() - start)
             # Record the first error we get, not the subsequent ones, because
             # in the case of network outages, the subsequent ones will be
             # about being unable to reconnect and not the original problem.
@@ -125,13 +311,18 @@ def timed_request(get_or_post, url, session = None, timeout = 20, **kwargs):
                 retries += 1
                 failures = 0
                 if __debug__: log('pausing because of consecutive failures')
-                sleep(10 * retries * retries)
+                _pause('backoff', 10 * retries * retries)
             else:
                 # We've already paused & restarted once.
                 raise error
 
 
-def download_files(downloads_list, user, pswd, output_dir, missing_ok, say):
+def download_files(downloads_list, user, pswd, output_dir, missing_ok, say,
+                   algorithms = []):
+    '''Download the URLs in 'downloads_list' into 'output_dir'.  Returns a
+    dict mapping the names of the files written to dicts of their checksums,
+    computed using the algorithms named in 'algorithms' while downloading.'''
+    digests = {}
     for item in downloads_list:
         file = path.realpath(path.join(output_dir, path.basename(item)))
         say.info('Downloading {}', item)
@@ -141,14 +332,23 @@ def download_files(downloads_list, user, pswd, output_dir, missing_ok, say):
             # Don't retry unless the problem may be transient.
             retry = False
             error = None
+            start = perf_counter()
             try:
-                download(item, user, pswd, file)
+                checksums = download(item, user, pswd, file, algorithms = algorithms)
+                if checksums:
+                    digests[path.basename(file)] = checksums
             except (NoContent, ServiceFailure, AuthenticationFailure) as ex:
                 if missing_ok:
                     say.error(str(ex))
+                    # Don't leave a partial file to end up in the bag.
+                    PartialDownload(file).discard()
                     failures = 0
                 else:
                     error = ex
+            except RateLimitExceeded as ex:
+                # download() has already waited and retried.  The document
+                # exists, so it must not be left out as if it were missing.
+                error = ex
             except Exception as ex:
                 # Something unexpected.  Don't retry this entry, but count
                 # this failure in case we're up against a roadblock.
@@ -156,18 +356,101 @@ def download_files(downloads_list, user, pswd, output_dir, missing_ok, say):
                 error = ex
                 failures += 1
                 retry = True
+                if failures < _MAX_FAILURES:
+                    _count_retry('redownload', perf_counter() - start)
         if error:
             raise error
         continue
+    return digests
 
 
-def download(url, user, password, local_destination, recursing = 0):
-    '''Download the 'url' to the file 'local_destination'.'''
+def stream_files(downloads_list, user, pswd, add_file, missing_ok, say):
+    '''Download the URLs in 'downloads_list' without writing them to disk.
+    For each document, calls 'add_file' with the file name, an iterator over
+    the contents of the document (see document_chunks()) and the size of the
+    document, or None if the size is unknown.'''
+    for item in downloads_list:
+        say.info('Downloading {}', item)
+        try:
+            req = open_document(item, user, pswd)
+        except (NoContent, ServiceFailure, AuthenticationFailure) as ex:
+            if not missing_ok:
+                raise
+            say.error(str(ex))
+            continue
+        add_file(path.basename(item), document_chunks(req), content_length(req))
+
+
+def download(url, user, password, local_destination, recursing = 0, algorithms = []):
+    '''Download the 'url' to the file 'local_destination'.  Returns a dict
+    mapping the names in 'algorithms' (a list of hashlib algorithm names) to
+    the hexadecimal digests of the data, computed as it is received.'''
+    if _async_network and not recursing:
+        return _async_network.download(url, user, password, local_destination,
+                                       algorithms)
+
+    partial = PartialDownload(local_destination)
+    req = _document_response(url, user, password, partial.request_headers())
+
+    # Interpret the response.  Unless we read the body, we have to close the
+    # response explicitly so that the connection goes back to the pool.
+    code = req.status_code
+    if not (200 <= code < 400) or code == 202:
+        req.close()
+    if code in [429, 503]:
+        # The server is overloaded.  Wait like net() does and try again.
+        if recursing >= _MAX_RECURSIVE_CALLS:
+            raise _throttled(code, url)
+        _pause('throttled', _throttle_pause(req.headers, recursing))
+        return download(url, user, password, local_destination, recursing + 1,
+                        algorithms)
+    elif code == 202 and recursing >= _MAX_RECURSIVE_CALLS:
+        raise _deferred(url)
+    elif code == 202 or (code == 416 and partial.offset):
+        # Code 202 = Accepted, "received but not yet acted upon."  Code 416
+        # means the partial file we have is not a prefix of the document.
+        if code == 416:
+            partial.discard()
+        else:
+            _pause('accepted', 1)       # Sleep a short time and try again.
+        recursing += 1
+        if __debug__: log('calling download() recursively for http code {}', code)
+        return download(url, user, password, local_destination, recursing,
+                        algorithms)
+    elif 200 <= code < 400 and _segmentable_size(code, req.headers):
+        return _segmented_download(req, url, user, password, partial, algorithms)
+    elif 200 <= code < 400:
+        # This started as code in https://stackoverflow.com/a/13137873/743730
+        # Note: I couldn't get the shutil.copyfileobj approach to work; the
+        # file always ended up zero-length.  I couldn't figure out why.
+        digester = Digester(algorithms)
+        with partial.open(code, req.headers, digester) as f:
+            try:
+                for chunk in _response_chunks(req):
+                    if _rate_limiter:
+                        _rate_limiter.consume(len(chunk))
+                    digester.update(chunk)
+                    f.write(chunk)
+            except BaseException:
+                partial.save(f)
+                raise
+            finally:
+                req.close()
+        partial.finish()
+        return digester.hexdigests()
+    else:
+        raise _download_error(code, url)
+
+
+def _document_response(url, user, password, headers = None, recursing = 0):
+    # Returns the response to a GET of 'url', with the body not yet read, or
+    # raises an exception for network failures.
     def addurl(text):
         return (text + ' for {}').format(url)
 
     try:
-        req = timed_request('get', url, stream = True, auth = (user, password))
+        return timed_request('get', url, stream = True, headers = headers,
+                             auth = basic_auth(user, password))
     except requests.exceptions.ConnectionError as ex:
         if recursing >= _MAX_RECURSIVE_CALLS:
             raise NetworkFailure(addurl('Too many connection errors'))
@@ -176,17 +459,16 @@ def download(url, user, password, local_destination, recursing = 0):
             if __debug__: log(str(arg0))
             original = unwrapped_urllib3_exception(arg0)
             if isinstance(original, str) and 'unreacheable' in original:
-                return (req, NetworkFailure(addurl('Unable to connect to server')))
+                raise NetworkFailure(addurl('Unable to connect to server'))
             elif network_available():
                 raise NetworkFailure(addurl('Unable to resolve host'))
             else:
                 raise NetworkFailure(addurl('Lost network connection with server'))
         elif (isinstance(arg0, urllib3.exceptions.ProtocolError)
-              and arg0.args and isinstance(args0.args[1], ConnectionResetError)):
-            if __debug__: log('download() got ConnectionResetError; will recurse')
-            sleep(1)                    # Sleep a short time and try again.
-            recursing += 1
-            download(url, user, password, local_destination, recursing)
+              and len(arg0.args) > 1 and isinstance(arg0.args[1], ConnectionResetError)):
+            if __debug__: log('got ConnectionResetError; will recurse')
+            _pause('reset', 1)          # Sleep a short time and try again.
+            return _document_response(url, user, password, headers, recursing + 1)
         else:
             raise NetworkFailure(str(ex))
     except requests.exceptions.ReadTimeout as ex:
@@ -196,43 +478,252 @@ def download(url, user, password, local_destination, recursing = 0):
             raise NetworkFailure(addurl('Timed out reading data over network'))
     except requests.exceptions.InvalidSchema as ex:
         raise NetworkFailure(addurl('Unsupported network protocol'))
-    except Exception as ex:
-        raise
 
-    # Interpret the response.
+
+def open_document(url, user, password, recursing = 0):
+    '''Returns a requests.Response object for the document at 'url', with
+    the body not yet read.  Use document_chunks() to read it.  Raises an
+    exception if the document can't be obtained.'''
+    req = _document_response(url, user, password)
     code = req.status_code
-    if code == 202:
+    if code in [429, 503]:
+        req.close()
+        if recursing >= _MAX_RECURSIVE_CALLS:
+            raise _throttled(code, url)
+        _pause('throttled', _throttle_pause(req.headers, recursing))
+        return open_document(url, user, password, recursing + 1)
+    elif code == 202 and recursing < _MAX_RECURSIVE_CALLS:
         # Code 202 = Accepted, "received but not yet acted upon."
-        sleep(1)                        # Sleep a short time and try again.
-        recursing += 1
-        if __debug__: log('calling download() recursively for http code 202')
-        download(url, user, password, local_destination, recursing)
-    elif 200 <= code < 400:
-        # This started as code in https://stackoverflow.com/a/13137873/743730
-        # Note: I couldn't get the shutil.copyfileobj approach to work; the
-        # file always ended up zero-length.  I couldn't figure out why.
-        with open(local_destination, 'wb') as f:
-            for chunk in req.iter_content(1024):
-                f.write(chunk)
         req.close()
-        if __debug__: size = stat(local_destination).st_size
-        if __debug__: log('wrote {} bytes to file {}', size, local_destination)
-    elif code in [401, 402, 403, 407, 451, 511]:
-        raise AuthenticationFailure(addurl('Access is forbidden'))
-    elif code in [404, 410]:
-        raise NoContent(addurl('No content found'))
-    elif code in [405, 406, 409, 411, 412, 414, 417, 428, 431, 505, 510]:
-        raise InternalError(addurl('Server returned code {}'.format(code)))
-    elif code in [415, 416]:
-        raise ServiceFailure(addurl('Server rejected the request'))
-    elif code == 429:
-        raise RateLimitExceeded('Server blocking further requests due to rate limits')
-    elif code == 503:
-        raise ServiceFailure('Server is unavailable -- try again later')
-    elif code in [500, 501, 502, 506, 507, 508]:
-        raise ServiceFailure(addurl('Internal server error (HTTP code {})'.format(code)))
+        _pause('accepted', 1)
+        return open_document(url, user, password, recursing + 1)
+    elif code == 202:
+        req.close()
+        raise _deferred(url)
+    elif not (200 <= code < 400):
+        req.close()
+        raise _download_error(code, url)
+    return req
+
+
+def document_chunks(req):
+    '''Yields the body of the response 'req' returned by open_document(), in
+    chunks whose size is set by set_chunk_size().  Each chunk is only valid
+    until the next one is requested.  The response is closed at the end.'''
+    try:
+        for chunk in _response_chunks(req):
+            if _rate_limiter:
+                _rate_limiter.consume(len(chunk))
+            yield chunk
+    finally:
+        req.close()
+
+
+def content_length(req):
+    '''Returns the number of bytes document_chunks() will yield for the
+    response 'req', or None if the server didn't say.'''
+    if req.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    try:
+        return int(req.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _segmented_download(req, url, user, password, partial, algorithms):
+    # Download a large document in several byte ranges at once, each on its
+    # own connection, writing each range at its position in the file.  The
+    # response 'req' to the original request supplies the first range; the
+    # others are requested with If-Range, so that all the ranges are sure to
+    # come from the same version of the document.
+    size = int(req.headers['Content-Length'])
+    segment_size = -(-size // _num_segments)
+    bounds = [(start, min(start + segment_size, size) - 1)
+              for start in range(0, size, segment_size)]
+    if __debug__: log('downloading {} bytes of {} in {} segments', size, url, len(bounds))
+    validator = _validator(req.headers)
+    written = [0] * len(bounds)
+    errors = []
+
+    def fetch(index, response):
+        start, end = bounds[index]
+        try:
+            if response is None:
+                headers = {'Range': 'bytes={}-{}'.format(start, end), 'If-Range': validator}
+                response = timed_request('get', url, stream = True, headers = headers,
+                                         auth = basic_auth(user, password))
+                if response.status_code != 206 or _range_start(response.headers) != start:
+                    raise NetworkFailure('Unexpected response to range request'
+                                         ' for {}'.format(url))
+            remaining = end - start + 1
+            for chunk in _response_chunks(response):
+                chunk = chunk[:remaining]
+                if _rate_limiter:
+                    _rate_limiter.consume(len(chunk))
+                _pwrite(fd, chunk, start + written[index])
+                written[index] += len(chunk)
+                remaining -= len(chunk)
+                if remaining <= 0 or errors:
+                    break
+            if remaining > 0 and not errors:
+                raise NetworkFailure('Incomplete data received for {}'.format(url))
+        except Exception as ex:
+            if __debug__: log('segment {} of {} failed: {}', index, url, str(ex))
+            errors.append(ex)
+        finally:
+            if response is not None:
+                response.close()
+
+    with partial.open(req.status_code, req.headers, None) as f:
+        fd = f.fileno()
+        threads = [threading.Thread(target = fetch, args = (i, req if i == 0 else None),
+                                    name = 'segment-{}'.format(i))
+                   for i in range(len(bounds))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            # Keep the part of the file that's complete from the start, so
+            # that the next attempt can resume from there.
+            valid = 0
+            for index, (start, end) in enumerate(bounds):
+                valid += written[index]
+                if written[index] < end - start + 1:
+                    break
+            partial.save(f, valid)
+            raise errors[0]
+    partial.finish()
+    # The ranges arrive out of order, so the checksums can't be computed on
+    # the fly.  The file was just written, so it should be in the OS cache.
+    return file_digests(partial.destination, algorithms) if algorithms else {}
+
+
+def _segmentable_size(code, headers):
+    # Returns True if the response with 'code' and 'headers' is for a document
+    # big enough to download in segments, from a server that supports that.
+    if code != 200 or not _segment_threshold or _num_segments < 2:
+        return False
+    if headers.get('Accept-Ranges', 'none').lower() != 'bytes':
+        return False
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        return False
+    if not _validator(headers):
+        return False
+    try:
+        return int(headers.get('Content-Length', 0)) >= _segment_threshold
+    except ValueError:
+        return False
+
+
+def _pwrite(fd, data, offset):
+    # Write all of 'data' at position 'offset' in the file 'fd', without
+    # using (or changing) the file's current position.
+    if hasattr(os, 'pwrite'):
+        while data:
+            num_written = os.pwrite(fd, data, offset)
+            data = data[num_written:]
+            offset += num_written
     else:
-        raise NetworkFailure('Unable to resolve {}'.format(url))
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+
+class PartialDownload():
+    '''A document being downloaded to a ".part" file next to its final
+    location 'local_destination'.  If a download is interrupted, the partial
+    file is kept along with the validator (ETag or Last-Modified value) sent
+    by the server, and the next attempt asks the server for just the rest of
+    the document, using an HTTP Range request that is only honored if the
+    document has not changed (If-Range).  When the download is complete, the
+    file is renamed to its final name.
+    '''
+
+    def __init__(self, local_destination):
+        self.destination = local_destination
+        self.part_file = local_destination + _PART_SUFFIX
+        self.validator_file = self.part_file + _VALIDATOR_SUFFIX
+        self.validator = None
+        self.offset = 0
+        # A partial file without a validator file was not closed properly
+        # (e.g., the process was killed) and its contents can't be trusted.
+        if path.exists(self.part_file) and path.exists(self.validator_file):
+            with open(self.validator_file, 'r', encoding = 'utf-8') as f:
+                self.validator = f.read().strip()
+            self.offset = path.getsize(self.part_file)
+        if self.offset and self.validator:
+            if __debug__: log('found {} bytes of {}', self.offset, local_destination)
+        else:
+            self.offset = 0
+
+
+    def request_headers(self):
+        '''Returns the HTTP headers to send when requesting the document.'''
+        if not self.offset:
+            return {}
+        return {'Range': 'bytes={}-'.format(self.offset), 'If-Range': self.validator}
+
+
+    def open(self, code, headers, digester):
+        '''Returns a file object to which to write the body of a response
+        with HTTP status 'code' and 'headers'.  If the response continues the
+        partial file, the data already in the file is given to 'digester'
+        (if it is not None).'''
+        if code == 206 and self.offset and _range_start(headers) == self.offset:
+            if __debug__: log('resuming {} at byte {}', self.destination, self.offset)
+            f = open(self.part_file, 'r+b')
+            if digester:
+                for block in iter(lambda: f.read(1048576), b''):
+                    digester.update(block)
+            f.seek(self.offset)
+            return f
+        elif code == 206:
+            self.discard()
+            raise NetworkFailure('Unexpected range of data received for {}'.format(
+                self.destination))
+        # The server sent the whole document, either because we didn't ask for
+        # a range or because the document changed since the partial download.
+        self.offset = 0
+        self.validator = _validator(headers)
+        if path.exists(self.validator_file):
+            os.remove(self.validator_file)
+        f = open(self.part_file, 'wb')
+        _preallocate(f, headers)
+        return f
+
+
+    def save(self, file, size = None):
+        '''Keep the partial file written so far to 'file', if the server gave
+        us the means to resume it later.  'size' is the number of bytes at the
+        start of the file that are valid; by default, the file's position.'''
+        # The file may have been preallocated; cut it at what we received.
+        size = file.tell() if size is None else size
+        file.truncate(size)
+        file.flush()
+        if self.validator and size:
+            if __debug__: log('keeping {} bytes of {}', size, self.destination)
+            with open(self.validator_file, 'w', encoding = 'utf-8') as f:
+                f.write(self.validator)
+
+
+    def finish(self):
+        '''Move the completed download to its final location.'''
+        os.replace(self.part_file, self.destination)
+        if path.exists(self.validator_file):
+            os.remove(self.validator_file)
+        if __debug__: size = stat(self.destination).st_size
+        if __debug__: log('wrote {} bytes to file {}', size, self.destination)
+
+
+    def discard(self):
+        '''Delete the partial file, if any.'''
+        for file in [self.part_file, self.validator_file]:
+            if path.exists(file):
+                if __debug__: log('deleting {}', file)
+                os.remove(file)
+        self.offset = 0
 
 
 def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwargs):
@@ -244,14 +735,21 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
     response even in cases where exceptions are raised.
 
     If keyword 'session' is not None, it's assumed to be a requests session
-    object to use for the network call.
+    object to use for the network call; otherwise, the shared session returned
+    by shared_session() is used.
 
     If keyword 'polling' is True, certain statuses like 404 are ignored and
     the response is returned; otherwise, they are considered errors.
 
     This method hands allow_redirects = True to the underlying Python requests
     network call.
+
+    If use_async_network() has been called and no 'session' is given, the
+    request is performed by the asynchronous network layer instead.
     '''
+    if _async_network and not session and not recursing:
+        return _async_network.net(get_or_post, url, polling, **kwargs)
+
     def addurl(text):
         return (text + ' for {}').format(url)
 
@@ -275,9 +773,9 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
             else:
                 return (req, NetworkFailure(addurl('Lost network connection with server')))
         elif (isinstance(arg0, urllib3.exceptions.ProtocolError)
-              and arg0.args and isinstance(args0.args[1], ConnectionResetError)):
+              and len(arg0.args) > 1 and isinstance(arg0.args[1], ConnectionResetError)):
             if __debug__: log('net() got ConnectionResetError; will recurse')
-            sleep(1)                    # Sleep a short time and try again.
+            _pause('reset', 1)          # Sleep a short time and try again.
             if __debug__: log('doing recursive call #{}', recursing + 1)
             return net(get_or_post, url, session, polling, recursing + 1, **kwargs)
         else:
@@ -300,35 +798,190 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
     # Interpret the response.  Note that the requests library handles code 301
     # and 302 redirects automatically, so we don't need to do it here.
     code = req.status_code
-    error = None
     if __debug__: log(addurl('got http status code {}'.format(code)))
+    if code in [429, 503] and recursing < _MAX_RECURSIVE_CALLS:
+        # If we have a rate limiter, it has already slowed down in response
+        # to the 429 or 503, but that only spaces out new requests; this one
+        # still has to wait before it is tried again.
+        pause = _throttle_pause(req.headers, recursing)
+        if __debug__: log('rate limit hit -- sleeping {}', pause)
+        _pause('throttled', pause)
+        if __debug__: log('doing recursive call #{}', recursing + 1)
+        return net(get_or_post, url, session, polling, recursing + 1, **kwargs)
+    elif code == 202:
+        # Code 202 = Accepted, "received but not yet acted upon."
+        req.close()
+        if recursing >= _MAX_RECURSIVE_CALLS:
+            return (req, _deferred(url))
+        _pause('accepted', 1)
+        return net(get_or_post, url, session, polling, recursing + 1, **kwargs)
+    error = http_error(code, url, polling)
+    if __debug__: log('returning result {}',
+                      'with error {}'.format(error) if error else 'without error')
+    return (req, error)
+
+
+def _validator(headers):
+    # Returns the value to use in an If-Range header for a later request for
+    # the same document.  If-Range only works with strong ETags.
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def _range_start(headers):
+    # Returns the first byte position in a Content-Range header, or None.
+    try:
+        return int(headers.get('Content-Range', '').split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _response_chunks(req):
+    # Yield the body of the requests.Response 'req' in chunks of up to
+    # _chunk_size bytes.  Unless the body is compressed (in which case
+    # requests has to decode it), the data is read straight into a single
+    # buffer that is reused for every chunk, so the chunks yielded are only
+    # valid until the next one is requested.
+    if req.headers.get('Content-Encoding', 'identity') != 'identity':
+        yield from req.iter_content(_chunk_size)
+        return
+    buffer = bytearray(_chunk_size)
+    view = memoryview(buffer)
+    while True:
+        num_read = req.raw.readinto(buffer)
+        if not num_read:
+            break
+        yield view[:num_read]
+
+
+def _preallocate(file, headers):
+    # Reserve space for the whole document on disk up front, when its size is
+    # known.  This reduces fragmentation and makes a full disk fail early.
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        return
+    try:
+        size = int(headers.get('Content-Length', 0))
+        if size > 0:
+            os.posix_fallocate(file.fileno(), 0, size)
+    except (ValueError, OSError) as ex:
+        if __debug__: log('unable to preallocate {}: {}', file.name, str(ex))
+
+
+def _note_response(code, headers, seconds):
+    # Let the rate limiter adapt to how the server is coping.  'seconds' is
+    # the time it took to get the response.
+    if _rate_limiter:
+        if code in [429, 503]:
+            _rate_limiter.backoff(headers.get('Retry-After'), seconds)
+        else:
+            _rate_limiter.succeeded(seconds)
+
+
+def _throttle_pause(headers, recursing):
+    # Returns the number of seconds to wait before retrying a request refused
+    # with code 429 or 503: the time given in the Retry-After header, if any,
+    # or else 5 s, then 10 s, then 15 s, etc.
+    value = headers.get('Retry-After')
+    pause = retry_after_seconds(value) if value else 0
+    return pause or 5 * (recursing + 1)   # +1 b/c we start with recursing = 0.
+
+
+def http_error(code, url, polling = False):
+    '''Return an exception object describing the meaning of the HTTP status
+    'code' received for 'url', or None if the code does not indicate an
+    error.  If 'polling' is True, codes 404 and 410 are not treated as errors.
+    Note that the requests library handles code 301 and 302 redirects
+    automatically, so they are not errors here.
+    '''
+    def addurl(text):
+        return (text + ' for {}').format(url)
+
     if code == 400:
-        error = RequestError(addurl('Server rejected the request'))
+        return RequestError(addurl('Server rejected the request'))
     elif code in [401, 402, 403, 407, 451, 511]:
-        error = AuthFailure(addurl('Access is forbidden'))
-    elif code in [404, 410] and not polling:
-        error = NoContent(addurl("No content found"))
+        return AuthenticationFailure(addurl('Access is forbidden'))
+    elif code in [404, 410]:
+        return None if polling else NoContent(addurl("No content found"))
     elif code in [405, 406, 409, 411, 412, 414, 417, 428, 431, 505, 510]:
-        error = InternalError(addurl('Server returned code {}'.format(code)))
+        return InternalError(addurl('Server returned code {}'.format(code)))
     elif code in [415, 416]:
-        error = ServiceFailure(addurl('Server rejected the request'))
+        return ServiceFailure(addurl('Server rejected the request'))
     elif code == 429:
-        if recursing < _MAX_RECURSIVE_CALLS:
-            pause = 5 * (recursing + 1)   # +1 b/c we start with recursing = 0.
-            if __debug__: log('rate limit hit -- sleeping {}', pause)
-            sleep(pause)                  # 5 s, then 10 s, then 15 s, etc.
-            if __debug__: log('doing recursive call #{}', recursing + 1)
-            return net(get_or_post, url, session, polling, recursing + 1, **kwargs)
-        error = RateLimitExceeded('Server blocking further requests due to rate limits')
+        return RateLimitExceeded('Server blocking further requests due to rate limits')
     elif code == 503:
-        error = ServiceFailure('Server is unavailable -- try again later')
+        return ServiceFailure('Server is unavailable -- try again later')
     elif code in [500, 501, 502, 506, 507, 508]:
-        error = ServiceFailure(addurl('Server error (HTTP code {})'.format(code)))
+        return ServiceFailure(addurl('Server error (HTTP code {})'.format(code)))
     elif not (200 <= code < 400):
-        error = NetworkFailure("Unable to resolve {}".format(url))
-    if __debug__: log('returning result {}',
-                      'with error {}'.format(error) if error else 'without error')
-    return (req, error)
+        return NetworkFailure("Unable to resolve {}".format(url))
+    return None
+
+
+def _download_error(code, url):
+    # Like http_error(), but with the meanings that downloads of documents
+    # have always given to the codes: in particular, any code not listed is
+    # a NetworkFailure, including 400.
+    def addurl(text):
+        return (text + ' for {}').format(url)
+
+    if code in [401, 402, 403, 407, 451, 511]:
+        return AuthenticationFailure(addurl('Access is forbidden'))
+    elif code in [404, 410]:
+        return NoContent(addurl('No content found'))
+    elif code in [405, 406, 409, 411, 412, 414, 417, 428, 431, 505, 510]:
+        return InternalError(addurl('Server returned code {}'.format(code)))
+    elif code in [415, 416]:
+        return ServiceFailure(addurl('Server rejected the request'))
+    elif code == 429:
+        return RateLimitExceeded('Server blocking further requests due to rate limits')
+    elif code == 503:
+        return ServiceFailure('Server is unavailable -- try again later')
+    elif code in [500, 501, 502, 506, 507, 508]:
+        return ServiceFailure(addurl('Internal server error (HTTP code {})'.format(code)))
+    else:
+        return NetworkFailure('Unable to resolve {}'.format(url))
+
+
+def _deferred(url):
+    # Code 202 keeps coming back: the server never got around to it.
+    return ServiceFailure('Server kept deferring the request for {}'.format(url))
+
+
+def _throttled(code, url):
+    # The server kept answering 'url' with code 429 or 503.  The document is
+    # there, so this must not be mistaken for a missing one (with -k, a
+    # ServiceFailure would be).
+    return RateLimitExceeded('Server kept refusing requests for {} (HTTP code {})'
+                             .format(url, code))
+
+
+def _count_retry(name, seconds):
+    with _retry_lock:
+        _retry_counts[name] += 1
+        _retry_seconds[name] += seconds
+
+
+def _pause(name, seconds):
+    # Sleep, and count the time against retry path 'name'.
+    start = perf_counter()
+    sleep(seconds)
+    _count_retry(name, perf_counter() - start)
+
+
+def _new_session(pool_size):
+    if __debug__: log('creating session with pool size {}', pool_size)
+    session = requests.Session()
+    # We do our own retrying in timed_request(), so turn off urllib3's.
+    adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size,
+                                            pool_maxsize = pool_size,
+                                            max_retries = 0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 def unwrapped_urllib3_exception(ex):
@@ -336,3 +989,278 @@ def unwrapped_urllib3_exception(ex):
         return unwrapped_urllib3_exception(ex.args[0])
     else:
         return ex
+
+
+# Asynchronous network access.
+# .............................................................................
+# The following provides an alternative to timed_request(), net() and
+# download() based on asyncio and the optional package aiohttp.  All network
+# I/O happens on a single thread running an asyncio event loop, which lets a
+# large number of requests be in flight at once without a connection per
+# worker thread.  Errors are reported using the same exceptions as net() and
+# download(), so callers cannot tell which layer was used.
+
+def use_async_network(max_requests, per_host):
+    '''Make net() and download() use the asynchronous network layer from now
+    on.  At most 'max_requests' requests will be in flight at any time, and
+    at most 'per_host' of them to the same host.  Returns the AsyncNetwork
+    object; call its close() method when finished.
+    '''
+    global _async_network
+    _async_network = AsyncNetwork(max_requests, per_host)
+    return _async_network
+
+
+class AsyncNetwork():
+    '''Performs network requests on an asyncio event loop running in its own
+    thread.  Any number of threads can call net() and download() on the same
+    object concurrently; each call blocks its caller until the request is
+    done, but does not tie up a network connection while waiting its turn.
+    '''
+
+    def __init__(self, max_requests = 100, per_host = 8):
+        if aiohttp is None:
+            raise InternalError('Asynchronous network access requires the'
+                                ' Python package "aiohttp"')
+        self._max_requests = max_requests
+        self._per_host = per_host
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target = self._loop.run_forever,
+                                        name = 'async-network', daemon = True)
+        self._thread.start()
+        self._session = self._run(self._new_session())
+
+
+    def net(self, get_or_post, url, polling = False, **kwargs):
+        '''Like net(), but performed on the event loop.'''
+        return self._run(async_net(self._session, get_or_post, url, polling, **kwargs))
+
+
+    def download(self, url, user, password, local_destination, algorithms = []):
+        '''Like download(), but performed on the event loop.'''
+        coroutine = async_download(self._session, url, user, password,
+                                   local_destination, algorithms = algorithms)
+        return self._run(coroutine)
+
+
+    def close(self):
+        '''Close all connections and stop the event loop thread.'''
+        global _async_network
+        if _async_network is self:
+            _async_network = None
+        self._run(self._session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+
+    async def _new_session(self):
+        if __debug__: log('creating aiohttp session for {} requests, {} per host',
+                          self._max_requests, self._per_host)
+        # Verification of certificates is turned off, as in timed_request().
+        connector = aiohttp.TCPConnector(limit = self._max_requests,
+                                         limit_per_host = self._per_host,
+                                         ssl = False)
+        timeout = aiohttp.ClientTimeout(sock_connect = 20, sock_read = 20)
+        return aiohttp.ClientSession(connector = connector, timeout = timeout)
+
+
+class AsyncResponse():
+    '''The parts of a requests.Response that callers of net() make use of.'''
+
+    def __init__(self, url, status_code, headers, content, encoding):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors = 'replace')
+
+
+async def async_timed_request(session, get_or_post, url, **kwargs):
+    '''Like timed_request(), but for an aiohttp ClientSession.  Returns an
+    aiohttp ClientResponse whose body has not been read yet.'''
+    failures = 0
+    retries = 0
+    error = None
+    kwargs = _aiohttp_kwargs(kwargs)
+    while True:
+        try:
+            if __debug__: log('doing async http {} on {}', get_or_post, url)
+            if _rate_limiter:
+                start = perf_counter()
+                if await _rate_limiter.async_acquire():
+                    _count_retry('rate-limit', perf_counter() - start)
+            start = perf_counter()
+            response = await session.request(get_or_post.upper(), url, **kwargs)
+            if __debug__: log('response received')
+            _note_response(response.status, response.headers,
+                           perf_counter() - start)
+            return response
+        except Exception as ex:
+            # Problem might be transient.  Don't quit right away.
+            failures += 1
+            if __debug__: log('exception (failure #{}): {}', failures, str(ex))
+            _count_retry('failed', perf_counter() - start)
+            if not error:
+                error = ex
+        if failures >= _MAX_FAILURES:
+            if retries < _MAX_RETRIES:
+                retries += 1
+                failures = 0
+                if __debug__: log('pausing because of consecutive failures')
+                await _async_pause('backoff', 10 * retries * retries)
+            else:
+                raise error
+
+
+async def async_net(session, get_or_post, url, polling = False, recursing = 0, **kwargs):
+    '''Like net(), but for an aiohttp ClientSession.  Returns a tuple of
+    (response, exception), where the response is an AsyncResponse object.'''
+    try:
+        response = await async_timed_request(session, get_or_post, url, **kwargs)
+        try:
+            content = await response.read()
+        finally:
+            response.release()
+    except Exception as ex:
+        error = await _async_failure(ex, url)
+        if error is None and recursing < _MAX_RECURSIVE_CALLS:
+            if __debug__: log('async_net() got connection reset; will retry')
+            await _async_pause('reset', 1)
+            return await async_net(session, get_or_post, url, polling,
+                                   recursing + 1, **kwargs)
+        return (None, error or NetworkFailure(str(ex)))
+
+    code = response.status
+    if __debug__: log('got http status code {} for {}', code, url)
+    if code in [429, 503] and recursing < _MAX_RECURSIVE_CALLS:
+        pause = _throttle_pause(response.headers, recursing)
+        if __debug__: log('rate limit hit -- sleeping {}', pause)
+        await _async_pause('throttled', pause)
+        return await async_net(session, get_or_post, url, polling,
+                               recursing + 1, **kwargs)
+    elif code == 202:
+        if recursing >= _MAX_RECURSIVE_CALLS:
+            return (None, _deferred(url))
+        await _async_pause('accepted', 1)
+        return await async_net(session, get_or_post, url, polling,
+                               recursing + 1, **kwargs)
+    req = AsyncResponse(str(response.url), code, response.headers, content,
+                        response.charset)
+    return (req, http_error(code, url, polling))
+
+
+async def async_download(session, url, user, password, local_destination,
+                         recursing = 0, algorithms = []):
+    '''Like download(), but for an aiohttp ClientSession.  Reading and
+    writing files and computing checksums is done in the event loop's
+    default executor, so that it does not hold up other requests.'''
+    loop = asyncio.get_event_loop()
+    partial = await loop.run_in_executor(None, PartialDownload, local_destination)
+    try:
+        response = await async_timed_request(session, 'get', url,
+                                             auth = basic_auth(user, password),
+                                             headers = partial.request_headers())
+    except Exception as ex:
+        error = await _async_failure(ex, url)
+        if error is None and recursing < _MAX_RECURSIVE_CALLS:
+            if __debug__: log('async_download() got connection reset; will retry')
+            await _async_pause('reset', 1)
+            return await async_download(session, url, user, password,
+                                        local_destination, recursing + 1, algorithms)
+        raise error or NetworkFailure(str(ex))
+
+    try:
+        code = response.status
+        if code in [429, 503] and recursing < _MAX_RECURSIVE_CALLS:
+            await _async_pause('throttled', _throttle_pause(response.headers, recursing))
+        elif code in [429, 503]:
+            raise _throttled(code, url)
+        elif code == 202 and recursing < _MAX_RECURSIVE_CALLS:
+            # Code 202 = Accepted, "received but not yet acted upon."
+            await _async_pause('accepted', 1)
+        elif code == 202:
+            raise _deferred(url)
+        elif code == 416 and partial.offset and recursing < _MAX_RECURSIVE_CALLS:
+            # The partial file we have is not a prefix of the document.
+            await loop.run_in_executor(None, partial.discard)
+        elif 200 <= code < 400:
+            digester = Digester(algorithms)
+            f = await loop.run_in_executor(None, partial.open, code,
+                                           response.headers, digester)
+            try:
+                async for chunk in response.content.iter_chunked(_chunk_size):
+                    if _rate_limiter:
+                        await _rate_limiter.async_consume(len(chunk))
+                    await loop.run_in_executor(None, _write_chunk, f, digester, chunk)
+            except BaseException:
+                await loop.run_in_executor(None, partial.save, f)
+                raise
+            finally:
+                await loop.run_in_executor(None, f.close)
+            await loop.run_in_executor(None, partial.finish)
+            return digester.hexdigests()
+        else:
+            raise _download_error(code, url)
+    finally:
+        response.release()
+    if __debug__: log('calling async_download() again for http code {}', code)
+    return await async_download(session, url, user, password, local_destination,
+                                recursing + 1, algorithms)
+
+
+def _write_chunk(file, digester, chunk):
+    # Hash and write one chunk of a download; run in an executor.
+    digester.update(chunk)
+    file.write(chunk)
+
+
+def _aiohttp_kwargs(kwargs):
+    # Translate the arguments used with requests into their aiohttp forms.
+    kwargs = dict(kwargs)
+    auth = kwargs.pop('auth', None)
+    if isinstance(auth, requests.auth.HTTPBasicAuth):
+        kwargs['auth'] = aiohttp.BasicAuth(auth.username, auth.password)
+    elif auth:
+        kwargs['auth'] = aiohttp.BasicAuth(*auth)
+    kwargs.pop('stream', None)
+    return kwargs
+
+
+async def _async_pause(name, seconds):
+    start = perf_counter()
+    await asyncio.sleep(seconds)
+    _count_retry(name, perf_counter() - start)
+
+
+async def _async_failure(ex, url):
+    # Return the exception net() would have produced for a network failure,
+    # or None if the failure was a connection reset that's worth retrying.
+    def addurl(text):
+        return (text + ' for {}').format(url)
+
+    if __debug__: log('got network exception: {}', str(ex))
+    if isinstance(ex, (aiohttp.ServerDisconnectedError, ConnectionResetError)):
+        return None
+    elif isinstance(ex, aiohttp.InvalidURL) or 'scheme' in str(ex).lower():
+        return NetworkFailure(addurl('Unsupported network protocol'))
+    loop = asyncio.get_event_loop()
+    connected = await loop.run_in_executor(None, network_available)
+    if isinstance(ex, asyncio.TimeoutError):
+        if connected:
+            return ServiceFailure(addurl('Timed out reading data from server'))
+        else:
+            return NetworkFailure(addurl('Timed out reading data over network'))
+    elif isinstance(ex, aiohttp.ClientConnectorError):
+        if connected:
+            return NetworkFailure(addurl('Unable to resolve host'))
+        else:
+            return NetworkFailure(addurl('Lost network connection with server'))
+    return NetworkFailure(str(ex))
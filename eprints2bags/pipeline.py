@@ -0,0 +1,186 @@
+'''
+pipeline.py: run work items through a series of concurrent stages
+
+A Pipeline is made up of an ordered list of Stage objects.  Each stage is
+served by its own pool of worker threads, and consecutive stages are joined
+by bounded queues, so that (for example) one stage can be downloading files
+over the network while the next stage is busy computing checksums.  The
+bounded queues keep a fast stage from running arbitrarily far ahead of a slow
+one.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import namedtuple
+import queue
+import threading
+import time
+
+import eprints2bags
+from   eprints2bags.debug import log
+
+
+# Constants.
+# .............................................................................
+
+_QUEUE_SLOTS_PER_WORKER = 2
+'''The queue feeding a stage holds at most this many items per worker thread
+of that stage.'''
+
+_END = object()
+'''Marker put on a queue to tell a worker thread that no more items follow.'''
+
+_thread_time = getattr(time, 'thread_time', None)
+'''Function returning the CPU time of the calling thread (Python 3.7+).'''
+
+
+# Exported classes.
+# .............................................................................
+
+StageStats = namedtuple('StageStats', ['items', 'seconds', 'cpu_seconds'])
+StageStats.__doc__ = '''Totals for one stage of a Pipeline: the number of
+items processed, the time spent in the stage function, and the CPU time of
+the worker threads in the stage function (None if the version of Python does
+not provide per-thread CPU times).  CPU time used by other processes on
+behalf of the stage, such as the checksumming processes, is not included.'''
+
+
+class Stage():
+    '''One step of a Pipeline.  'name' is used in thread names and debug
+    messages.  'function' is called with a single work item; it must return
+    the item to be handed to the next stage, or None to drop the item from
+    further processing.  'workers' is the number of threads that will call
+    'function' concurrently.
+    '''
+
+    def __init__(self, name, function, workers = 1):
+        self.name = name
+        self.function = function
+        self.workers = max(1, int(workers))
+
+
+class Pipeline():
+    '''Runs items through a list of Stage objects.  Items enter the first
+    stage in the order given, but because stages can have multiple workers,
+    items may leave a stage in a different order than they entered it.
+
+    If a stage function raises an exception, no new work is started, items
+    still in the queues are discarded, and the first exception raised is
+    re-raised by run() once all threads have stopped.
+    '''
+
+    def __init__(self, stages):
+        self._stages    = stages
+        self._queues    = [queue.Queue(maxsize = _QUEUE_SLOTS_PER_WORKER * s.workers)
+                           for s in stages]
+        self._remaining = [s.workers for s in stages]
+        self._lock      = threading.Lock()
+        self._stopped   = threading.Event()
+        self._error     = None
+        self._items     = [0] * len(stages)
+        self._seconds   = [0.0] * len(stages)
+        self._cpu       = [0.0] * len(stages)
+
+
+    def run(self, items):
+        '''Process every item in the iterable 'items' and wait until all the
+        stages are finished.'''
+        threads = []
+        for index, stage in enumerate(self._stages):
+            for n in range(stage.workers):
+                name = '{}-{}'.format(stage.name, n + 1)
+                thread = threading.Thread(target = self._work, args = (index,),
+                                          name = name, daemon = True)
+                thread.start()
+                threads.append(thread)
+        if __debug__: log('started {} pipeline threads', len(threads))
+        try:
+            for item in items:
+                if self._stopped.is_set():
+                    break
+                self._queues[0].put(item)
+        except BaseException as ex:
+            self._fail(ex)
+        finally:
+            for _ in range(self._stages[0].workers):
+                self._queues[0].put(_END)
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            # Most likely a KeyboardInterrupt.  Tell the workers to give up.
+            self._stopped.set()
+            raise
+        if self._error:
+            raise self._error
+
+
+    def stopped(self):
+        '''Returns True if the pipeline has been stopped due to an error.'''
+        return self._stopped.is_set()
+
+
+    def stats(self):
+        '''Returns a dict mapping the names of the stages to StageStats.'''
+        with self._lock:
+            return {stage.name: StageStats(self._items[i], self._seconds[i],
+                                           self._cpu[i] if _thread_time else None)
+                    for i, stage in enumerate(self._stages)}
+
+
+    def _work(self, index):
+        stage = self._stages[index]
+        source = self._queues[index]
+        sink = self._queues[index + 1] if index + 1 < len(self._queues) else None
+        while True:
+            item = source.get()
+            if item is _END:
+                break
+            if self._stopped.is_set():
+                # Keep draining the queue so that upstream threads don't block.
+                continue
+            start = time.perf_counter()
+            start_cpu = _thread_time() if _thread_time else 0
+            try:
+                result = stage.function(item)
+            except BaseException as ex:
+                self._fail(ex)
+                continue
+            finally:
+                self._count(index, start, start_cpu)
+            if sink and result is not None:
+                sink.put(result)
+        with self._lock:
+            self._remaining[index] -= 1
+            last_one_out = self._remaining[index] == 0
+        if sink and last_one_out:
+            if __debug__: log('stage {} finished', stage.name)
+            for _ in range(self._stages[index + 1].workers):
+                sink.put(_END)
+
+
+    def _count(self, index, start, start_cpu):
+        elapsed = time.perf_counter() - start
+        cpu = (_thread_time() - start_cpu) if _thread_time else 0
+        with self._lock:
+            self._items[index] += 1
+            self._seconds[index] += elapsed
+            self._cpu[index] += cpu
+
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                if __debug__: log('pipeline stopping due to error: {}', str(error))
+                self._error = error
+        self._stopped.set()
@@ -0,0 +1,213 @@
+'''
+ratelimit.py: token-bucket rate limiting with adaptive backoff
+
+The RateLimiter class in this module limits both the number of requests per
+second and the number of bytes per second transferred.  When the server
+signals that it's overloaded (with HTTP code 429 or 503), the request rate is
+cut in half; after each successful request, it creeps back up toward the
+configured maximum.  (This is the additive-increase/multiplicative-decrease
+or "AIMD" scheme used by TCP congestion control.)  If the server sends a
+Retry-After header, no new requests are started until that time has passed.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import asyncio
+from   datetime import datetime, timezone
+from   email.utils import parsedate_to_datetime
+import threading
+from   time import monotonic, sleep
+
+import eprints2bags
+from   eprints2bags.debug import log
+
+
+# Constants.
+# .............................................................................
+
+_MIN_RATE = 0.1
+'''Lowest request rate (per second) that backoff() will reduce the rate to.'''
+
+_INCREASE_STEPS = 50
+'''Number of consecutive successful requests needed for the request rate to
+climb from its lowest value back to the configured maximum.'''
+
+_MAX_RETRY_AFTER = 600
+'''Longest pause (in seconds) that we will honor in a Retry-After header.'''
+
+_RTT_WEIGHT = 0.125
+'''Weight of each new measurement in the running estimate of the round-trip
+time of requests (the same weight TCP uses).'''
+
+
+# Exported classes.
+# .............................................................................
+
+class RateLimiter():
+    '''Limits the rate of requests and, optionally, of bytes transferred.
+    'requests_per_sec' is the maximum request rate; 'bytes_per_sec' is the
+    maximum transfer rate, or None for no limit on it.  The object can be
+    shared by any number of threads, and by coroutines on an event loop.
+    '''
+
+    def __init__(self, requests_per_sec, bytes_per_sec = None):
+        self._max_rate     = float(requests_per_sec)
+        self._rate         = self._max_rate
+        self._step         = self._max_rate / _INCREASE_STEPS
+        self._tokens       = 1.0
+        self._last         = monotonic()
+        self._paused_until = 0
+        self._rtt          = 0.0
+        self._last_cut     = None
+        self._byte_rate    = float(bytes_per_sec) if bytes_per_sec else None
+        self._byte_tokens  = self._byte_rate
+        self._byte_last    = self._last
+        self._lock         = threading.Lock()
+
+
+    def rate(self):
+        '''Returns the current request rate, in requests per second.'''
+        return self._rate
+
+
+    def acquire(self):
+        '''Block until another request may be started.  Returns the number
+        of seconds waited, which is 0 if the request could start at once.'''
+        wait = self._reserve_request()
+        if wait > 0:
+            sleep(wait)
+        return max(wait, 0)
+
+
+    async def async_acquire(self):
+        '''Like acquire(), but for coroutines.'''
+        wait = self._reserve_request()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return max(wait, 0)
+
+
+    def consume(self, num_bytes):
+        '''Block until 'num_bytes' more bytes may be transferred.'''
+        wait = self._reserve_bytes(num_bytes)
+        if wait > 0:
+            sleep(wait)
+
+
+    async def async_consume(self, num_bytes):
+        '''Like consume(), but for coroutines.'''
+        wait = self._reserve_bytes(num_bytes)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+    def succeeded(self, seconds = None):
+        '''Report that a request went through.  Increases the request rate
+        by a small amount, up to the configured maximum.  'seconds', if not
+        None, is the time the request took.'''
+        with self._lock:
+            self._refill(monotonic())
+            self._note_rtt(seconds)
+            self._rate = min(self._max_rate, self._rate + self._step)
+
+
+    def backoff(self, retry_after = None, seconds = None):
+        '''Report that the server asked us to slow down.  Cuts the request
+        rate in half, unless it was already cut less than a round-trip time
+        (or the interval between requests at the current rate, if that is
+        longer) ago.  If 'retry_after' is not None, it's the value of the
+        Retry-After header in the server's response, and no new requests will
+        be started until the time it indicates.  'seconds', if not None, is
+        the time the request took.'''
+        pause = retry_after_seconds(retry_after) if retry_after else 0
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self._note_rtt(seconds)
+            # When the server starts refusing requests, every request in
+            # flight at the time gets refused.  Those refusals say nothing
+            # about the rate we have just cut to, so they don't cut it again.
+            window = max(self._rtt, 1 / self._rate)
+            cut = self._last_cut is None or now - self._last_cut >= window
+            if cut:
+                self._rate = max(_MIN_RATE, self._rate / 2)
+                self._last_cut = now
+            self._paused_until = max(self._paused_until, now + pause)
+        if __debug__:
+            if cut:
+                log('backing off to {:.2f} requests/s, pause {} s', self._rate, pause)
+            else:
+                log('rate was cut {:.2f} s ago; pause {} s', now - self._last_cut, pause)
+
+
+    def _reserve_request(self):
+        # Take a token even if none is available yet, and return how long the
+        # caller must wait for it.  Tokens can go negative; that represents
+        # requests that have been promised a future time slot.
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+            return max(wait, self._paused_until - now)
+
+
+    def _reserve_bytes(self, num_bytes):
+        if not self._byte_rate:
+            return 0
+        with self._lock:
+            now = monotonic()
+            elapsed = now - self._byte_last
+            self._byte_last = now
+            self._byte_tokens = min(self._byte_rate,
+                                    self._byte_tokens + elapsed * self._byte_rate)
+            self._byte_tokens -= num_bytes
+            if self._byte_tokens < 0:
+                return -self._byte_tokens / self._byte_rate
+            return 0
+
+
+    def _note_rtt(self, seconds):
+        # Update the running estimate of the round-trip time of requests.
+        if seconds is not None:
+            if self._rtt:
+                self._rtt += _RTT_WEIGHT * (seconds - self._rtt)
+            else:
+                self._rtt = seconds
+
+
+    def _refill(self, now):
+        # The bucket holds at most one second's worth of requests (and at
+        # least one request), which allows short bursts at the start.
+        capacity = max(1.0, self._rate)
+        self._tokens = min(capacity, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+
+# Exported functions.
+# .............................................................................
+
+def retry_after_seconds(value):
+    '''Interpret the value of an HTTP Retry-After header, which can be either
+    a number of seconds or an HTTP date.  Returns a number of seconds (0 if
+    the value cannot be parsed), capped at a reasonable maximum.'''
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        try:
+            when = parsedate_to_datetime(value)
+            seconds = (when - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            if __debug__: log('unable to parse Retry-After value {}', value)
+            return 0
+    return min(max(0, seconds), _MAX_RETRY_AFTER)
@@ -23,4 +23,8 @@ with open(path.join(here, 'requirements.txt')) as f:
 setup(
     setup_requires = ['wheel'],
     install_requires = reqs,
+    extras_require = {
+        'async': ['aiohttp>=3.5'],
+        'zstd':  ['zstandard>=0.13'],
+    },
 )
@@ -0,0 +1,92 @@
+'''
+test_bags.py: tests of the bags made and archived by eprints2bags
+'''
+
+import bagit
+import os
+from   os import path
+import pytest
+
+from   eprints2bags import bags
+from   eprints2bags.files import create_archive
+
+ALGORITHMS = ['sha256', 'md5']
+
+# Names of documents taken from URLs are often percent-encoded.  (A name
+# containing "%0A" or "%0D" itself can't be represented in a bagit manifest.)
+ODD_NAMES = ['My%20Thesis.pdf', '100%.txt', '%25.txt', 'a b.txt', 'café.pdf']
+
+
+def make_record_dir(tmp_path, names):
+    record_dir = tmp_path / '4'
+    record_dir.mkdir()
+    for index, name in enumerate(names):
+        (record_dir / name).write_bytes(b'content of file ' + str(index).encode())
+    return str(record_dir)
+
+
+def test_manifest_text_encodes_only_line_breaks():
+    text = bags.manifest_text([('data/My%20Thesis.pdf', 'abc'), ('data/a\nb\rc', 'def')])
+    assert text == 'abc  data/My%20Thesis.pdf\ndef  data/a%0Ab%0Dc\n'
+
+
+def test_manifest_round_trip():
+    entries = [('data/My%20Thesis.pdf', 'abc'), ('data/100%.txt', 'def'),
+               ('data/a\nb\rc', '123')]
+    parsed = bags._parsed_manifest(bags.manifest_text(entries), 'bag/')
+    assert parsed == {'bag/' + name: checksum for name, checksum in entries}
+
+
+def test_make_bag_with_odd_names_validates(tmp_path):
+    record_dir = make_record_dir(tmp_path, ODD_NAMES)
+    bag = bags.make_bag(record_dir, ALGORITHMS)
+    bag.validate()
+    assert sorted(bag.payload_files()) == sorted('data/' + name for name in ODD_NAMES)
+
+
+def test_make_bag_matches_bagit(tmp_path):
+    ours = make_record_dir(tmp_path, ODD_NAMES)
+    bags.make_bag(ours, ALGORITHMS)
+    theirs = str(tmp_path / 'theirs')
+    os.mkdir(theirs)
+    for name in ODD_NAMES:
+        with open(path.join(ours, 'data', name), 'rb') as src:
+            with open(path.join(theirs, name), 'wb') as dest:
+                dest.write(src.read())
+    bagit.make_bag(theirs, checksums = ALGORITHMS)
+    for alg in ALGORITHMS:
+        manifest = 'manifest-{}.txt'.format(alg)
+        with open(path.join(ours, manifest)) as file:
+            our_lines = sorted(file.read().splitlines())
+        with open(path.join(theirs, manifest)) as file:
+            their_lines = sorted(file.read().splitlines())
+        assert our_lines == their_lines
+
+
+@pytest.mark.parametrize('type', ['uncompressed-zip', 'compressed-zip', 'uncompressed-tar'])
+def test_audit_archive_with_odd_names(tmp_path, type):
+    record_dir = make_record_dir(tmp_path, ODD_NAMES)
+    bags.make_bag(record_dir, ALGORITHMS)
+    archive_file = str(tmp_path / 'record.archive')
+    create_archive(archive_file, type, record_dir)
+    assert bags.audit_archive(archive_file, type, full = True) == []
+    assert bags.audit_archive(archive_file, type, full = False) == []
+
+
+def test_archived_bag_with_odd_names(tmp_path):
+    archive_file = str(tmp_path / '4.zip')
+    bag = bags.ArchivedBag(archive_file, 'uncompressed-zip', '4', ALGORITHMS)
+    for name in ODD_NAMES:
+        data = name.encode('utf-8') * 10
+        bag.add_file(name, [data], len(data))
+    bag.finish({'External-Identifier': 'test'})
+    bag.close()
+    assert bags.audit_archive(archive_file, 'uncompressed-zip') == []
+
+
+@pytest.mark.parametrize('type', ['uncompressed-zip', 'uncompressed-tar'])
+def test_archived_bag_rejects_wrong_size(tmp_path, type):
+    bag = bags.ArchivedBag(str(tmp_path / '4.archive'), type, '4', ALGORITHMS)
+    with pytest.raises(IOError):
+        bag.add_file('doc.pdf', [b'0123456789', b'extra'], 10)
+    bag.abort()
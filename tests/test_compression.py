@@ -0,0 +1,119 @@
+'''
+test_compression.py: tests of the files written by the compression module
+'''
+
+import gzip
+import pytest
+from   zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+from   eprints2bags import compression
+from   eprints2bags.compression import (ParallelGzipFile, ParallelZipFile,
+                                        ZstdFile, zstd_reader, incompressible)
+
+
+def sample_data(size):
+    # Data that is neither random nor trivially compressible, and spans
+    # several compression blocks when 'size' is large.
+    words = [b'eprints', b'bag', b'archive', b'record', b'caltech', b'\x00\xff']
+    data = bytearray()
+    n = 0
+    while len(data) < size:
+        data += words[n % len(words)] + str(n).encode()
+        n += 7
+    return bytes(data[:size])
+
+
+LARGE = sample_data(3 * compression._BLOCK_SIZE + 12345)
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_gzip_reads_back(tmp_path, threads):
+    file = str(tmp_path / 'data.gz')
+    with ParallelGzipFile(file, level = 6, threads = threads) as out:
+        out.write(LARGE[:1000])
+        out.write(LARGE[1000:])
+    with gzip.open(file, 'rb') as input:
+        assert input.read() == LARGE
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_zip_reads_back(tmp_path, threads):
+    file = str(tmp_path / 'data.zip')
+    contents = {'large.txt': LARGE, 'empty.txt': b'', 'café.txt': b'x' * 100}
+    with ParallelZipFile(file, threads = threads) as archive:
+        for name, data in contents.items():
+            with archive.open(ZipInfo(name), 'w') as member:
+                member.write(data)
+    with ZipFile(file) as archive:
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == sorted(contents)
+        for name, data in contents.items():
+            assert archive.read(name) == data
+            assert archive.getinfo(name).compress_type == ZIP_DEFLATED
+
+
+def test_zip_stores_incompressible_files(tmp_path):
+    file = str(tmp_path / 'data.zip')
+    with ParallelZipFile(file, smart = True) as archive:
+        for name in ['paper.pdf', 'notes.txt']:
+            with archive.open(ZipInfo(name), 'w') as member:
+                member.write(LARGE[:5000])
+    with ZipFile(file) as archive:
+        assert archive.getinfo('paper.pdf').compress_type == ZIP_STORED
+        assert archive.getinfo('notes.txt').compress_type == ZIP_DEFLATED
+        assert archive.read('paper.pdf') == LARGE[:5000]
+    assert incompressible('THESIS.PDF')
+    assert not incompressible('thesis.txt')
+
+
+def test_zip_write_and_infolist(tmp_path):
+    source = tmp_path / 'source.txt'
+    source.write_bytes(LARGE)
+    file = str(tmp_path / 'data.zip')
+    with ParallelZipFile(file) as archive:
+        archive.comment = b'a comment'
+        archive.write(str(source), 'dir/source.txt')
+        info = archive.infolist()[0]
+        assert info.file_size == len(LARGE)
+    with ZipFile(file) as archive:
+        assert archive.comment == b'a comment'
+        assert archive.read('dir/source.txt') == LARGE
+        assert archive.getinfo('dir/source.txt').CRC == info.CRC
+
+
+def test_zip64_member_headers(tmp_path):
+    file = str(tmp_path / 'data.zip')
+    with ParallelZipFile(file) as archive:
+        with archive.open(ZipInfo('large.txt'), 'w', force_zip64 = True) as member:
+            member.write(LARGE)
+    with ZipFile(file) as archive:
+        assert archive.testzip() is None
+        assert archive.read('large.txt') == LARGE
+
+
+def test_zip64_directory(tmp_path):
+    # More members than fit in the 16-bit counts of the ordinary end record.
+    file = str(tmp_path / 'data.zip')
+    count = compression._MAX_16 + 10
+    with ParallelZipFile(file) as archive:
+        for n in range(count):
+            with archive.open(ZipInfo('{}.txt'.format(n)), 'w') as member:
+                member.write(str(n).encode())
+    with ZipFile(file) as archive:
+        infos = archive.infolist()
+        assert len(infos) == count
+        assert archive.read(infos[-1]) == str(count - 1).encode()
+
+
+def test_zstd_reads_back(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    file = str(tmp_path / 'data.zst')
+    with ZstdFile(file, level = 3, threads = 2) as out:
+        out.write(LARGE[:1000])
+        out.write(LARGE[1000:])
+    with zstd_reader(file) as input:
+        assert input.read() == LARGE
+    # The file must also be readable by an ordinary decompressor.
+    with open(file, 'rb') as input:
+        reader = zstandard.ZstdDecompressor(max_window_size = 2**27).stream_reader(input)
+        assert reader.read() == LARGE
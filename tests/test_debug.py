@@ -0,0 +1,95 @@
+'''
+test_debug.py: tests of the debug logging and tracing facility
+'''
+
+import json
+import pytest
+
+from   eprints2bags import debug
+from   eprints2bags.debug import (set_debug, set_tracing, flush_trace, log,
+                                  new_span, span)
+
+
+@pytest.fixture(autouse = True)
+def no_logging():
+    set_debug(False)
+    yield
+    set_debug(False)
+
+
+def read_json_lines(file):
+    with open(file) as input:
+        return [json.loads(line) for line in input]
+
+
+def test_log_does_nothing_when_off(capsys):
+    log('nothing {}', 1)
+    assert new_span('x') is None
+    assert capsys.readouterr().err == ''
+
+
+def test_debug_to_console(capsys):
+    set_debug(True)
+    log('hello {}', 'world')
+    assert capsys.readouterr().err == 'eprints2bags test_debug.py test_debug_to_console(): hello world\n'
+
+
+def test_debug_to_json_lines(tmp_path):
+    file = str(tmp_path / 'debug.jsonl')
+    set_debug(True, file)
+    log('number {}', 42)
+    set_debug(False)
+    entries = read_json_lines(file)
+    assert len(entries) == 1
+    assert entries[0]['message'] == 'number 42'
+    assert entries[0]['function'] == 'test_debug_to_json_lines'
+    assert entries[0]['file'] == 'test_debug.py'
+    assert entries[0]['span'] is None
+
+
+def test_bad_format_keeps_message(capsys):
+    set_debug(True)
+    log('two {} {}', 'args?')
+    assert "two {} {} ('args?',)" in capsys.readouterr().err
+
+
+def test_tracing_keeps_last_messages(tmp_path):
+    file = str(tmp_path / 'trace.jsonl')
+    set_tracing(file, size = 5)
+    for n in range(10):
+        log('message {}', n)
+    flush_trace()
+    assert [e['message'] for e in read_json_lines(file)] == \
+        ['message {}'.format(n) for n in range(5, 10)]
+    # Flushing again writes nothing new.
+    flush_trace()
+    assert len(read_json_lines(file)) == 5
+
+
+def test_tracing_formats_mutable_args_at_once(tmp_path):
+    file = str(tmp_path / 'trace.jsonl')
+    set_tracing(file)
+    items = [1]
+    log('items {}', items)
+    items.append(2)
+    flush_trace()
+    assert read_json_lines(file)[0]['message'] == 'items [1]'
+
+
+def test_spans_tag_messages(tmp_path):
+    file = str(tmp_path / 'trace.jsonl')
+    set_tracing(file)
+    span_id = new_span('4')
+    with span(span_id):
+        log('inside')
+    log('outside')
+    flush_trace()
+    entries = read_json_lines(file)
+    assert [(e['message'], e['span']) for e in entries] == \
+        [('span for 4', span_id), ('inside', span_id), ('outside', None)]
+
+
+def test_debug_overrides_tracing(tmp_path, capsys):
+    set_debug(True)
+    set_tracing(str(tmp_path / 'trace.jsonl'))
+    assert isinstance(debug._tracer, debug._StreamTracer)
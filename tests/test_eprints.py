@@ -0,0 +1,77 @@
+'''
+test_eprints.py: tests of the EPrints-specific utilities
+'''
+
+from   lxml import etree
+import pytest
+import threading
+
+from   eprints2bags.eprints import eprints_records_list
+
+LIST_HEAD = b'''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+  "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>EPrints REST: Eprints DataSet</title></head>
+<body>
+<h1>EPrints REST: Eprints DataSet</h1>
+<ul>
+'''
+
+LIST_TAIL = b'</ul>\n</body>\n</html>\n'
+
+
+def list_items(numbers):
+    return b''.join("<li><a href='{0}/'>{0}/</a></li>\n<li><a href='{0}.xml'>{0}.xml</a></li>\n"
+                    .format(n).encode() for n in numbers)
+
+
+class Chunks():
+    # Iterator over the list in small chunks, which notes how far it got.
+
+    def __init__(self, data, size = 100, fail = False):
+        self._chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        self._fail = fail
+        self.read = 0
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self.read += 1
+            yield chunk
+        if self._fail:
+            raise IOError('connection reset')
+
+    def close(self):
+        self.closed.set()
+
+
+def test_records_list():
+    raw_list = Chunks(LIST_HEAD + list_items(range(1, 1001)) + LIST_TAIL)
+    assert list(eprints_records_list(raw_list)) == [str(n) for n in range(1, 1001)]
+    assert raw_list.closed.is_set()
+
+
+def test_records_list_is_read_ahead():
+    # The whole list is read even though only one number has been used.
+    raw_list = Chunks(LIST_HEAD + list_items(range(1, 1001)) + LIST_TAIL)
+    numbers = eprints_records_list(raw_list)
+    assert next(numbers) == '1'
+    assert raw_list.closed.wait(10)
+    assert raw_list.read == len(raw_list._chunks)
+    assert len(list(numbers)) == 999
+
+
+def test_records_list_error():
+    raw_list = Chunks(LIST_HEAD + list_items(range(1, 11)), fail = True)
+    numbers = eprints_records_list(raw_list)
+    with pytest.raises(IOError):
+        for number in numbers:
+            pass
+    assert number == '10'
+
+
+def test_records_list_bad_xml():
+    raw_list = Chunks(LIST_HEAD + b'<li><a href="4.xml">4.xml</a></oops>' + LIST_TAIL)
+    with pytest.raises(etree.XMLSyntaxError):
+        list(eprints_records_list(raw_list))
@@ -0,0 +1,60 @@
+'''
+test_journal.py: tests of the journal used to resume runs
+'''
+
+from   os import path
+
+from   eprints2bags.journal import (Journal, remove_journal, stage_done,
+                                    MISSING, SKIPPED)
+
+
+def test_journal_resume_keeps_stages(tmp_path):
+    file = str(tmp_path / 'journal.db')
+    journal = Journal(file)
+    journal.record(4, 'fetched', '4')
+    journal.record(6, 'archived', '6')
+    journal.record(9, MISSING)
+    journal.close()
+    journal = Journal(file, resume = True)
+    assert journal.stages() == {'4': 'fetched', '6': 'archived', '9': MISSING}
+    assert journal.stage('6') == 'archived'
+    assert journal.name(4) == '4'
+    assert journal.name(9) is None
+    assert journal.stage(11) is None
+    journal.close()
+
+
+def test_journal_without_resume_starts_over(tmp_path):
+    file = str(tmp_path / 'journal.db')
+    journal = Journal(file)
+    journal.record(4, 'bagged', '4')
+    journal.close()
+    journal = Journal(file, resume = False)
+    assert journal.stages() == {}
+    journal.close()
+
+
+def test_journal_later_stage_replaces_earlier(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.db'))
+    journal.record(4, 'fetched', '4')
+    journal.record(4, 'downloaded', '4')
+    assert journal.stage(4) == 'downloaded'
+    journal.close()
+
+
+def test_remove_journal(tmp_path):
+    file = str(tmp_path / 'journal.db')
+    journal = Journal(file)
+    journal.record(4, 'fetched')
+    journal.close()
+    remove_journal(file)
+    assert not any(path.exists(file + suffix) for suffix in ['', '-wal', '-shm'])
+    remove_journal(file)
+
+
+def test_stage_done():
+    assert stage_done('archived', 'downloaded')
+    assert stage_done('downloaded', 'downloaded')
+    assert not stage_done('fetched', 'bagged')
+    assert not stage_done(None, 'fetched')
+    assert not stage_done(SKIPPED, 'fetched')
@@ -0,0 +1,47 @@
+'''
+test_layout.py: tests of the layout of the output directory
+'''
+
+from   os import path
+
+from   eprints2bags.layout import (shard, record_path, find_record,
+                                   saved_layout, save_layout, remove_layout)
+
+
+def test_shard():
+    assert shard(4) == path.join('000', '000')
+    assert shard('999') == path.join('000', '000')
+    assert shard(1000) == path.join('000', '001')
+    assert shard(123456) == path.join('000', '123')
+    assert shard(1234567) == path.join('001', '234')
+    assert shard(999999999) == path.join('999', '999')
+
+
+def test_shard_of_odd_numbers():
+    assert shard('abc') == path.join('000', '000')
+    assert shard('-5') == path.join('000', '000')
+
+
+def test_record_path():
+    assert record_path('out', 123456, 'rec', True) == path.join('out', '000', '123', 'rec')
+    assert record_path('out', 123456, 'rec', False) == path.join('out', 'rec')
+
+
+def test_find_record(tmp_path):
+    output_dir = str(tmp_path)
+    assert find_record(output_dir, 4321, '4321') is None
+    sharded = record_path(output_dir, 4321, '4321', True)
+    (tmp_path / '000' / '004').mkdir(parents = True)
+    open(sharded + '.tar.gz', 'w').close()
+    assert find_record(output_dir, 4321, '4321') == sharded + '.tar.gz'
+    (tmp_path / '6').mkdir()
+    assert find_record(output_dir, 6, '6') == path.join(output_dir, '6')
+
+
+def test_saved_layout(tmp_path):
+    output_dir = str(tmp_path)
+    assert saved_layout(output_dir) is None
+    save_layout(output_dir, 'sharded')
+    assert saved_layout(output_dir) == 'sharded'
+    remove_layout(output_dir)
+    assert saved_layout(output_dir) is None
@@ -0,0 +1,42 @@
+'''
+test_main.py: tests of helpers used by the main program
+'''
+
+from   eprints2bags.__main__ import FilterGate, _FILTER_SAMPLE
+
+
+def gate_after(rejected_fraction, filter_seconds, fetch_seconds):
+    gate = FilterGate()
+    for n in range(_FILTER_SAMPLE):
+        gate.filtered(filter_seconds, n < rejected_fraction * _FILTER_SAMPLE)
+        gate.fetched(fetch_seconds)
+    return gate
+
+
+def test_filter_gate_starts_enabled():
+    gate = FilterGate()
+    assert gate.worthwhile()
+    gate.filtered(10, False)
+    gate.fetched(0.1)
+    assert gate.worthwhile()
+
+
+def test_filter_gate_keeps_useful_filter():
+    # Half the records left out, and fields are 10x cheaper than records.
+    assert gate_after(0.5, 0.01, 0.1).worthwhile()
+
+
+def test_filter_gate_stops_useless_filter():
+    # Nothing is left out, so the field queries are pure overhead.
+    assert not gate_after(0, 0.01, 0.1).worthwhile()
+    # Records are left out, but getting them costs less than the queries.
+    assert not gate_after(0.5, 0.1, 0.1).worthwhile()
+
+
+def test_filter_gate_resumes_when_records_are_left_out():
+    gate = gate_after(0, 0.01, 0.1)
+    assert not gate.worthwhile()
+    # Records rejected after being fetched in full count too.
+    for _ in range(3 * _FILTER_SAMPLE):
+        gate.judged(True)
+    assert gate.worthwhile()
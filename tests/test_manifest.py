@@ -0,0 +1,32 @@
+'''
+test_manifest.py: tests of the manifest of records written, used by -d
+'''
+
+from   eprints2bags.manifest import Manifest, ManifestEntry
+
+
+def test_manifest_persists_versions(tmp_path):
+    file = str(tmp_path / 'manifest.db')
+    manifest = Manifest(file)
+    first = ManifestEntry('4', '4', '2019-01-01 00:00:00', '1', '"a"', None,
+                          {'paper.pdf': 'abc'})
+    second = ManifestEntry('4', '4-2', '2019-02-01 00:00:00', '2', '"b"', None,
+                           {'paper.pdf': 'def'})
+    manifest.update(first)
+    manifest.update(second)
+    manifest.close()
+    manifest = Manifest(file)
+    assert manifest.entries(4) == [first, second]
+    assert manifest.entry('4') == second
+    assert manifest.has_name('4-2')
+    assert not manifest.has_name('6')
+    assert manifest.entry(6) is None
+    manifest.close()
+
+
+def test_manifest_update_replaces_same_name(tmp_path):
+    manifest = Manifest(str(tmp_path / 'manifest.db'))
+    manifest.update(ManifestEntry('4', '4', 'x', '1', None, None, None))
+    manifest.update(ManifestEntry('4', '4', 'y', '2', None, None, {}))
+    assert manifest.entries(4) == [ManifestEntry('4', '4', 'y', '2', None, None, {})]
+    manifest.close()
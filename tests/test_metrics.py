@@ -0,0 +1,115 @@
+'''
+test_metrics.py: tests of the per-operation metrics and their output formats
+'''
+
+import json
+import pytest
+
+from   eprints2bags import metrics
+from   eprints2bags.metrics import (timed, operation_stats, reset_metrics,
+                                    summary, write_summary, prometheus_text,
+                                    write_prometheus, LATENCY_BUCKETS)
+from   eprints2bags.pipeline import StageStats
+
+
+@pytest.fixture(autouse = True)
+def clean_metrics():
+    reset_metrics()
+    yield
+    reset_metrics()
+
+
+class Clock():
+    # Stand-in for time.perf_counter that advances by a set amount per call.
+
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def test_timed_counts_operations(monkeypatch):
+    monkeypatch.setattr(metrics.time, 'perf_counter', Clock(0.03))
+    with timed('download') as timing:
+        timing.bytes = 500
+    with pytest.raises(ValueError):
+        with timed('download'):
+            raise ValueError('failed')
+    stats = operation_stats()['download']
+    assert stats.count == 2
+    assert stats.errors == 1
+    assert stats.bytes == 500
+    assert stats.seconds == pytest.approx(0.06)
+    assert stats.max_seconds == pytest.approx(0.03)
+    # 0.03 s falls in the bucket whose upper bound is 0.05.
+    assert stats.buckets[LATENCY_BUCKETS.index(0.05)] == 2
+    assert sum(stats.buckets) == 2
+    assert operation_stats()['fetch'].count == 0
+
+
+def test_long_operations_go_in_last_bucket(monkeypatch):
+    monkeypatch.setattr(metrics.time, 'perf_counter', Clock(10000))
+    with timed('validate'):
+        pass
+    assert operation_stats()['validate'].buckets[-1] == 1
+
+
+def test_summary(tmp_path):
+    with timed('fetch') as timing:
+        timing.bytes = 100
+    stages = {'fetch': StageStats(1, 0.5, 0.1)}
+    file = str(tmp_path / 'metrics.json')
+    write_summary(file, stages)
+    with open(file) as input:
+        data = json.load(input)
+    assert data['operations']['fetch']['count'] == 1
+    assert data['operations']['fetch']['bytes'] == 100
+    assert data['operations']['fetch']['latency_buckets']['+Inf'] == 0
+    assert data['operations']['parse']['mean_seconds'] is None
+    assert data['stages']['fetch'] == {'items': 1, 'seconds': 0.5, 'cpu_seconds': 0.1}
+    assert 'retries' in data
+    assert list(data['operations']) == list(metrics.OPERATIONS)
+
+
+def test_summary_computes_rates(monkeypatch):
+    monkeypatch.setattr(metrics.time, 'perf_counter', Clock(0.5))
+    for _ in range(2):
+        with timed('download') as timing:
+            timing.bytes = 1000
+    data = summary()
+    assert data['operations']['download']['mean_seconds'] == pytest.approx(0.5)
+    assert data['operations']['download']['bytes_per_sec'] == pytest.approx(2000)
+    assert data['operations']['fetch']['bytes_per_sec'] is None
+    assert data['stages'] == {}
+    assert json.loads(json.dumps(data))['operations'] == data['operations']
+
+
+def test_prometheus_text(monkeypatch):
+    monkeypatch.setattr(metrics.time, 'perf_counter', Clock(0.03))
+    with timed('make_bag'):
+        pass
+    with timed('make_bag'):
+        pass
+    text = prometheus_text({'bag': StageStats(2, 1.5, None)})
+    lines = text.splitlines()
+    assert '# TYPE eprints2bags_operation_seconds histogram' in lines
+    # Histogram buckets are cumulative.
+    assert 'eprints2bags_operation_seconds_bucket{operation="make_bag",le="0.025"} 0' in lines
+    assert 'eprints2bags_operation_seconds_bucket{operation="make_bag",le="0.05"} 2' in lines
+    assert 'eprints2bags_operation_seconds_bucket{operation="make_bag",le="+Inf"} 2' in lines
+    assert 'eprints2bags_operation_seconds_count{operation="make_bag"} 2' in lines
+    assert 'eprints2bags_stage_items_total{stage="bag"} 2' in lines
+    assert 'eprints2bags_stage_seconds_total{stage="bag"} 1.5' in lines
+    assert not any(line.startswith('eprints2bags_stage_cpu_seconds_total{') for line in lines)
+    assert text.endswith('\n')
+
+
+def test_write_prometheus_replaces_file(tmp_path):
+    file = tmp_path / 'eprints2bags.prom'
+    file.write_text('old contents')
+    write_prometheus(str(file))
+    assert file.read_text().startswith('# HELP eprints2bags_')
+    assert [f.name for f in tmp_path.iterdir()] == ['eprints2bags.prom']
@@ -0,0 +1,70 @@
+'''
+test_network.py: tests of document downloads from the server
+'''
+
+import io
+import pytest
+
+from   eprints2bags import network
+from   eprints2bags.exceptions import NetworkFailure, NoContent, RateLimitExceeded
+from   eprints2bags.exceptions import ServiceFailure
+from   eprints2bags.messages import MessageHandler
+from   eprints2bags.network import download, download_files
+
+
+class Response():
+    # Stand-in for the parts of a requests.Response that download() uses.
+
+    def __init__(self, code, body = b'', headers = {}):
+        self.status_code = code
+        self.headers = dict(headers)
+        self.raw = io.BytesIO(body)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Replies to downloads with the responses in 'server.replies', in order,
+    # and records the pauses taken instead of sleeping.
+    class Server():
+        replies = []
+        pauses = []
+    monkeypatch.setattr(network, '_document_response',
+                        lambda *args, **kwargs: Server.replies.pop(0))
+    monkeypatch.setattr(network, '_pause',
+                        lambda name, seconds: Server.pauses.append((name, seconds)))
+    return Server
+
+
+def test_download_retries_after_throttling(server, tmp_path):
+    server.replies = [Response(429, headers = {'Retry-After': '7'}),
+                      Response(503),
+                      Response(200, b'document')]
+    dest = str(tmp_path / 'doc.pdf')
+    download('http://example.org/doc.pdf', None, None, dest)
+    assert open(dest, 'rb').read() == b'document'
+    assert server.pauses == [('throttled', 7), ('throttled', 10)]
+
+
+def test_throttled_download_is_not_missing(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(network, '_MAX_RECURSIVE_CALLS', 2)
+    server.replies = [Response(503) for _ in range(10)]
+    with pytest.raises(RateLimitExceeded):
+        download_files(['http://example.org/doc.pdf'], None, None, str(tmp_path),
+                       missing_ok = True, say = MessageHandler(False, True))
+    assert len(server.pauses) == 2
+
+
+def test_download_error_codes(server, tmp_path):
+    dest = str(tmp_path / 'doc.pdf')
+    server.replies = [Response(400)]
+    with pytest.raises(NetworkFailure):
+        download('http://example.org/doc.pdf', None, None, dest)
+    server.replies = [Response(500)]
+    with pytest.raises(ServiceFailure, match = 'Internal server error'):
+        download('http://example.org/doc.pdf', None, None, dest)
+    server.replies = [Response(404)]
+    with pytest.raises(NoContent):
+        download('http://example.org/doc.pdf', None, None, dest)
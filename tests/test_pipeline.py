@@ -0,0 +1,81 @@
+'''
+test_pipeline.py: tests of the multithreaded pipeline of stages
+'''
+
+import threading
+import pytest
+
+from   eprints2bags.pipeline import Pipeline, Stage
+
+
+class Boom(Exception):
+    pass
+
+
+def test_single_workers_keep_order():
+    output = []
+    stages = [Stage('double', lambda x: x * 2),
+              Stage('add', lambda x: x + 1),
+              Stage('collect', output.append)]
+    Pipeline(stages).run(range(100))
+    assert output == [x * 2 + 1 for x in range(100)]
+
+
+def test_multiple_workers_process_every_item():
+    output = []
+    lock = threading.Lock()
+    def collect(item):
+        with lock:
+            output.append(item)
+    stages = [Stage('square', lambda x: x * x, workers = 4),
+              Stage('collect', collect, workers = 3)]
+    Pipeline(stages).run(range(500))
+    assert sorted(output) == [x * x for x in range(500)]
+
+
+def test_none_drops_items():
+    output = []
+    stages = [Stage('odd', lambda x: x if x % 2 else None, workers = 2),
+              Stage('collect', output.append)]
+    pipeline = Pipeline(stages)
+    pipeline.run(range(20))
+    assert sorted(output) == list(range(1, 20, 2))
+    stats = pipeline.stats()
+    assert stats['odd'].items == 20
+    assert stats['collect'].items == 10
+
+
+def test_stage_error_stops_pipeline():
+    seen = []
+    def fail_on_five(item):
+        if item == 5:
+            raise Boom(item)
+        return item
+    stages = [Stage('check', fail_on_five),
+              Stage('collect', seen.append)]
+    pipeline = Pipeline(stages)
+    with pytest.raises(Boom):
+        pipeline.run(range(10000))
+    assert pipeline.stopped()
+    assert 5 not in seen
+    # Work still queued when the error happened is discarded.
+    assert len(seen) < 100
+
+
+def test_first_error_is_raised():
+    def fail(item):
+        raise Boom(item)
+    stages = [Stage('first', lambda x: x), Stage('fail', fail)]
+    with pytest.raises(Boom) as info:
+        Pipeline(stages).run(range(10))
+    assert info.value.args == (0,)
+
+
+def test_error_in_items_is_raised():
+    def items():
+        yield 1
+        yield 2
+        raise Boom('items')
+    output = []
+    with pytest.raises(Boom):
+        Pipeline([Stage('collect', output.append)]).run(items())
@@ -0,0 +1,138 @@
+'''
+test_ratelimit.py: tests of the request and transfer rate limiter
+'''
+
+from   email.utils import formatdate
+import pytest
+import time
+
+from   eprints2bags import ratelimit
+from   eprints2bags.ratelimit import RateLimiter, retry_after_seconds
+
+
+class Clock():
+    # Stand-in for time.monotonic that only moves when told to.
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'monotonic', clock)
+    return clock
+
+
+def test_first_request_is_immediate(clock):
+    limiter = RateLimiter(10)
+    assert limiter._reserve_request() == 0
+
+
+def test_requests_are_spaced_by_rate(clock):
+    limiter = RateLimiter(10)
+    limiter._reserve_request()
+    assert limiter._reserve_request() == pytest.approx(0.1)
+    assert limiter._reserve_request() == pytest.approx(0.2)
+
+
+def test_bucket_refills_up_to_one_second(clock):
+    limiter = RateLimiter(10)
+    limiter._reserve_request()
+    clock.now += 60
+    # A long idle time allows a burst of one second's worth of requests.
+    waits = [limiter._reserve_request() for _ in range(10)]
+    assert waits == [0] * 10
+    assert limiter._reserve_request() == pytest.approx(0.1)
+
+
+def test_backoff_halves_rate(clock):
+    limiter = RateLimiter(8)
+    limiter.backoff()
+    assert limiter.rate() == 4
+
+
+def test_backoff_stops_at_minimum(clock):
+    limiter = RateLimiter(1)
+    for _ in range(20):
+        clock.now += 100
+        limiter.backoff()
+    assert limiter.rate() == ratelimit._MIN_RATE
+
+
+def test_succeeded_climbs_back_to_maximum(clock):
+    limiter = RateLimiter(10)
+    limiter.backoff()
+    limiter.succeeded()
+    assert limiter.rate() == pytest.approx(5 + 10 / ratelimit._INCREASE_STEPS)
+    for _ in range(ratelimit._INCREASE_STEPS):
+        limiter.succeeded()
+    assert limiter.rate() == 10
+
+
+def test_retry_after_pauses_requests(clock):
+    limiter = RateLimiter(10)
+    limiter.backoff('30')
+    assert limiter._reserve_request() == pytest.approx(30)
+    clock.now += 31
+    assert limiter._reserve_request() == 0
+
+
+def test_byte_limit(clock):
+    limiter = RateLimiter(10, bytes_per_sec = 1000)
+    assert limiter._reserve_bytes(1000) == 0
+    assert limiter._reserve_bytes(500) == pytest.approx(0.5)
+    assert RateLimiter(10)._reserve_bytes(10**9) == 0
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds('12') == 12
+    assert retry_after_seconds('-5') == 0
+    assert retry_after_seconds('100000') == ratelimit._MAX_RETRY_AFTER
+    assert retry_after_seconds('not a date') == 0
+    assert retry_after_seconds(formatdate(time.time() + 60, usegmt = True)) \
+        == pytest.approx(60, abs = 2)
+
+
+def test_backoff_cuts_once_per_window(clock):
+    limiter = RateLimiter(8)
+    # Eight workers all get refused at about the same time.
+    for _ in range(8):
+        limiter.backoff()
+        clock.now += 0.01
+    assert limiter.rate() == 4
+    # The window is the time between two requests at the new rate.
+    clock.now += 0.25
+    limiter.backoff()
+    assert limiter.rate() == 2
+
+
+def test_backoff_window_covers_round_trip(clock):
+    limiter = RateLimiter(100)
+    for _ in range(10):
+        limiter.succeeded(seconds = 2)
+    limiter.backoff(seconds = 2)
+    clock.now += 1
+    limiter.backoff(seconds = 2)
+    assert limiter.rate() == 50
+    clock.now += 1.5
+    limiter.backoff(seconds = 2)
+    assert limiter.rate() == 25
+
+
+def test_ignored_backoff_still_pauses(clock):
+    limiter = RateLimiter(10)
+    limiter.backoff()
+    limiter.backoff('30')
+    assert limiter.rate() == 5
+    assert limiter._reserve_request() == pytest.approx(30)
+
+
+def test_acquire_returns_wait(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'sleep', lambda seconds: None)
+    limiter = RateLimiter(10)
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == pytest.approx(0.1)